@@ -1,18 +1,31 @@
 """Hubspace Service Integration"""
 from __future__ import annotations
 
+import json
 import logging
 
-from .const import DOMAIN
+from .client import async_get_coordinator
+from .const import DOMAIN, CONF_SNAPSHOT_TTL, CONF_WRITE_WINDOW, CONF_PUSH, CONF_RATE_LIMIT, CONF_RATE_BURST, CONF_MIN_INTERVAL, CONF_MAX_INTERVAL, CONF_PROMETHEUS, DATA_COORDINATOR
+from .dump import DEFAULT_MAX_SIZE, DIAGNOSTICS_FILE, build_diagnostics
+from .profiler import DEFAULT_SECONDS, MAX_SECONDS, async_profile
 import voluptuous as vol
 
 # Import the device class from the component that you want to support
 from homeassistant.helpers import config_validation as cv
-from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
-from homeassistant.core import HomeAssistant
+from homeassistant.const import ATTR_AREA_ID, ATTR_DEVICE_ID, ATTR_ENTITY_ID, CONF_PASSWORD, CONF_USERNAME, ENTITY_MATCH_ALL, Platform
+from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.exceptions import ConfigEntryAuthFailed, PlatformNotReady
+from homeassistant.helpers.discovery import async_load_platform
+from homeassistant.helpers.service import async_extract_entity_ids
 from homeassistant.helpers.typing import ConfigType
 from datetime import timedelta
 
+try:
+    from homeassistant.core import SupportsResponse
+except ImportError:
+    # Home Assistant before 2023.7, dumps and profiles are only written to files
+    SupportsResponse = None
+
 # Import exceptions from the requests module
 import requests.exceptions
 
@@ -27,13 +40,25 @@ CONF_DEBUG: Final = "debug"
 
 # Validation of the user's configuration
 HUBSPACE_SCHEMA = vol.All(
+    # Superseded by the dump_diagnostics service and the coordinator's polls,
+    # still accepted so old configs load
+    cv.deprecated(CONF_DEBUG),
+    cv.deprecated(CONF_SNAPSHOT_TTL),
     vol.Schema(
         {
             vol.Required(CONF_USERNAME): cv.string,
             vol.Required(CONF_PASSWORD): cv.string,
-            vol.Required(CONF_DEBUG, default=False): cv.boolean,
+            vol.Optional(CONF_DEBUG): cv.boolean,
             vol.Required(CONF_FRIENDLYNAMES, default=[]): vol.All(cv.ensure_list, [cv.string]),
             vol.Required(CONF_ROOMNAMES, default=[]): vol.All(cv.ensure_list, [cv.string]),
+            vol.Optional(CONF_SNAPSHOT_TTL): cv.positive_int,
+            vol.Optional(CONF_WRITE_WINDOW, default=0.25): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Optional(CONF_PUSH, default=True): cv.boolean,
+            vol.Optional(CONF_RATE_LIMIT, default=2): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Optional(CONF_RATE_BURST, default=10): cv.positive_int,
+            vol.Optional(CONF_MIN_INTERVAL, default=15): cv.positive_int,
+            vol.Optional(CONF_MAX_INTERVAL, default=300): cv.positive_int,
+            vol.Optional(CONF_PROMETHEUS, default=False): cv.boolean,
         },
         extra=vol.PREVENT_EXTRA,
     )
@@ -43,15 +68,111 @@ CONFIG_SCHEMA = vol.Schema(
     {vol.Optional(DOMAIN): HUBSPACE_SCHEMA}, extra=vol.ALLOW_EXTRA
 )
 
-def setup(
+# Without a target every device is dumped, so unlike cv.make_entity_service_schema none is required
+DUMP_DIAGNOSTICS_SCHEMA = vol.Schema(
+    {
+        # The frontend stores data here
+        vol.Remove('metadata'): dict,
+        **cv.ENTITY_SERVICE_FIELDS,
+        vol.Optional('anonymize', default=True): cv.boolean,
+        vol.Optional('max_size', default=DEFAULT_MAX_SIZE): cv.positive_int,
+    }
+)
+
+PROFILE_SCHEMA = vol.Schema(
+    {
+        vol.Optional('seconds', default=DEFAULT_SECONDS): vol.All(vol.Coerce(int), vol.Range(min=1, max=MAX_SECONDS)),
+        vol.Optional('refresh', default=True): cv.boolean,
+    }
+)
+
+async def async_setup(
     hass: HomeAssistant,
     yaml_config: ConfigType,
-) -> None:
+) -> bool:
     """Set up the Hubspace component."""
     if DOMAIN not in yaml_config:
         return False
 
-    hass.data[DOMAIN] = yaml_config[DOMAIN]
+    # The config is copied so the shared client, coordinator and discovery
+    # can be kept next to it, and outlive reloads of the platforms
+    hass.data[DOMAIN] = dict(yaml_config[DOMAIN])
+
+    try:
+        await async_get_coordinator(hass)
+    except PlatformNotReady as ex:
+        # The platforms retry with the same shared setup
+        _LOGGER.warning("Hubspace is not ready yet: %s", ex)
+    except ConfigEntryAuthFailed as ex:
+        # The platforms fail the same way, without logging in again
+        _LOGGER.error("Hubspace rejected the login, check the username and password: %s", ex)
+
+    # The API metric sensors need no configuration of their own
+    hass.async_create_task(async_load_platform(hass, Platform.SENSOR, DOMAIN, {}, yaml_config))
+    if hass.data[DOMAIN][CONF_PROMETHEUS]:
+        # http is only an after_dependency, so Prometheus does not pull in a web server
+        if "http" in hass.config.components:
+            from .metrics import HubspaceMetricsView
+            hass.http.register_view(HubspaceMetricsView(hass))
+        else:
+            _LOGGER.error("prometheus: true needs the http integration, add http: or default_config: to configuration.yaml")
+
+    async def send_command(call: ServiceCall) -> None:
+        """Send one function value to the devices of the targeted entities."""
+        _LOGGER.info("Received data" +  str(call.data))
+
+        coordinator = hass.data[DOMAIN].get(DATA_COORDINATOR)
+        if coordinator is None:
+            return
+
+        # Entities of one device (e.g. the outlets of a strip) share a single PUT
+        devices = {}
+        for entity_id in call.data['entity_id']:
+            entity = coordinator.entities.get(entity_id)
+            if entity is not None:
+                devices.setdefault(entity._childId, entity)
+        for entity in devices.values():
+            await entity.async_send_command(call.data['functionClass'], call.data['value'], call.data.get('functionInstance'))
+
+    # Registered once, so it reaches lights and fans alike
+    hass.services.async_register(DOMAIN, 'send_command', send_command)
+
+    async def dump_diagnostics(call: ServiceCall) -> dict:
+        """Dump the cached snapshot of the targeted entities' devices, or of all of them."""
+        coordinator = hass.data[DOMAIN].get(DATA_COORDINATOR)
+        if coordinator is None:
+            return {}
+
+        children = None
+        if call.data.get(ATTR_ENTITY_ID) != ENTITY_MATCH_ALL and any(key in call.data for key in (ATTR_ENTITY_ID, ATTR_DEVICE_ID, ATTR_AREA_ID)):
+            # Areas and devices are resolved to their entities
+            entity_ids = await async_extract_entity_ids(hass, call)
+            children = {coordinator.entities[entity_id]._childId for entity_id in entity_ids if entity_id in coordinator.entities}
+        diagnostics = build_diagnostics(coordinator, hass.data[DOMAIN], children,
+                                        anonymized=call.data['anonymize'],
+                                        max_size=call.data['max_size'])
+
+        path = hass.config.path(DIAGNOSTICS_FILE)
+        await hass.async_add_executor_job(_write_diagnostics, path, diagnostics)
+        _LOGGER.info("Hubspace diagnostics written to %s", path)
+        return diagnostics
+
+    async def profile(call: ServiceCall) -> dict:
+        """Profile polls and commands for a while and write the results to the config directory."""
+        coordinator = hass.data[DOMAIN].get(DATA_COORDINATOR)
+        if coordinator is None:
+            return {}
+        return await async_profile(hass, coordinator, call.data['seconds'], call.data['refresh'])
+
+    for name, handler, schema in (('dump_diagnostics', dump_diagnostics, DUMP_DIAGNOSTICS_SCHEMA), ('profile', profile, PROFILE_SCHEMA)):
+        if SupportsResponse is not None:
+            hass.services.async_register(DOMAIN, name, handler, schema=schema, supports_response=SupportsResponse.OPTIONAL)
+        else:
+            hass.services.async_register(DOMAIN, name, handler, schema=schema)
 
     return True
-        
\ No newline at end of file
+
+
+def _write_diagnostics(path, diagnostics):
+    with open(path, 'w') as file:
+        json.dump(diagnostics, file, indent=2)
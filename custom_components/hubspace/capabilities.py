@@ -0,0 +1,248 @@
+"""What a device can do, compiled once per model from its function descriptions."""
+from __future__ import annotations
+
+import bisect
+import logging
+import re
+
+from homeassistant.components.light import COLOR_MODES_COLOR, ColorMode
+from homeassistant.util.percentage import ordered_list_item_to_percentage, percentage_to_ordered_list_item
+
+_LOGGER = logging.getLogger(__name__)
+
+# Models whose descriptions do not tell the whole story. Anything not listed
+# here is taken from the functions the device describes.
+#   power: the power functionInstance the light switches
+#   modes: the color modes, replacing the derived ones
+#   extra_modes: color modes added in front of the derived ones
+#   mireds: (min_mireds, max_mireds)
+LIGHT_MODELS = {
+    # https://www.homedepot.com/p/Commercial-Electric-500-Watt-Single-Pole-Smart-Hubspace-Dimmer-with-Motion-Sensor-White-HPDA311CWB/317249353
+    'HPDA311CWB': {'modes': (ColorMode.BRIGHTNESS,)},
+    # https://www.homedepot.com/p/Defiant-15-Amp-120-Volt-Smart-Hubspace-Outdoor-Single-Outlet-Wi-Fi-Bluetooth-Plug-HPPA51CWB/316341409
+    # https://www.homedepot.com/p/Defiant-15-Amp-120-Volt-Smart-Hubspace-Wi-Fi-Bluetooth-Plug-with-1-Outlet-HPPA11AWB/315636834
+    'HPPA51CWB': {'modes': (ColorMode.ONOFF,)},
+    'HPPA11AWBA023': {'modes': (ColorMode.ONOFF,)},
+    'HPSA11CWB': {'modes': (ColorMode.ONOFF,)},
+    'HPPA11CWB': {'modes': (ColorMode.ONOFF,)},
+    # https://www.homedepot.com/p/EcoSmart-16-ft-Smart-Hubspace-RGB-and-Tunable-White-Tape-Light-Works-with-Amazon-Alexa-and-Google-Assistant-AL-TP-RGBCW-60/314680856
+    'AL-TP-RGBCW-60-2116, AL-TP-RGBCW-60-2232': {'power': 'primary', 'modes': (ColorMode.RGB, ColorMode.WHITE)},
+    'HPKA315CWB': {'power': 'primary', 'modes': (ColorMode.RGB, ColorMode.WHITE)},
+    'HPPA52CWBA023': {'power': 'primary', 'modes': (ColorMode.RGB, ColorMode.WHITE)},
+    # https://www.homedepot.com/p/Commercial-Electric-4-in-Smart-Hubspace-Color-Selectable-CCT-Integrated-LED-Recessed-Light-Trim-Works-with-Amazon-Alexa-and-Google-538551010/314199717
+    # https://www.homedepot.com/p/Commercial-Electric-6-in-Smart-Hubspace-Ultra-Slim-New-Construction-and-Remodel-RGB-W-LED-Recessed-Kit-Works-with-Amazon-Alexa-and-Google-50292/313556988
+    # https://www.homedepot.com/p/EcoSmart-120-Watt-Equivalent-Smart-Hubspace-PAR38-Color-Changing-CEC-LED-Light-Bulb-with-Voice-Control-1-Bulb-11PR38120RGBWH1/318411934
+    # https://www.homedepot.com/p/EcoSmart-60-Watt-Equivalent-Smart-Hubspace-A19-Color-Changing-CEC-LED-Light-Bulb-with-Voice-Control-1-Bulb-11A19060WRGBWH1/318411935
+    '50291, 50292': {'modes': (ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE), 'mireds': (154, 454)},
+    '11PR38120RGBWH1': {'modes': (ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE), 'mireds': (154, 454)},
+    '11A21100WRGBWH1': {'modes': (ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE), 'mireds': (154, 454)},
+    '11A19060WRGBWH1': {'modes': (ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE), 'mireds': (154, 454)},
+    # Fan lights dim, and their color temperatures come from the description
+    '52133, 37833': {'power': 'light-power', 'extra_modes': (ColorMode.BRIGHTNESS,)},
+    '76278, 37278': {'power': 'light-power', 'extra_modes': (ColorMode.BRIGHTNESS,)},
+    # https://www.homedepot.com/p/Commercial-Electric-5-in-6-in-Smart-Hubspace-Color-Selectable-CCT-Integrated-LED-Recessed-Light-Trim-Works-with-Amazon-Alexa-and-Google-538561010/314254248
+    '538551010, 538561010, 538552010, 538562010': {'modes': (ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE), 'mireds': (154, 370)},
+    # https://www.homedepot.com/p/Hampton-Bay-Lakeshore-13-in-Matte-Black-Smart-Hubspace-CCT-and-RGB-Selectable-LED-Flush-Mount-SMACADER-MAGB01/317216753
+    'SMACADER-MAGD01, SMACADER-MAGB01, SMACADER-MAGW01, CAD1aERMAGW26, CAD1aERMAGP26, CAD1aERMAGA26': {'modes': (ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE), 'mireds': (154, 370)},
+}
+
+TEMPERATURE_SUFFIX = 'K'
+DEFAULT_FAN_SPEEDS = ('fan-speed-025', 'fan-speed-050', 'fan-speed-075', 'fan-speed-100')
+
+# (model, functions) -> LightCapabilities. Devices of one model share their functions tuple.
+_LIGHTS = {}
+# (model, functions) -> FanCapabilities
+_FANS = {}
+
+
+class LightCapabilities:
+    """Everything a light entity decides per command, worked out up front."""
+
+    __slots__ = ('modes', 'power', 'brightness', 'color', 'temperature', 'min_mireds', 'max_mireds',
+                 'temperatures', 'temperature_range', 'temperature_suffix')
+
+    def __init__(self, modes, power, min_mireds=None, max_mireds=None, temperatures=None, temperature_range=None, temperature_suffix=None):
+        self.modes = frozenset(modes)
+        self.power = power
+        # ColorMode.ONOFF is the only color mode that doesn't support brightness
+        self.brightness = ColorMode.ONOFF not in self.modes
+        self.color = any(mode in COLOR_MODES_COLOR for mode in self.modes)
+        self.temperature = self.color or ColorMode.COLOR_TEMP in self.modes
+        self.min_mireds = min_mireds
+        self.max_mireds = max_mireds
+        # Sorted kelvin values the device accepts by name, e.g. 2700K
+        self.temperatures = temperatures
+        # (min, max, step) in kelvin, for devices that take a number
+        self.temperature_range = temperature_range
+        self.temperature_suffix = temperature_suffix
+
+    def nearest_temperature(self, kelvin):
+        """Return the supported color temperature closest to kelvin."""
+        if self.temperatures:
+            i = bisect.bisect_left(self.temperatures, kelvin)
+            candidates = self.temperatures[max(0, i - 1):i + 1]
+            return min(candidates, key=lambda choice: abs(choice - kelvin))
+        if self.temperature_range is not None:
+            low, high, step = self.temperature_range
+            kelvin = min(max(kelvin, low), high)
+            if step:
+                kelvin = low + round((kelvin - low) / step) * step
+            return min(kelvin, high)
+        return kelvin
+
+    def temperature_value(self, kelvin):
+        """The color-temperature value to send for kelvin."""
+        if self.temperature_suffix is not None:
+            return str(kelvin) + self.temperature_suffix
+        return kelvin
+
+    def kelvin(self, value):
+        """Strip the suffix from a reported color-temperature value."""
+        if self.temperature_suffix is not None and isinstance(value, str) and value.endswith(self.temperature_suffix):
+            return value[:-len(self.temperature_suffix)]
+        return value
+
+
+def _temperature_names(function):
+    for value in function.values:
+        name = value.name
+        if isinstance(name, str) and name.endswith(TEMPERATURE_SUFFIX):
+            try:
+                yield int(name[:-len(TEMPERATURE_SUFFIX)])
+            except ValueError:
+                _LOGGER.debug(f"Can't convert temperatureName {name} to int")
+
+
+def _temperature_range(function):
+    for value in function.values:
+        valueRange = value.range or {}
+        if 'min' in valueRange and 'max' in valueRange:
+            return valueRange['min'], valueRange['max'], valueRange.get('step') or 0
+    return None
+
+
+def _power_instance(functions):
+    instances = [function.functionInstance for function in functions if function.functionClass == 'power']
+    if 'light-power' in instances:
+        return 'light-power'
+    if len(instances) == 1:
+        return instances[0]
+    return None
+
+
+def _compile_light(model, functions):
+    override = LIGHT_MODELS.get(model, {})
+    byClass = {}
+    for function in functions:
+        byClass.setdefault(function.functionClass, []).append(function)
+
+    temperatures = None
+    temperature_range = None
+    temperature_suffix = None
+    for function in byClass.get('color-temperature', ()):
+        names = sorted(set(_temperature_names(function)))
+        if names:
+            temperatures = tuple(names)
+            temperature_suffix = TEMPERATURE_SUFFIX
+            break
+        temperature_range = temperature_range or _temperature_range(function)
+
+    modes = override.get('modes')
+    if modes is None:
+        modes = list(override.get('extra_modes', ()))
+        if 'color-rgb' in byClass:
+            modes.append(ColorMode.RGB)
+        if temperatures or temperature_range:
+            modes.append(ColorMode.COLOR_TEMP)
+        if ColorMode.RGB in modes or ColorMode.COLOR_TEMP in modes:
+            modes.append(ColorMode.WHITE)
+        if not modes:
+            modes = [ColorMode.BRIGHTNESS if 'brightness' in byClass else ColorMode.ONOFF]
+
+    min_mireds, max_mireds = override.get('mireds', (None, None))
+    if min_mireds is None:
+        if temperatures:
+            min_mireds, max_mireds = 1000000 // temperatures[-1], 1000000 // temperatures[0] + 1
+        elif temperature_range is not None:
+            min_mireds, max_mireds = 1000000 // temperature_range[1], 1000000 // temperature_range[0] + 1
+
+    power = override['power'] if 'power' in override else _power_instance(functions)
+    return LightCapabilities(modes, power, min_mireds, max_mireds, temperatures, temperature_range, temperature_suffix)
+
+
+def light_capabilities(model, functions) -> LightCapabilities:
+    """Return the light capabilities of a device, compiled once per model and description."""
+    key = (model, tuple(functions))
+    capabilities = _LIGHTS.get(key)
+    if capabilities is None:
+        capabilities = _LIGHTS[key] = _compile_light(model, functions)
+        _LOGGER.debug("Capabilities of %s: modes %s, power %s", model, sorted(capabilities.modes), capabilities.power)
+    return capabilities
+
+
+class FanCapabilities:
+    """Lookup tables between fan-speed values and Home Assistant percentages."""
+
+    __slots__ = ('power', 'speed_instance', 'speeds', 'speed_count', 'off_speed', 'percentages', 'values')
+
+    def __init__(self, power, speed_instance, speeds, off_speed=None):
+        self.power = power
+        self.speed_instance = speed_instance
+        # fan-speed values from slowest to fastest, without the one that means off
+        self.speeds = speeds
+        self.speed_count = len(speeds)
+        self.off_speed = off_speed
+        # value -> percentage, for updates
+        self.percentages = {speed: ordered_list_item_to_percentage(speeds, speed) for speed in speeds}
+        if off_speed is not None:
+            self.percentages[off_speed] = 0
+        # percentage -> value, for commands
+        self.values = (off_speed,) + tuple(percentage_to_ordered_list_item(speeds, percentage) for percentage in range(1, 101)) if speeds else ()
+
+    def value(self, percentage):
+        """The fan-speed value to send for a percentage, None when there is none."""
+        if not self.values:
+            return None
+        return self.values[min(max(int(percentage), 0), 100)]
+
+
+def _speed_number(name):
+    match = re.search(r"(\d+)$", name) if isinstance(name, str) else None
+    return int(match.group(1)) if match else None
+
+
+def _compile_fan(model, functions):
+    speed_instance = 'fan-speed'
+    speeds = []
+    off_speed = None
+    for function in functions:
+        if function.functionClass != 'fan-speed':
+            continue
+        speed_instance = function.functionInstance
+        named = [(value.name, _speed_number(value.name)) for value in function.values]
+        # Slowest first by the number the value ends with, the description lists them in any order
+        for name, number in sorted(named, key=lambda item: (item[1] is None, item[1] or 0)):
+            if number == 0:
+                off_speed = name
+            else:
+                speeds.append(name)
+        break
+    else:
+        # No description to go by, assume the four steps the first supported fans had
+        return FanCapabilities('fan-power', speed_instance, DEFAULT_FAN_SPEEDS, 'fan-speed-000')
+
+    instances = [function.functionInstance for function in functions if function.functionClass == 'power']
+    power = 'fan-power'
+    if instances and power not in instances:
+        power = instances[0]
+    return FanCapabilities(power, speed_instance, tuple(speeds), off_speed)
+
+
+def fan_capabilities(model, functions) -> FanCapabilities:
+    """Return the fan capabilities of a device, compiled once per model and description."""
+    key = (model, tuple(functions))
+    capabilities = _FANS.get(key)
+    if capabilities is None:
+        capabilities = _FANS[key] = _compile_fan(model, functions)
+        _LOGGER.debug("Fan speeds of %s: %s", model, capabilities.speeds)
+    return capabilities
@@ -0,0 +1,186 @@
+"""The account-wide Hubspace client, coordinator and discovery shared by all platforms."""
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import timedelta
+
+from homeassistant.const import CONF_PASSWORD, CONF_USERNAME, EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.exceptions import ConfigEntryAuthFailed, PlatformNotReady
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.dispatcher import async_dispatcher_connect, async_dispatcher_send
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.storage import Store
+
+from .const import DOMAIN, CONF_WRITE_WINDOW, CONF_PUSH, CONF_RATE_LIMIT, CONF_RATE_BURST, CONF_MIN_INTERVAL, CONF_MAX_INTERVAL, DATA_CLIENT, DATA_COORDINATOR, DATA_DISCOVERY, DATA_LOCK, DATA_NEW_DEVICE_LISTENERS, SIGNAL_NEW_DEVICES
+from .coordinator import HubspaceCoordinator
+from .discovery import discover_entities
+from .hubspace import AsyncHubSpace, AuthenticationError, CircuitOpenError
+
+# Import exceptions from the requests module
+import requests.exceptions
+
+STORAGE_VERSION = 1
+STORAGE_KEY = f"{DOMAIN}.auth"
+CATALOG_KEY = f"{DOMAIN}.catalog"
+# Seconds a rotated refresh token may wait before it is written out
+SAVE_DELAY = 10
+CATALOG_SAVE_DELAY = 60
+
+_LOGGER = logging.getLogger(__name__)
+
+
+async def async_create_client(hass: HomeAssistant) -> AsyncHubSpace:
+    """Start logging in with the saved refresh token, or the password if there is none.
+
+    The refresh token and account id are kept in Home Assistant's storage
+    directory, which only the Home Assistant user can read. The client is
+    returned at once and requests wait for the login.
+    """
+    conf = hass.data[DOMAIN]
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY, private=True)
+    saved = await store.async_load() or {}
+    if saved.get(CONF_USERNAME) != conf[CONF_USERNAME]:
+        saved = {}
+
+    hs = AsyncHubSpace(conf[CONF_USERNAME], conf[CONF_PASSWORD], async_get_clientsession(hass),
+                       write_window=conf[CONF_WRITE_WINDOW],
+                       rate_limit=conf[CONF_RATE_LIMIT],
+                       rate_burst=conf[CONF_RATE_BURST],
+                       login=False)
+
+    def credentials():
+        return {CONF_USERNAME: conf[CONF_USERNAME], **hs.getCredentials()}
+
+    # Token refreshes run on the event loop and in executor threads alike
+    hs.onRefreshToken = lambda: hass.loop.call_soon_threadsafe(store.async_delay_save, credentials, SAVE_DELAY)
+    hs.start_login(saved.get("refresh_token"), saved.get("accountId"))
+    return hs
+
+
+async def async_get_coordinator(hass: HomeAssistant) -> HubspaceCoordinator:
+    """Return the account's coordinator, logging in and discovering devices only once.
+
+    Every platform calls this, so the first one does the work and the others,
+    and any later reload, reuse the client and discovery in hass.data[DOMAIN].
+    A failed attempt keeps the client so the retry does not log in again,
+    and a rejected login is not retried at all.
+
+    When an earlier run saved the device catalog, entities are built from it
+    right away and the login and first poll catch up in the background.
+    Devices the catalog did not have get their entities after that poll.
+    """
+    data = hass.data[DOMAIN]
+    async with data.setdefault(DATA_LOCK, asyncio.Lock()):
+        coordinator = data.get(DATA_COORDINATOR)
+        if coordinator is not None:
+            return coordinator
+
+        catalog = Store(hass, STORAGE_VERSION, CATALOG_KEY, private=True)
+        saved = await catalog.async_load()
+        if saved is None or saved.get(CONF_USERNAME) != data[CONF_USERNAME] or not saved.get("metadevices"):
+            saved = None
+
+        if data.get(DATA_CLIENT) is None:
+            data[DATA_CLIENT] = await async_create_client(hass)
+        hs = data[DATA_CLIENT]
+        if saved is None:
+            try:
+                await hs.wait_for_login()
+            except AuthenticationError as ex:
+                raise ConfigEntryAuthFailed(str(ex)) from ex
+            except (requests.exceptions.RequestException, CircuitOpenError) as ex:
+                raise PlatformNotReady(f"Connection error while connecting to hubspace: {ex}") from ex
+
+        coordinator = HubspaceCoordinator(hass, hs,
+                                          min_interval=timedelta(seconds=data[CONF_MIN_INTERVAL]),
+                                          max_interval=timedelta(seconds=data[CONF_MAX_INTERVAL]))
+        if saved is not None:
+            coordinator.async_set_updated_data(hs.loadRegistry(saved["metadevices"]))
+        else:
+            await coordinator.async_refresh()
+            if not coordinator.last_update_success:
+                raise PlatformNotReady("Unable to fetch device state from hubspace")
+
+        data[DATA_DISCOVERY] = discover_entities(coordinator.data, data)
+        data[DATA_COORDINATOR] = coordinator
+        if saved is not None:
+            _async_add_new_devices(hass, coordinator)
+            hass.async_create_task(coordinator.async_refresh())
+
+        @callback
+        def save_catalog():
+            # Coalesced, pushes and polls only rewrite the file once a minute
+            catalog.async_delay_save(lambda: {CONF_USERNAME: data[CONF_USERNAME], "metadevices": coordinator.data.asDicts()}, CATALOG_SAVE_DELAY)
+
+        coordinator.async_add_listener(save_catalog)
+        if saved is None:
+            save_catalog()
+
+        if data[CONF_PUSH]:
+            coordinator.async_start_push()
+
+        async def shutdown(event):
+            await coordinator.async_shutdown()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, shutdown)
+        return coordinator
+
+
+async def async_setup_hubspace_platform(hass: HomeAssistant, platform: str, entity_types: dict,
+                                        async_add_entities: AddEntitiesCallback) -> None:
+    """Add a platform's share of the shared discovery, and of devices found after setup.
+
+    entity_types maps the kinds discovery hands out to entity classes. A
+    platform that is set up again, as on a reload, drops the listener of its
+    earlier setup so new devices are not added twice.
+    """
+    coordinator = await async_get_coordinator(hass)
+    data = hass.data[DOMAIN]
+
+    def create_entities(specs):
+        return [entity_types[kind](coordinator, **kwargs) for kind, kwargs in specs]
+
+    @callback
+    def add_new_devices(discovery):
+        new = create_entities(discovery.get(platform, []))
+        if new:
+            async_add_entities(new)
+
+    listeners = data.setdefault(DATA_NEW_DEVICE_LISTENERS, {})
+    unsubscribe = listeners.pop(platform, None)
+    if unsubscribe is not None:
+        unsubscribe()
+    listeners[platform] = async_dispatcher_connect(hass, SIGNAL_NEW_DEVICES, add_new_devices)
+
+    entities = create_entities(data[DATA_DISCOVERY].get(platform, []))
+    if entities:
+        async_add_entities(entities)
+
+
+@callback
+def _async_add_new_devices(hass: HomeAssistant, coordinator: HubspaceCoordinator) -> None:
+    """Discover the devices the saved catalog did not have, after the first poll that works."""
+    data = hass.data[DOMAIN]
+    catalog = coordinator.data
+    known = set(catalog.states)
+
+    @callback
+    def check():
+        registry = coordinator.data
+        # Pushes and commands update the catalog's registry in place, a poll replaces it
+        if not coordinator.last_update_success or registry is catalog:
+            return
+        remove()
+        new = set(registry.states) - known
+        if not new:
+            return
+        _LOGGER.info("Adding %d devices that are new since the last start", len(new))
+        discovery = discover_entities(registry, data, new)
+        # Platforms set up later read these, the ones already set up are sent them
+        for platform, specs in discovery.items():
+            data[DATA_DISCOVERY].setdefault(platform, []).extend(specs)
+        async_dispatcher_send(hass, SIGNAL_NEW_DEVICES, discovery)
+
+    remove = coordinator.async_add_listener(check)
@@ -0,0 +1,186 @@
+"""Real-time device state pushed by the Afero conclave stream."""
+from __future__ import annotations
+
+import asyncio
+import codecs
+import json
+import logging
+from typing import Callable
+
+import aiohttp
+
+from .hubspace import AsyncHubSpace, AuthenticationError, CircuitOpenError
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds to wait before reconnecting, doubled after every failed attempt
+RECONNECT_MIN = 1
+RECONNECT_MAX = 300
+CONNECT_TIMEOUT = 30
+# The stream is reopened when nothing at all arrives for this long
+IDLE_TIMEOUT = 15 * 60
+# Junk without a line break is dropped once the buffer grows past this
+MAX_BUFFER = 1024 * 1024
+
+
+def _login(channelId, token):
+    login = {"login": {"channelId": channelId, "accessToken": token, "type": "android", "version": "1.0.0", "protocol": 2, "trace": False}}
+    return (json.dumps(login) + "\n").encode()
+
+
+class ConclaveDecoder:
+    """Split the conclave byte stream into JSON messages as data arrives.
+
+    The stream sends one JSON object per line, but starts with bytes that
+    are not JSON at all. Anything before the first brace of a line, and any
+    line that does not parse, is logged and skipped instead of failing the
+    connection.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        # Reads can split a multi-byte character
+        self._utf8 = codecs.getincrementaldecoder("utf-8")("replace")
+
+    def feed(self, data: bytes) -> list[dict]:
+        self._buffer += self._utf8.decode(data)
+        *lines, self._buffer = self._buffer.split("\n")
+        if len(self._buffer) > MAX_BUFFER:
+            _LOGGER.debug("Dropping %d bytes of unterminated conclave data", len(self._buffer))
+            self._buffer = ""
+
+        messages = []
+        for line in lines:
+            start = line.find("{")
+            if start < 0:
+                if line.strip():
+                    _LOGGER.debug("Skipping conclave data: %r", line[:100])
+                continue
+            try:
+                message = json.loads(line[start:])
+            except ValueError:
+                _LOGGER.debug("Skipping conclave data: %r", line[:100])
+                continue
+            if isinstance(message, dict):
+                messages.append(message)
+        return messages
+
+
+def _state_updates(message, known):
+    """Yield (metadeviceId, values) for every device state carried by one message.
+
+    Events nest the state at different depths, so the message is searched for
+    objects shaped like a metadevice state, a metadeviceId with a list of
+    values. Only devices in known count, so function descriptions and other
+    look-alikes are not taken for state.
+    """
+    stack = [message]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(item)
+            continue
+        if not isinstance(item, dict):
+            continue
+        child = item.get('metadeviceId')
+        values = item.get('values')
+        if (isinstance(child, str) and child in known and isinstance(values, list) and values
+                and all(isinstance(lis, dict) and 'functionClass' in lis for lis in values)):
+            yield child, values
+        else:
+            stack.extend(item.values())
+
+
+class ConclaveStream:
+    """Keep a conclave connection open and feed its state updates into the client.
+
+    on_update is called with the set of updated metadevice ids after every
+    read that carried state, on_connection with True once the stream is
+    logged in and False when it drops.
+    """
+
+    def __init__(
+        self,
+        hs: AsyncHubSpace,
+        on_update: Callable[[set], None],
+        on_connection: Callable[[bool], None] | None = None,
+        ssl=True,
+    ) -> None:
+        self._hs = hs
+        self._on_update = on_update
+        self._on_connection = on_connection
+        # Pass ssl=None to talk to a plain local stand-in
+        self._ssl = ssl
+        self._task = None
+        self.connected = False
+        # Seconds to wait before the next attempt if the current one fails,
+        # doubled once that wait is over
+        self.reconnect_delay = RECONNECT_MIN
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        self.connected = False
+
+    def _set_connected(self, connected: bool) -> None:
+        if connected == self.connected:
+            return
+        self.connected = connected
+        _LOGGER.debug("Conclave stream %s", "connected" if connected else "disconnected")
+        if self._on_connection is not None:
+            self._on_connection(connected)
+
+    async def _run(self) -> None:
+        self.reconnect_delay = RECONNECT_MIN
+        while True:
+            try:
+                if await self._listen():
+                    self.reconnect_delay = RECONNECT_MIN
+            except AuthenticationError as ex:
+                _LOGGER.debug("Conclave stream stopped: %s", ex)
+                self._set_connected(False)
+                return
+            except (OSError, asyncio.TimeoutError, aiohttp.ClientError, CircuitOpenError) as ex:
+                _LOGGER.debug("Conclave stream failed: %s", ex)
+            except Exception:
+                # e.g. an unexpected conclaveAccess response, push must not stop for good
+                _LOGGER.exception("Conclave stream failed unexpectedly")
+            self._set_connected(False)
+            await asyncio.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX)
+
+    async def _listen(self) -> bool:
+        """Read one connection until it closes. Returns whether it ever logged in."""
+        host, port, token, expiresTimestamp = await self._hs.get_conclave()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=self._ssl), CONNECT_TIMEOUT)
+        loggedIn = False
+        try:
+            writer.write(_login(self._hs._accountId, token))
+            await writer.drain()
+
+            decoder = ConclaveDecoder()
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), IDLE_TIMEOUT)
+                if not data:
+                    return loggedIn
+                updated = set()
+                for message in decoder.feed(data):
+                    loggedIn = True
+                    self._set_connected(True)
+                    for child, values in _state_updates(message, self._hs.knownDevices()):
+                        self._hs.applyPushedState(child, values)
+                        updated.add(child)
+                if updated:
+                    self._on_update(updated)
+        finally:
+            writer.close()
@@ -1 +1,21 @@
-DOMAIN = "hubspace"
\ No newline at end of file
+DOMAIN = "hubspace"
+
+CONF_SNAPSHOT_TTL = "snapshot_ttl"
+CONF_WRITE_WINDOW = "write_window"
+CONF_PUSH = "push"
+CONF_RATE_LIMIT = "rate_limit"
+CONF_RATE_BURST = "rate_burst"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_MAX_INTERVAL = "max_interval"
+CONF_PROMETHEUS = "prometheus"
+
+# Keys of the shared account objects kept in hass.data[DOMAIN] next to the config
+DATA_CLIENT = "client"
+DATA_COORDINATOR = "coordinator"
+DATA_DISCOVERY = "discovery"
+DATA_LOCK = "setup_lock"
+# {platform: unsubscribe} of each platform's SIGNAL_NEW_DEVICES listener
+DATA_NEW_DEVICE_LISTENERS = "new_device_listeners"
+
+# Dispatched with {platform: [(kind, kwargs), ...]} for devices that showed up after setup
+SIGNAL_NEW_DEVICES = f"{DOMAIN}_new_devices"
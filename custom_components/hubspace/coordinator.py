@@ -0,0 +1,241 @@
+"""Account-wide polling for Hubspace entities."""
+from __future__ import annotations
+
+import abc
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+import aiohttp
+import requests.exceptions
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.exceptions import ConfigEntryAuthFailed
+from homeassistant.helpers.update_coordinator import CoordinatorEntity, DataUpdateCoordinator, UpdateFailed
+
+from .conclave import ConclaveStream
+from .const import DOMAIN
+from .hubspace import AsyncHubSpace, AuthenticationError, CircuitOpenError, DeviceRegistry
+
+SCAN_INTERVAL = timedelta(seconds=60)
+MIN_INTERVAL = timedelta(seconds=15)
+MAX_INTERVAL = timedelta(minutes=5)
+# While the conclave stream is up, polling only catches anything it missed
+PUSH_SCAN_INTERVAL = timedelta(minutes=15)
+# Seconds one poll may take before it is abandoned, so a slow cloud cannot stack polls up
+UPDATE_DEADLINE = 45
+
+# Function classes the entities control. Telemetry like wifi-rssi, available
+# or watts changes all the time and does not count as activity.
+ACTIVITY_FUNCTIONS = frozenset({'power', 'brightness', 'fan-speed', 'color-rgb', 'color-mode', 'color-temperature', 'toggle', 'lock-control'})
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _last_update(state):
+    # Newest lastUpdateTime of a device's controllable values, in milliseconds
+    return max((lis.lastUpdateTime or 0 for lis in state.values if lis.functionClass in ACTIVITY_FUNCTIONS), default=0)
+
+
+class ActivityScheduler:
+    """Poll interval per device, short right after it changed and growing while it stays idle.
+
+    A device's interval drops to the minimum when the newest lastUpdateTime
+    of its ACTIVITY_FUNCTIONS moves or it is sent a command, and doubles on every poll that finds it
+    unchanged, up to the maximum.
+    """
+
+    def __init__(self, min_interval: timedelta, max_interval: timedelta) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._seen = {}
+        self._intervals = {}
+
+    def observe(self, registry: DeviceRegistry) -> None:
+        now = time.time() * 1000
+        for child, state in registry.states.items():
+            updated = _last_update(state)
+            seen = self._seen.get(child)
+            self._seen[child] = updated
+            if seen is None:
+                # First sight: a device that changed within the longest interval counts as active
+                recent = now - updated < self.max_interval.total_seconds() * 1000
+                self._intervals[child] = self.min_interval if recent else self.max_interval
+            elif updated != seen:
+                self._intervals[child] = self.min_interval
+            else:
+                self._intervals[child] = min(self.max_interval, self._intervals.get(child, self.min_interval) * 2)
+
+    def touch(self, child) -> None:
+        self._intervals[child] = self.min_interval
+
+    def interval(self) -> timedelta:
+        # One request polls the whole account, so the most active device sets the pace
+        return min(self._intervals.values(), default=self.max_interval)
+
+
+class HubspaceCoordinator(DataUpdateCoordinator):
+    """Fetch the state of every device on the account with one request per interval.
+
+    Without push the interval follows device activity, see ActivityScheduler.
+    """
+
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        hs: AsyncHubSpace,
+        min_interval: timedelta = MIN_INTERVAL,
+        max_interval: timedelta = MAX_INTERVAL,
+    ) -> None:
+        super().__init__(hass, _LOGGER, name=DOMAIN, update_interval=SCAN_INTERVAL)
+        self.hs = hs
+        self.scheduler = ActivityScheduler(min_interval, max_interval)
+        self._stream = None
+        # entity_id -> entity, for services that target entities of any platform
+        self.entities = {}
+
+    async def _async_update_data(self) -> DeviceRegistry:
+        start = time.monotonic()
+        try:
+            registry = await self.hs.refresh_registry(UPDATE_DEADLINE)
+        except AuthenticationError as ex:
+            # Stops polling, the password is not sent again
+            raise ConfigEntryAuthFailed(str(ex)) from ex
+        except CircuitOpenError as ex:
+            # Entities show as unavailable until a probe gets through again
+            raise UpdateFailed(str(ex)) from ex
+        except (aiohttp.ClientError, asyncio.TimeoutError, requests.exceptions.RequestException) as ex:
+            raise UpdateFailed(f"Error communicating with hubspace: {ex}") from ex
+        _LOGGER.debug("%d of %d devices changed since the last poll", len(registry.changed), len(registry.states))
+        self.scheduler.observe(registry)
+        self._adapt_interval()
+        self.hs._phase('update', time.monotonic() - start)
+        return registry
+
+    @callback
+    def async_update_listeners(self) -> None:
+        start = time.monotonic()
+        super().async_update_listeners()
+        self.hs._phase('entity_update', time.monotonic() - start)
+
+    @property
+    def push_connected(self) -> bool:
+        return self._stream is not None and self._stream.connected
+
+    def _adapt_interval(self) -> None:
+        if self.push_connected:
+            self.update_interval = PUSH_SCAN_INTERVAL
+        else:
+            self.update_interval = self.scheduler.interval()
+
+    @callback
+    def async_device_active(self, child) -> None:
+        """Poll sooner after a command to a device."""
+        self.scheduler.touch(child)
+        previous = self.update_interval
+        self._adapt_interval()
+        if self.update_interval < previous:
+            self._schedule_refresh()
+
+    @callback
+    def async_start_push(self) -> None:
+        """Receive state changes from the conclave stream as they happen."""
+        if self._stream is None:
+            self._stream = ConclaveStream(self.hs, self._handle_push, self._handle_push_connection)
+            self._stream.start()
+
+    async def async_stop_push(self, *args) -> None:
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            await stream.stop()
+
+    async def async_shutdown(self) -> None:
+        """Stop polling, push and the writes still queued, when Home Assistant stops."""
+        await super().async_shutdown()
+        await self.async_stop_push()
+        await self.hs.cancel_writes()
+
+    @callback
+    def _handle_push(self, children: set) -> None:
+        # Pushed values were merged into the shared snapshot, so coordinator.data is already current
+        if self.data is not None:
+            self.async_update_listeners()
+
+    @callback
+    def _handle_push_connection(self, connected: bool) -> None:
+        self._adapt_interval()
+        if not connected:
+            # Catch up on whatever changed while the stream was down
+            self.hass.async_create_task(self.async_request_refresh())
+
+
+class HubspaceEntity(CoordinatorEntity):
+    """Entity that reads its state from the coordinator's device registry."""
+
+    _applied_state = None
+    _applied_available = None
+    # (functionClass, functionInstance) keys _update_from_registry reads, an
+    # instance of None matches any instance, and None reads everything
+    _state_keys = None
+
+    @abc.abstractmethod
+    def _update_from_registry(self, registry: DeviceRegistry) -> None:
+        """Copy this entity's fields out of the latest snapshot.
+
+        The coordinator fetches the whole account once per interval, so no requests are made here.
+        """
+
+    async def _async_write_states(self, values: list) -> None:
+        """Send values to this entity's device and show the accepted state right away.
+
+        The client folds the PUT response into the shared snapshot, so listeners
+        are refreshed from it instead of polling the account again.
+        """
+        start = time.monotonic()
+        await self.coordinator.hs.queue_states(self._childId, values)
+        self.coordinator.async_device_active(self._childId)
+        self.coordinator.async_update_listeners()
+        # Includes waiting out the write window
+        self.coordinator.hs._phase('command', time.monotonic() - start)
+
+    async def async_send_command(self, field_name, field_state, functionInstance=None) -> None:
+        await self._async_write_states([(field_name, functionInstance, field_state)])
+
+    async def async_added_to_hass(self) -> None:
+        await super().async_added_to_hass()
+        self.coordinator.entities[self.entity_id] = self
+        if self.coordinator.data is not None:
+            self._applied_state = self.coordinator.data.states.get(self._childId)
+            self._applied_available = self.available
+            self._update_from_registry(self.coordinator.data)
+
+    async def async_will_remove_from_hass(self) -> None:
+        self.coordinator.entities.pop(self.entity_id, None)
+        await super().async_will_remove_from_hass()
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        registry = self.coordinator.data
+        if registry is None:
+            return
+        state = registry.states.get(self._childId)
+        available = self.available
+        if available == self._applied_available and not self._affected_by(state):
+            self._applied_state = state
+            return
+        self._applied_state = state
+        self._applied_available = available
+        self._update_from_registry(registry)
+        super()._handle_coordinator_update()
+
+    def _affected_by(self, state) -> bool:
+        # The client keeps the same state object while a device is unchanged,
+        # and of a changed device only the values this entity reads matter,
+        # so telemetry like wifi-rssi leaves its entities alone
+        applied = self._applied_state
+        if state is applied:
+            return False
+        if state is None or applied is None or self._state_keys is None:
+            return True
+        return any(key in self._state_keys or (key[0], None) in self._state_keys for key in state.changes(applied))
@@ -0,0 +1,100 @@
+"""Decide once which entities every Hubspace device gets, for all platforms."""
+from __future__ import annotations
+
+import logging
+
+from homeassistant.const import Platform
+
+from .hubspace import DeviceRegistry
+
+_LOGGER = logging.getLogger(__name__)
+
+CONF_FRIENDLYNAMES = "friendlynames"
+CONF_ROOMNAMES = "roomnames"
+
+FAN_MODELS = ('52133, 37833', '76278, 37278')
+
+
+def _named_entities(model, deviceClass, friendlyName):
+    """Entities for a device picked by name, the entity looks the device up itself."""
+    if model == 'HPKA315CWB' or model == 'HPPA52CWBA023':
+        _LOGGER.debug("Creating Outlets")
+        return [(Platform.LIGHT, 'outlet', {'friendlyname': friendlyName, 'outletIndex': index}) for index in ("1", "2")]
+    if model == 'LTS-4G-W':
+        _LOGGER.debug("Creating Outlets")
+        return [(Platform.LIGHT, 'outlet', {'friendlyname': friendlyName, 'outletIndex': index}) for index in ("1", "2", "3", "4")]
+    if model == 'HB-200-1215WIFIB':
+        _LOGGER.debug("Creating Transformers")
+        return [(Platform.LIGHT, 'transformer', {'friendlyname': friendlyName, 'outletIndex': index}) for index in ("1", "2", "3")]
+    if model in FAN_MODELS:
+        _LOGGER.debug("Creating Fan and Light")
+        return [(Platform.FAN, 'fan', {'friendlyname': friendlyName}),
+                (Platform.LIGHT, 'light', {'friendlyname': friendlyName})]
+    if deviceClass == 'door-lock' and model == 'TBD':
+        _LOGGER.debug("Creating Lock")
+        return [(Platform.LIGHT, 'lock', {'friendlyname': friendlyName})]
+    _LOGGER.debug("creating lights")
+    return [(Platform.LIGHT, 'light', {'friendlyname': friendlyName})]
+
+
+def _toggle_indexes(functions):
+    for function in functions:
+        if function.functionClass == 'toggle':
+            try:
+                _LOGGER.debug(f"Found toggle with id {function.id} and instance {function.functionInstance}")
+                yield function.functionInstance.split('-')[1]
+            except IndexError:
+                _LOGGER.debug('Error extracting outlet index')
+
+
+def _discovered_entities(childId, model, deviceId, deviceClass, friendlyName, functions):
+    """Entities for an automatically discovered device."""
+    device = {'friendlyname': friendlyName, 'childId': childId, 'model': model, 'deviceId': deviceId, 'deviceClass': deviceClass}
+    if deviceClass == 'light' or deviceClass == 'switch':
+        return [(Platform.LIGHT, 'light', {**device, 'functions': functions})]
+    if deviceClass == 'power-outlet':
+        return [(Platform.LIGHT, 'outlet', {**device, 'outletIndex': index}) for index in _toggle_indexes(functions)]
+    if deviceClass == 'landscape-transformer':
+        return [(Platform.LIGHT, 'transformer', {**device, 'outletIndex': index}) for index in _toggle_indexes(functions)]
+    if deviceClass == 'fan':
+        return [(Platform.FAN, 'fan', device)]
+    return []
+
+
+def discover_entities(registry: DeviceRegistry, conf: dict, children=None) -> dict:
+    """Return {platform: [(kind, kwargs), ...]} for the configured or discovered devices.
+
+    Only the given registry is read, so no requests are made. With children
+    only those devices are looked at, e.g. the ones new since the last run.
+    """
+    found = []
+    for friendlyName in conf[CONF_FRIENDLYNAMES]:
+        _LOGGER.debug("friendlyName " + friendlyName)
+        childId, model, deviceId, deviceClass, _ = registry.childInfoByName(friendlyName)
+        if children is not None and childId not in children:
+            continue
+        _LOGGER.debug(f"Switch on Model {model} childId: {childId} deviceId: {deviceId} deviceClass: {deviceClass}")
+        found.extend(_named_entities(model, deviceClass, friendlyName))
+
+    for roomName in conf[CONF_ROOMNAMES]:
+        _LOGGER.debug("roomName " + roomName)
+        for childId in registry.childrenFromRoom(roomName) or []:
+            if children is not None and childId not in children:
+                continue
+            childId, model, deviceId, deviceClass, friendlyName = registry.childInfoById(childId)
+            _LOGGER.debug(f"Switch on Model {model} deviceId: {deviceId} deviceClass: {deviceClass} friendlyName: {friendlyName}")
+            found.extend(_named_entities(model, deviceClass, friendlyName))
+
+    if conf[CONF_FRIENDLYNAMES] == [] and conf[CONF_ROOMNAMES] == []:
+        _LOGGER.debug('Attempting automatic discovery')
+        for childId, model, deviceId, deviceClass, friendlyName, functions in registry.discover():
+            if children is not None and childId not in children:
+                continue
+            _LOGGER.debug(f"childId {childId} model {model} deviceId {deviceId} deviceClass {deviceClass} friendlyName {friendlyName}")
+            _LOGGER.debug("functions: " + str(functions))
+            found.extend(_discovered_entities(childId, model, deviceId, deviceClass, friendlyName, functions))
+
+    entities = {}
+    for platform, kind, kwargs in found:
+        entities.setdefault(platform, []).append((kind, kwargs))
+    return entities
@@ -0,0 +1,115 @@
+"""Anonymized diagnostics from the cached snapshot, made only when asked for."""
+from __future__ import annotations
+
+import json
+import random
+import re
+import time
+import uuid
+
+from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
+
+from .coordinator import HubspaceCoordinator
+from .discovery import CONF_FRIENDLYNAMES, CONF_ROOMNAMES
+
+DIAGNOSTICS_FILE = "hubspace_diagnostics.json"
+# Bytes of JSON a dump may take, devices that do not fit are left out
+DEFAULT_MAX_SIZE = 256 * 1024
+
+JSON_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+# The same things sample_data/anonymize_json.py replaces, matched as whole JSON strings
+UUID_RE = re.compile(r'"([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"')
+LATLONG_RE = re.compile(r'"(-?[0-9]{1,3}\.[0-9]*)"')
+FRIENDLYNAME_RE = re.compile(r'"friendlyName": "((?:[^"\\]|\\.)*)"')
+MAC_RE = re.compile(r'"([0-9a-f]{12})"')
+SSID_RE = re.compile(r'"functionClass": "wifi-ssid", "functionInstance": [^,]*, "value": "((?:[^"\\]|\\.)*)"')
+
+
+def _replace_all(text, pattern, replacement, also=()):
+    """Replace every JSON string matched by pattern, the same value always by the same stand-in.
+
+    also are more values to replace, as they appear in the JSON text.
+    """
+    found = {}
+    for value in pattern.findall(text) + list(also):
+        if value not in found:
+            found[value] = replacement(len(found))
+    # One pass, so a stand-in that equals another original value is not replaced again
+    return JSON_STRING_RE.sub(lambda match: f'"{found[match.group(1)]}"' if match.group(1) in found else match.group(0), text)
+
+
+def anonymize(text: str, names=()) -> str:
+    """Anonymize dumped JSON so it can be shared, like sample_data/anonymize_json.py.
+
+    names are replaced like friendlyNames, for names of devices and rooms
+    that were left out of the dump but show up elsewhere in it.
+    """
+    text = _replace_all(text, UUID_RE, lambda i: str(uuid.uuid4()))
+    text = _replace_all(text, LATLONG_RE, lambda i: str(random.random()))
+    # Names also show up in the configured friendlynames and roomnames
+    names = [json.dumps(name)[1:-1] for name in names]
+    text = _replace_all(text, FRIENDLYNAME_RE, lambda i: f"Friendly Name {i}", names)
+    text = _replace_all(text, MAC_RE, lambda i: '%012x' % random.randrange(16**12))
+    text = _replace_all(text, SSID_RE, lambda i: f"SSID{i}")
+    return text
+
+
+def _device(registry, lis):
+    data = lis.asDict()
+    if lis.id in registry.states:
+        # The state entities show, with our recent writes and pushes applied
+        data['state'] = registry.getDebugInfo(lis.id)
+    return data
+
+
+def build_diagnostics(coordinator: HubspaceCoordinator, conf: dict, children=None,
+                      anonymized: bool = True, max_size: int = DEFAULT_MAX_SIZE) -> dict:
+    """Return a dump of the cached snapshot, no requests are made.
+
+    With children only those devices are dumped. Devices are added until
+    max_size is reached, the rest are only counted.
+    """
+    config = {key: value for key, value in conf.items() if isinstance(value, (str, int, float, bool, list))}
+    for key in (CONF_USERNAME, CONF_PASSWORD):
+        if key in config:
+            config[key] = "**REDACTED**"
+
+    hs = coordinator.hs
+    registry = coordinator.data
+    entities = {entity_id: coordinator.entities[entity_id]._childId for entity_id in sorted(coordinator.entities)}
+    if anonymized:
+        # Entity ids are made from the device names
+        entities = {f"{entity_id.split('.')[0]}.hubspace_{i}": child for i, (entity_id, child) in enumerate(entities.items())}
+    diagnostics = {
+        "config": config,
+        "coordinator": {
+            "last_update_success": coordinator.last_update_success,
+            "update_interval": coordinator.update_interval.total_seconds() if coordinator.update_interval else None,
+            "push_connected": coordinator.push_connected,
+            "entities": entities,
+            "snapshot_age": None if hs._snapshot_time is None else round(time.monotonic() - hs._snapshot_time, 1),
+        },
+        "metadevices": [],
+        "omitted": 0,
+    }
+    names = list(conf.get(CONF_FRIENDLYNAMES, [])) + list(conf.get(CONF_ROOMNAMES, []))
+    if registry is None:
+        return json.loads(anonymize(json.dumps(diagnostics), names)) if anonymized else diagnostics
+
+    size = len(json.dumps(diagnostics))
+    for lis in registry.metadevices:
+        if children is not None and lis.id not in children:
+            continue
+        device = _device(registry, lis)
+        device_size = len(json.dumps(device)) + 2
+        if size + device_size > max_size:
+            diagnostics["omitted"] += 1
+            continue
+        size += device_size
+        diagnostics["metadevices"].append(device)
+
+    if anonymized:
+        # Every name of the account, the dump may leave out the rooms and devices they belong to
+        names += [lis.friendlyName for lis in registry.metadevices if lis.friendlyName]
+        diagnostics = json.loads(anonymize(json.dumps(diagnostics), names))
+    return diagnostics
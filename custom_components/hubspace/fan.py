@@ -1,159 +1,53 @@
 """Platform for fan integration."""
 from __future__ import annotations
-import re
 from enum import Enum
 
 import logging
 
-from .hubspace import HubSpace
-from .const import DOMAIN
-import voluptuous as vol
+from .capabilities import fan_capabilities
+from .client import async_setup_hubspace_platform
+from .coordinator import HubspaceEntity
 
 # Import the device class from the component that you want to support
-from homeassistant.helpers import config_validation as cv, entity_platform, service
-from homeassistant.components.fan import (PLATFORM_SCHEMA, FanEntity, FanEntityFeature)
-from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
-from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.components.fan import FanEntity, FanEntityFeature
+from homeassistant.const import Platform
+from homeassistant.core import HomeAssistant
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from datetime import timedelta
 
-# Import exceptions from the requests module
-import requests.exceptions
-
 class FanSpeed(Enum):
+    # Preset names for fans with four speeds, slowest first
     LOW = 1
     MEDIUM = 2
     HIGH = 3
     MAX = 4
-    def getPercentage(self):
-        return self.value * 25
-    def toHubspaceSpeedString(self):
-        return f"fan-speed-{str(self.getPercentage()).zfill(3)}"
-    def fromHubspaceSpeedString(speedstring):
-        percentage_digits = re.search("(\d{3})$", speedstring).group(0)
-        percentage = int(percentage_digits)
-        val = percentage / 25
-        return FanSpeed(val)
-        
+
 
 SCAN_INTERVAL = timedelta(seconds=60)
 BASE_INTERVAL = timedelta(seconds=60)
 
 _LOGGER = logging.getLogger(__name__)
 
-CONF_FRIENDLYNAMES: Final = "friendlynames"
-CONF_ROOMNAMES: Final = "roomnames"
-CONF_DEBUG: Final = "debug"
-
-def _add_entity(entities, hs, model, deviceClass, friendlyName, debug):
-        if model == '52133, 37833':
-            _LOGGER.debug("Creating Fan" )
-            entities.append(HubspaceFan(hs, friendlyName,debug))
-        elif model == '76278, 37278':
-            _LOGGER.debug("Creating Fan" )
-            entities.append(HubspaceFan(hs, friendlyName,debug))
-        else:
-            _LOGGER.debug("skipping non-fan entities")
-        return entities
-
-def setup_platform(
+async def async_setup_platform(
     hass: HomeAssistant,
     config: ConfigType,
-    add_entities: AddEntitiesCallback,
+    async_add_entities: AddEntitiesCallback,
     discovery_info: DiscoveryInfoType | None = None
 ) -> None:
     """Set up the Awesome Fan platform."""
-    
-    # Assign configuration variables.
-    # The configuration check takes care they are present.
-        
-    username = hass.data[DOMAIN][CONF_USERNAME]
-    password = hass.data[DOMAIN][CONF_PASSWORD]
-    debug = hass.data[DOMAIN][CONF_DEBUG]
-    try:
-        hs = HubSpace(username,password)
-    except requests.exceptions.ReadTimeout as ex:
-        raise PlatformNotReady(f"Connection error while connecting to hubspace: {ex}") from ex
-    
-    entities = []
-    for friendlyName in hass.data[DOMAIN][CONF_FRIENDLYNAMES]:
-
-        _LOGGER.debug("friendlyName " + friendlyName )
-        [childId, model, deviceId, deviceClass] = hs.getChildId(friendlyName)
-
-        _LOGGER.debug("Switch on Model " + model )
-        _LOGGER.debug("childId: " + childId )
-        _LOGGER.debug("deviceId: " + deviceId )
-        _LOGGER.debug("deviceClass: " + deviceClass )
-        
-        entities = _add_entity(entities, hs, model, deviceClass, friendlyName, debug)
-
-    for roomName in hass.data[DOMAIN][CONF_ROOMNAMES]:
-
-        _LOGGER.debug("roomName " + roomName )
-        children = hs.getChildrenFromRoom(roomName)
-
-        for childId in children:
-
-            _LOGGER.debug("childId " + childId )
-            [childId, model, deviceId, deviceClass, friendlyName] = hs.getChildInfoById(childId)
-
-            _LOGGER.debug("Switch on Model " + model )
-            _LOGGER.debug("deviceId: " + deviceId )
-            _LOGGER.debug("deviceClass: " + deviceClass )
-            _LOGGER.debug("friendlyName: " + friendlyName )
-
-            entities = _add_entity(entities, hs, model, deviceClass, friendlyName, debug)
-    
-    if hass.data[DOMAIN][CONF_FRIENDLYNAMES] == [] and hass.data[DOMAIN][CONF_ROOMNAMES] == []:
-        _LOGGER.debug('Attempting automatic discovery')
-        for [childId, model, deviceId, deviceClass, friendlyName, functions] in hs.discoverDeviceIds():
-            _LOGGER.debug("childId " + childId )
-            _LOGGER.debug("Switch on Model " + model )
-            _LOGGER.debug("deviceId: " + deviceId )
-            _LOGGER.debug("deviceClass: " + deviceClass )
-            _LOGGER.debug("friendlyName: " + friendlyName )
-            _LOGGER.debug("functions: " + str(functions))
-            
-            if deviceClass == 'fan':
-                entities.append(HubspaceFan(hs, friendlyName, debug, childId, model, deviceId, deviceClass))
-    
-    if not entities:
-        return
-    add_entities(entities, True)
-    
-    
-    def my_service(call: ServiceCall) -> None:
-        """My first service."""
-        _LOGGER.info("Received data" +  str(call.data))
-        
-        entity_ids = call.data['entity_id']       
-        functionClass = call.data['functionClass']
-        value = call.data['value']
-        
-        if 'functionInstance' in call.data:
-            functionInstance = call.data['functionInstance']
-        else:
-            functionInstance = None
-        
-        for entity_id in entity_ids:
-            _LOGGER.info("entity_id: " + str(entity_id))
-            for i in entities:
-                if i.entity_id == entity_id:
-                    _LOGGER.info("Found Entity")
-                    i.send_command(functionClass,value,functionInstance)
-            
-
-    # Register our service with Home Assistant.
-    hass.services.register("hubspace", 'send_command', my_service)
+    # The client, first poll and discovery are shared with the other platforms
+    await async_setup_hubspace_platform(hass, Platform.FAN, _ENTITY_TYPES, async_add_entities)
     
         
-class HubspaceFan(FanEntity):
+class HubspaceFan(HubspaceEntity, FanEntity):
     """Representation of an Awesome Fan."""
+
+    _state_keys = frozenset({('power', None), ('fan-speed', None)})
     
-    def __init__(self, hs, friendlyname, debug, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
+    def __init__(self, coordinator, friendlyname, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
         """Initialize an AwesomeFan."""
+        super().__init__(coordinator)
         
         _LOGGER.debug("Fan Name: " )
         _LOGGER.debug(friendlyname)
@@ -169,20 +63,28 @@ class HubspaceFan(FanEntity):
         
         _LOGGER.debug(f" Entity Name: {self._name}")
 
-        self._attr_supported_features = FanEntityFeature.PRESET_MODE
-        self._debug = debug
         self._state = 'off'
         self._childId = childId
         self._model = model
-        self._attr_preset_modes = list(FanSpeed.__members__)
-        self._attr_speed_count = len(self._attr_preset_modes)
-        self._hs = hs
+        self._hs = coordinator.hs
         self._deviceId = deviceId
-        self._debugInfo = None
         
         if None in (childId, model, deviceId, deviceClass):
-            [self._childId, self._model, self._deviceId, deviceClass] = self._hs.getChildId(friendlyname)
-        self.update()
+            [self._childId, self._model, self._deviceId, deviceClass] = coordinator.data.childInfoByName(friendlyname)[:4]
+
+        # Speeds come from the fan-speed values the device describes, so any number of them works
+        self._capabilities = fan_capabilities(self._model, coordinator.data.functions(self._childId))
+        self._attr_speed_count = self._capabilities.speed_count
+        # Without speed values there is nothing to map a percentage to
+        self._attr_supported_features = FanEntityFeature(0)
+        if self._capabilities.speed_count:
+            self._attr_supported_features |= FanEntityFeature.SET_SPEED
+        self._presets = {}
+        if self._capabilities.speed_count == len(FanSpeed):
+            self._presets = dict(zip(FanSpeed.__members__, self._capabilities.speeds))
+            self._attr_supported_features |= FanEntityFeature.PRESET_MODE
+        self._attr_preset_modes = list(self._presets) or None
+        self._preset_names = {speed: preset for preset, speed in self._presets.items()}
     
     @property
     def name(self) -> str:
@@ -199,9 +101,23 @@ class HubspaceFan(FanEntity):
         """Return true if fan is on."""
         return self._state == 'on'
 
-    def turn_on(self, **kwargs: Any) -> None:
-        self._hs.setStateInstance(self._childId,'power','fan-power','on')
-        self.update()
+    async def async_turn_on(self, percentage: int | None = None, preset_mode: str | None = None, **kwargs: Any) -> None:
+        # Power and speed go out in one PUT
+        values = [('power', self._capabilities.power, 'on')]
+        if preset_mode is not None:
+            values.append(('fan-speed', self._capabilities.speed_instance, self._presets[preset_mode]))
+        elif percentage:
+            speed = self._capabilities.value(percentage)
+            if speed is not None:
+                values.append(('fan-speed', self._capabilities.speed_instance, speed))
+        await self._async_write_states(values)
+
+    async def async_set_percentage(self, percentage: int) -> None:
+        """Set the speed of the fan, 0 turns it off."""
+        if percentage == 0:
+            await self.async_turn_off()
+        else:
+            await self.async_turn_on(percentage=percentage)
 
     @property
     def extra_state_attributes(self):
@@ -214,39 +130,28 @@ class HubspaceFan(FanEntity):
             attr["deviceId"] = self._deviceId
         attr["devbranch"] = False
         
-        attr["debugInfo"] = self._debugInfo
-        
         return attr
 
-    def set_preset_mode(self, preset_mode: str) -> None:
+    async def async_set_preset_mode(self, preset_mode: str) -> None:
         """Set the preset mode of the fan."""
-        preset_enum = FanSpeed[preset_mode]
-        self._hs.setStateInstance(self._childId,'fan-speed','fan-speed',preset_enum.toHubspaceSpeedString())
-        self.update()
+        await self._async_write_states([('fan-speed', self._capabilities.speed_instance, self._presets[preset_mode])])
 
         
-    def turn_off(self, **kwargs: Any) -> None:
+    async def async_turn_off(self, **kwargs: Any) -> None:
         """Instruct the fan to turn off."""
-        self._hs.setStateInstance(self._childId,'power','fan-power','off')
-        self.update()
+        await self._async_write_states([('power', self._capabilities.power, 'off')])
         
-    @property
-    def should_poll(self):
-        """Turn on polling """
-        return True
-        
-    def update(self) -> None:
-        """Fetch new state data for this fan.
-
-        This is the only method that should fetch new data for Home Assistant.
-        """
-        self._state = self._hs.getStateInstance(self._childId,'power','fan-power')
-        fanspeed = self._hs.getStateInstance(self._childId,'fan-speed','fan-speed')
-        _LOGGER.debug(f" Speed: {fanspeed}")
-        self._attr_preset_mode = FanSpeed.fromHubspaceSpeedString(fanspeed).name
+    def _update_from_registry(self, registry) -> None:
+        """Read this fan's state from the coordinator's snapshot."""
+        capabilities = self._capabilities
+        self._state = registry.getState(self._childId,'power',capabilities.power)
+        fanspeed = registry.getState(self._childId,'fan-speed',capabilities.speed_instance)
+        self._attr_percentage = capabilities.percentages.get(fanspeed) if self._state == 'on' else 0
+        self._attr_preset_mode = self._preset_names.get(fanspeed)
         
         _LOGGER.debug(f"UPDATE: {self._name}")
         _LOGGER.debug(f" State: {self._state}")
-        _LOGGER.debug(f" Speed: {self._attr_preset_mode}")
-        if self._debug:
-            self._debugInfo = self._hs.getDebugInfo(self._childId)
+        _LOGGER.debug(f" Speed: {fanspeed} ({self._attr_percentage}%)")
+
+
+_ENTITY_TYPES = {'fan': HubspaceFan}
@@ -1,38 +1,823 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 import json
 import re
 import calendar
 import datetime
 import hashlib
 import base64
+import bisect
+import codecs
 import os
 import asyncio
+import aiohttp
 import logging
+import threading
+import time
+import email.utils
+from collections import namedtuple
+from functools import partial
 
 _LOGGER = logging.getLogger(__name__)
 
+TOKEN_URL = "https://accounts.hubspaceconnect.com/auth/realms/thd/protocol/openid-connect/token"
+API_URL = "https://api2.afero.net/v1"
+
+def _token_header():
+    return {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "user-agent": "Dart/2.15 (dart:io)",
+        "host":"accounts.hubspaceconnect.com",
+    }
+
+def _refresh_data(refresh_token):
+    return {
+        "grant_type":    "refresh_token",
+        "refresh_token": refresh_token,
+        "scope": "openid email offline_access profile",
+        "client_id":     "hubspace_android",
+    }
+
+def _token_expiry(token):
+    """Return the exp claim of a JWT in epoch seconds, or None if it has none."""
+    try:
+        claims = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4)))
+        return float(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def _api_header(token, host="semantics2.afero.net", json_body=False):
+    header = {
+        "user-agent": "Dart/2.15 (dart:io)",
+        "host": host,
+        "accept-encoding": "gzip",
+        "authorization": "Bearer " + token,
+    }
+    if json_body:
+        header["content-type"] = "application/json; charset=utf-8"
+    return header
+
+def _state_url(accountId, child):
+    return API_URL + "/accounts/" + accountId + "/metadevices/" + child + "/state"
+
+def _state_payload(child, values, utc_time):
+    # values is a list of (functionClass, functionInstance, value), a later
+    # entry for the same function replaces an earlier one
+    merged = {}
+    for functionClass, functionInstance, value in values:
+        merged.pop((functionClass, functionInstance), None)
+        merged[(functionClass, functionInstance)] = value
+
+    payload = {
+        "metadeviceId": str(child),
+        "values": []
+    }
+    for (functionClass, functionInstance), value in merged.items():
+        entry = {
+            "functionClass": functionClass,
+            "lastUpdateTime": utc_time,
+            "value": value
+        }
+        if functionInstance is not None:
+            entry["functionInstance"] = functionInstance
+        payload["values"].append(entry)
+    return payload
+
+def _retry_after(value):
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """Token bucket for the requests to one host, shared by threads and the event loop.
+
+    A 429 stops the bucket for the Retry-After time, or for a pause that
+    doubles with every 429 in a row when the server does not say.
+    """
+
+    _min_pause = 1
+    _max_pause = 300
+
+    def __init__(self, host, rate, burst):
+        self.host = host
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.throttled = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._pause = self._min_pause
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0, self._blocked_until - now)
+            if self.rate <= 0:
+                return wait
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens may go negative, later callers then queue up behind earlier ones
+            self._tokens -= 1
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def tooManyRequests(self, retryAfter=None):
+        """Record a 429 and return the seconds to wait before trying again."""
+        with self._lock:
+            pause = retryAfter if retryAfter is not None else self._pause
+            self._pause = min(self._max_pause, self._pause * 2)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+            self.throttled += 1
+        _LOGGER.warning("Hubspace is throttling requests to %s, pausing them for %.0f seconds", self.host, pause)
+        return pause
+
+    def succeeded(self):
+        if self._pause != self._min_pause:
+            with self._lock:
+                self._pause = self._min_pause
+            _LOGGER.info("Hubspace stopped throttling requests to %s", self.host)
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ENDPOINTS = ('token', 'metadevices', 'state_get', 'state_put', 'conclave', 'account', 'other')
+
+def _endpoint(method, url):
+    if url == TOKEN_URL:
+        return 'token'
+    path = urlparse(url).path
+    if path.endswith('/metadevices'):
+        return 'metadevices'
+    if path.endswith('/state'):
+        return 'state_put' if method == 'put' else 'state_get'
+    if path.endswith('/conclaveAccess'):
+        return 'conclave'
+    if path.endswith('/users/me'):
+        return 'account'
+    return 'other'
+
+class EndpointMetrics:
+    __slots__ = ('requests', 'errors', 'timeouts', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.seconds = 0.0
+        # Per bucket of LATENCY_BUCKETS, the last one counts everything slower
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q-th fastest request fell into.
+
+        None without requests, or when it took longer than the last bucket.
+        """
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.buckets):
+            seen += count
+            if count and seen >= q * self.requests:
+                return bound
+        return None
+
+class ApiMetrics:
+    """Request counters and latency histograms of one client, per endpoint.
+
+    Recording takes a lock and a few additions, next to a network round trip.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {endpoint: EndpointMetrics() for endpoint in ENDPOINTS}
+        self.counters = {'token_refreshes': 0, 'throttled': 0}
+
+    def observe(self, endpoint, seconds, outcome=None):
+        """Record one request, outcome is None when it succeeded, else 'error' or 'timeout'."""
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            metrics = self.endpoints[endpoint]
+            metrics.requests += 1
+            metrics.seconds += seconds
+            metrics.buckets[bucket] += 1
+            if outcome == 'timeout':
+                metrics.timeouts += 1
+            elif outcome is not None:
+                metrics.errors += 1
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] += n
+
+class PhaseTimings:
+    """Time spent per phase (auth, network, parse, ...) while a profile is running."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # phase -> [count, total seconds, longest seconds]
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        with self._lock:
+            entry = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def summary(self):
+        with self._lock:
+            return {phase: {'count': count, 'total_seconds': round(total, 4),
+                            'average_ms': round(total / count * 1000, 2), 'max_ms': round(longest * 1000, 2)}
+                    for phase, (count, total, longest) in sorted(self.phases.items(), key=lambda item: -item[1][1])}
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while the circuit breaker for its host is open."""
+
+class AuthenticationError(Exception):
+    """Raised when Hubspace rejects the username and password."""
+
+class CircuitBreaker:
+    """Stop sending requests to a host after repeated failures.
+
+    After _failure_threshold failures in a row the circuit opens and requests
+    fail at once. Once _reset_timeout has passed a single request is let
+    through as a probe, closing the circuit when it works and opening it again,
+    for twice as long, when it does not.
+    """
+
+    _failure_threshold = 5
+    _reset_timeout = 30
+    _max_reset_timeout = 600
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self._opened_until = None
+        self._timeout = self._reset_timeout
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self._opened_until is not None
+
+    def before(self):
+        with self._lock:
+            if self._opened_until is None:
+                return
+            if self._probing or time.monotonic() < self._opened_until:
+                raise CircuitOpenError(f"Requests to {self.host} are paused after {self.failures} failures")
+            self._probing = True
+
+    def record(self, ok):
+        """Count the outcome of a request, None when it was cancelled before it had one."""
+        if ok is None:
+            with self._lock:
+                self._probing = False
+        elif ok:
+            self.succeeded()
+        else:
+            self.failed()
+
+    def succeeded(self):
+        with self._lock:
+            wasOpen = self._opened_until is not None
+            self.failures = 0
+            self._opened_until = None
+            self._timeout = self._reset_timeout
+            self._probing = False
+        if wasOpen:
+            _LOGGER.warning("Requests to %s work again, closing the circuit", self.host)
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing:
+                self._timeout = min(self._max_reset_timeout, self._timeout * 2)
+            elif self._opened_until is not None or self.failures < self._failure_threshold:
+                return
+            self._probing = False
+            self._opened_until = time.monotonic() + self._timeout
+        _LOGGER.warning("Requests to %s keep failing, pausing them for %d seconds", self.host, self._timeout)
+
+class StateValue(namedtuple('StateValue', ('functionClass', 'functionInstance', 'value', 'lastUpdateTime'))):
+    """One state value of a device, a plain tuple."""
+
+    __slots__ = ()
+
+    @classmethod
+    def fromDict(cls, lis):
+        if isinstance(lis, cls):
+            return lis
+        return cls(lis.get('functionClass'), lis.get('functionInstance'), lis.get('value'), lis.get('lastUpdateTime'))
+
+    @property
+    def key(self):
+        return self.functionClass, self.functionInstance
+
+    def asDict(self):
+        return self._asdict()
+
+def _state_values(values):
+    return tuple(StateValue.fromDict(lis) for lis in values or ())
+
+def _overlay(values, newer):
+    """Replace state values by those of newer, {key: StateValue}, that have a later lastUpdateTime."""
+    pending = dict(newer)
+    merged = []
+    for lis in values:
+        other = pending.pop(lis.key, None)
+        if other is not None and (lis.lastUpdateTime or 0) < (other.lastUpdateTime or 0):
+            lis = other
+        merged.append(lis)
+    merged.extend(pending.values())
+    return merged
+
+class FunctionValue(namedtuple('FunctionValue', ('name', 'range', 'hints'))):
+    """One named value a function accepts, e.g. a color temperature or fan speed."""
+
+    __slots__ = ()
+
+    @classmethod
+    def fromDict(cls, value):
+        return cls(value.get('name'), value.get('range'), value.get('hints'))
+
+    def asDict(self):
+        return {key: value for key, value in self._asdict().items() if value is not None}
+
+class FunctionDescriptor:
+    """One function from a device description, shared by every device with the same description."""
+
+    __slots__ = ('id', 'functionClass', 'functionInstance', 'type', 'values')
+
+    def __init__(self, id, functionClass, functionInstance, type, values):
+        self.id = id
+        self.functionClass = functionClass
+        self.functionInstance = functionInstance
+        self.type = type
+        self.values = values
+
+    @classmethod
+    def fromDict(cls, function):
+        values = tuple(FunctionValue.fromDict(value) for value in function.get('values') or ())
+        return cls(function.get('id'), function.get('functionClass'), function.get('functionInstance'), function.get('type'), values)
+
+    def asDict(self):
+        return {'id': self.id, 'functionClass': self.functionClass, 'functionInstance': self.functionInstance,
+                'type': self.type, 'values': [value.asDict() for value in self.values]}
+
+    def __repr__(self):
+        return f"FunctionDescriptor({self.functionClass!r}, {self.functionInstance!r}, {len(self.values)} values)"
+
+# (model, description id, description version) -> functions, every identical device shares one tuple
+_FUNCTIONS = {}
+
+def _functions(model, description):
+    key = (model, description.get('id'), description.get('version'))
+    functions = _FUNCTIONS.get(key)
+    if functions is None:
+        functions = tuple(FunctionDescriptor.fromDict(function) for function in description.get('functions') or ())
+        if key[1] is not None or key[2] is not None:
+            functions = _FUNCTIONS.setdefault(key, functions)
+    return functions
+
+class Metadevice:
+    """A home, room or device of the account, with only the fields the integration reads.
+
+    deviceValues, timestamps, images and the like are dropped from the cloud's
+    document. asDict gives back a document fromDict accepts, for the catalog.
+    """
+
+    __slots__ = ('id', 'typeId', 'deviceId', 'friendlyName', 'children', 'model', 'deviceClass',
+                 'defaultName', 'manufacturerName', 'description', 'functions', 'state')
+
+    @classmethod
+    def fromDict(cls, lis):
+        self = cls()
+        self.id = lis.get('id')
+        self.typeId = lis.get('typeId')
+        self.deviceId = lis.get('deviceId')
+        self.friendlyName = lis.get('friendlyName')
+        self.children = lis.get('children')
+        description = lis.get('description')
+        if description is None:
+            self.model = self.deviceClass = self.defaultName = self.manufacturerName = None
+            self.description = None
+            self.functions = ()
+        else:
+            device = description.get('device') or {}
+            self.model = device.get('model')
+            self.deviceClass = device.get('deviceClass')
+            self.defaultName = device.get('defaultName')
+            self.manufacturerName = device.get('manufacturerName')
+            # (id, version), which the function descriptors are shared by
+            self.description = (description.get('id'), description.get('version'))
+            self.functions = _functions(self.model, description)
+        state = lis.get('state')
+        self.state = None if state is None else _state_values(state.get('values'))
+        return self
+
+    def asDict(self):
+        lis = {key: getattr(self, key) for key in ('id', 'typeId', 'deviceId', 'friendlyName', 'children') if getattr(self, key) is not None}
+        if self.description is not None:
+            lis['description'] = {
+                'id': self.description[0],
+                'version': self.description[1],
+                'device': {'model': self.model, 'deviceClass': self.deviceClass,
+                           'defaultName': self.defaultName, 'manufacturerName': self.manufacturerName},
+                'functions': [function.asDict() for function in self.functions],
+            }
+        if self.state is not None:
+            lis['state'] = {'metadeviceId': self.id, 'values': [value.asDict() for value in self.state]}
+        return lis
+
+    def __repr__(self):
+        return f"Metadevice({self.typeId!r}, {self.id!r}, {self.friendlyName!r})"
+
+class DeviceState:
+    """State values of one device, indexed by functionClass and functionInstance."""
+
+    def __init__(self, values):
+        self.values = _state_values(values)
+        self.byInstance = {}
+        self.byClass = {}
+        # (functionClass, functionInstance) -> (value, lastUpdateTime), for change detection
+        self.stamps = {}
+        # Last matching value wins, like the old scans over the values list
+        for lis in self.values:
+            self.byInstance[lis.key] = lis.value
+            self.byClass[lis.functionClass] = lis.value
+            self.stamps[lis.key] = (lis.value, lis.lastUpdateTime)
+
+    def changes(self, previous):
+        """Return the (functionClass, functionInstance) keys whose value or lastUpdateTime differ from previous."""
+        if previous is None:
+            return set(self.stamps)
+        return {key for key in self.stamps.keys() | previous.stamps.keys() if self.stamps.get(key) != previous.stamps.get(key)}
+
+    def get(self, functionClass, functionInstance=None):
+        # Without an instance, any instance of the function class matches
+        if functionInstance is not None:
+            return self.byInstance.get((functionClass, functionInstance))
+        return self.byClass.get(functionClass)
+
+    def getPowerState(self):
+        return self.get("power")
+
+    def getRGB(self):
+        return _rgb(self.get('color-rgb'))
+
+def _device_info(lis):
+    return lis.id, lis.model, lis.deviceId, lis.deviceClass, lis.friendlyName
+
+def _best_device(devices):
+    # Prefer the first device that reports a model and class, like the old linear scans did
+    child = None
+    model = None
+    deviceId = None
+    deviceClass = None
+    friendlyName = None
+
+    for lis in devices:
+        child, model, deviceId, deviceClass, friendlyName = _device_info(lis)
+        if model is not None and deviceClass is not None:
+            break
+
+    return child,model,deviceId,deviceClass,friendlyName
+
+class DeviceRegistry:
+    """Indexes over one metadevices snapshot, built once per fetch."""
+
+    def __init__(self, metadevices):
+        self.metadevices = metadevices
+        self.devices = []
+        self.byId = {}
+        self.byFriendlyName = {}
+        self.byDeviceId = {}
+        self.byDeviceClass = {}
+        self.roomChildren = {}
+        self.states = {}
+
+        for lis in metadevices:
+            self.byId[lis.id] = lis
+            if lis.typeId == 'metadevice.room':
+                # The first room with a name wins
+                self.roomChildren.setdefault(lis.friendlyName, lis.children)
+            elif lis.typeId == 'metadevice.device':
+                self.devices.append(lis)
+                self.byFriendlyName.setdefault(lis.friendlyName, []).append(lis)
+                self.byDeviceId.setdefault(lis.deviceId, []).append(lis)
+                self.byDeviceClass.setdefault(lis.deviceClass, []).append(lis)
+                self.states[lis.id] = DeviceState(lis.state)
+        # Devices whose state differs from the previous snapshot, set by the client
+        self.changed = set(self.states)
+
+    def childrenFromRoom(self, roomName):
+        children = self.roomChildren.get(roomName)
+        if children is None:
+            _LOGGER.debug("No children found ")
+        else:
+            _LOGGER.debug('Room Children')
+            _LOGGER.debug(children)
+        return children
+
+    def childInfoById(self, childId):
+        lis = self.byId.get(childId)
+        if lis is None or lis.typeId != 'metadevice.device':
+            return _best_device([])
+        return _best_device([lis])
+
+    def childInfoByName(self, friendlyName):
+        return _best_device(self.byFriendlyName.get(friendlyName, []))
+
+    def devicesWithDeviceId(self, deviceId):
+        return self.byDeviceId.get(deviceId, [])
+
+    def devicesOfClass(self, deviceClass):
+        return self.byDeviceClass.get(deviceClass, [])
+
+    def functions(self, id, functionClass = None):
+        lis = self.byId.get(id)
+        if lis is None:
+            return ()
+        if functionClass is None:
+            return lis.functions
+        return tuple(function for function in lis.functions if function.functionClass == functionClass)
+
+    def getState(self, child, functionClass, functionInstance=None):
+        state = self.states.get(child)
+        if state is None:
+            return None
+        return state.get(functionClass, functionInstance)
+
+    def getPowerState(self, child):
+        return self.getState(child, "power")
+
+    def getRGB(self, child):
+        return _rgb(self.getState(child, 'color-rgb'))
+
+    def getDebugInfo(self, child):
+        state = self.states.get(child)
+        if state is None:
+            return None
+        return {'metadeviceId': child, 'values': [lis.asDict() for lis in state.values]}
+
+    def asDicts(self):
+        return [lis.asDict() for lis in self.metadevices]
+
+    def discover(self):
+        for lis in self.devices:
+            yield _device_info(lis) + (lis.functions,)
+
+def rgb_values(r, g, b):
+    # assume r,g,b 0-255
+    state = {'color-rgb': { 'r': r, 'b': b, 'g': g}}
+    return [('color-rgb', None, state), ('color-mode', None, 'color')]
+
+def _rgb(state):
+    r = int(state.get('color-rgb').get('r'))
+    g = int(state.get('color-rgb').get('g'))
+    b = int(state.get('color-rgb').get('b'))
+    return (r,g,b)
+
+def _conclave(response):
+    host = response.get('conclave').get('host')
+    port = response.get('conclave').get('port')
+    token = response.get('tokens')[0].get('token')
+    expiresTimestamp = response.get('tokens')[0].get('expiresTimestamp')
+    return host, port, token, expiresTimestamp
+
+# Bytes read at a time while streaming the metadevices document
+METADEVICE_CHUNK = 64 * 1024
+
+class MetadeviceParser:
+    """Parse the metadevices array one element at a time as bytes arrive.
+
+    feed returns the Metadevices completed by a chunk, so the whole document
+    is never held as text or as parsed JSON.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self):
+        self._buffer = ""
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._started = False
+        self._ended = False
+        # A partial element is not parsed again until the buffer has doubled, so large devices stay linear
+        self._retry_at = 0
+
+    def feed(self, data):
+        self._buffer += self._utf8.decode(data)
+        return self._parse(False)
+
+    def close(self):
+        self._buffer += self._utf8.decode(b"", True)
+        metadevices = self._parse(True)
+        if not self._ended:
+            raise ValueError("metadevices document ended early")
+        return metadevices
+
+    def _parse(self, final):
+        metadevices = []
+        buffer = self._buffer
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buffer) or self._ended:
+                break
+            if not self._started:
+                if buffer[pos] != "[":
+                    raise ValueError("metadevices document is not a list: " + buffer[pos:pos + 100])
+                self._started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                self._ended = True
+                pos += 1
+                break
+            if not final and len(buffer) < self._retry_at:
+                break
+            try:
+                lis, pos = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                self._retry_at = len(buffer) + (len(buffer) - pos)
+                break
+            self._retry_at = 0
+            metadevices.append(Metadevice.fromDict(lis))
+        self._buffer = buffer[pos:]
+        if self._retry_at:
+            self._retry_at -= pos
+        return metadevices
+
 class HubSpace:
-    
+
     _refresh_token = None
     _password = None
     _username = None
     _accountId = None
     _last_token = None
-    _last_token_time = None
-    # Token lasts 120 seconds
-    _token_duration = 118 * 1000
-    
-    def __init__(self, username,password):
+    _token_expires = None
+    # Seconds a token lasts when neither the response nor the token says
+    _token_duration = 118
+    # Seconds before expiry a token is refreshed, the old one is used meanwhile
+    _token_refresh_ahead = 30
+    # Connections kept alive per host, shared by every entity using this client
+    _pool_size = 10
+    # Requests per second and burst allowed per host, a rate of 0 turns limiting off
+    _rate_limit = 2
+    _rate_burst = 10
+    # Times a request is retried after a 429
+    _throttle_retries = 3
+    # Seconds to connect, and to wait between bytes of the response
+    _connect_timeout = 10
+    _read_timeout = 30
+    # Seconds queued writes to one device are collected into a single PUT
+    _write_window = 0.25
+    # Seconds a written value wins over older values from polls
+    _read_your_writes = 30
+
+    def __init__(self, username,password,pool_size=None,write_window=None,refresh_token=None,accountId=None,login=True,rate_limit=None,rate_burst=None):
         self._username = username
         self._password = password
-        self._refresh_token = self.getRefreshCode()
-        self._accountId = self.getAccountId()
-    
+        if pool_size is not None:
+            self._pool_size = pool_size
+        if write_window is not None:
+            self._write_window = write_window
+        if rate_limit is not None:
+            self._rate_limit = rate_limit
+        if rate_burst is not None:
+            self._rate_burst = rate_burst
+        self._sessions = {}
+        self._limiters = {}
+        self._breakers = {}
+        self.metrics = ApiMetrics()
+        # A PhaseTimings while a profile is running, phases are not timed otherwise
+        self.timings = None
+        self._snapshot = None
+        self._snapshot_time = None
+        self._writes = {}
+        # child -> {key: StateValue} pushed since the last snapshot was stored,
+        # so a poll that was in flight meanwhile cannot revert them
+        self._pushes = {}
+        self._token_lock = threading.Lock()
+        # Called with no arguments whenever the refresh token changes, so it can be persisted
+        self.onRefreshToken = None
+        if login:
+            self.login(refresh_token, accountId)
+
+    def login(self, refresh_token=None, accountId=None):
+        """Log in, skipping the password login when a saved refresh token still works."""
+        if refresh_token is not None:
+            self._refresh_token = refresh_token
+            try:
+                self._fetchToken()
+            except requests.exceptions.HTTPError as ex:
+                if ex.response is not None and ex.response.status_code >= 500:
+                    raise
+                _LOGGER.debug("Saved refresh token was rejected, logging in again: %s", ex)
+                self._refresh_token = None
+                accountId = None
+        # Logging in and looking up the account warms the pools for both
+        # accounts.hubspaceconnect.com and api2.afero.net
+        if self._refresh_token is None:
+            self._refresh_token = self.getRefreshCode()
+            self._notifyRefreshToken()
+        self._accountId = accountId or self.getAccountId()
+
+    def _session(self, host):
+        session = self._sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+            session.mount("https://", adapter)
+            self._sessions[host] = session
+        return session
+
+    def _limiter(self, host):
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            limiter = self._limiters.setdefault(host, RateLimiter(host, self._rate_limit, self._rate_burst))
+        return limiter
+
+    def _breaker(self, host):
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers.setdefault(host, CircuitBreaker(host))
+        return breaker
+
+    def _request(self, method, url, **kwargs):
+        host = urlparse(url).hostname
+        limiter = self._limiter(host)
+        breaker = self._breaker(host)
+        endpoint = _endpoint(method, url)
+        kwargs.setdefault('timeout', (self._connect_timeout, self._read_timeout))
+        for attempt in range(self._throttle_retries + 1):
+            time.sleep(limiter.reserve())
+            breaker.before()
+            ok = None
+            outcome = 'error'
+            start = time.monotonic()
+            try:
+                r = self._session(host).request(method, url, **kwargs)
+                ok = r.status_code < 500
+                if r.status_code < 400:
+                    outcome = None
+            except requests.exceptions.Timeout:
+                ok = False
+                outcome = 'timeout'
+                raise
+            except requests.exceptions.ConnectionError:
+                ok = False
+                raise
+            finally:
+                breaker.record(ok)
+                self.metrics.observe(endpoint, time.monotonic() - start, outcome)
+                self._phase('network', time.monotonic() - start)
+            if r.status_code != 429:
+                limiter.succeeded()
+                return r
+            self.metrics.count('throttled')
+            limiter.tooManyRequests(_retry_after(r.headers.get('Retry-After')))
+        return r
+
+    def _apiRequest(self, method, url, host="semantics2.afero.net", json_body=False, **kwargs):
+        """Send an authorized request, renewing the token and replaying once if it is rejected."""
+        token = self.getAuthTokenFromRefreshToken()
+        r = self._request(method, url, headers=_api_header(token, host, json_body), **kwargs)
+        if r.status_code == 401:
+            r.close()
+            token = self._renewToken(token)
+            r = self._request(method, url, headers=_api_header(token, host, json_body), **kwargs)
+        return r
+
+    def _phase(self, phase, seconds):
+        if self.timings is not None:
+            self.timings.add(phase, seconds)
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+        self._sessions = {}
+
     def getUTCTime(self):
         date = datetime.datetime.utcnow()
         utc_time = calendar.timegm(date.utctimetuple()) * 1000
         return utc_time
-        
+
     def getCodeVerifierAndChallenge(self):
         code_verifier = base64.urlsafe_b64encode(os.urandom(40)).decode('utf-8')
         code_verifier = re.sub('[^a-zA-Z0-9]+', '', code_verifier)
@@ -42,11 +827,14 @@ class HubSpace:
         return code_challenge,code_verifier
 
     def getRefreshCode(self):
-        
+
         URL = "https://accounts.hubspaceconnect.com/auth/realms/thd/protocol/openid-connect/auth"
-        
+
+        # Start the login from a clean cookie jar so a previous keycloak session is not reused
+        self._session(urlparse(URL).hostname).cookies.clear()
+
         [code_challenge,code_verifier] = self.getCodeVerifierAndChallenge()
-        
+
         # defining a params dict for the parameters to be sent to the API
         PARAMS = {'response_type':'code',
                 'client_id':'hubspace_android',
@@ -55,10 +843,9 @@ class HubSpace:
                 'code_challenge_method':'S256',
                 'scope':'openid offline_access',
                 }
-      
+
         # sending get request and saving the response as response object
-        r = requests.get(url = URL, params = PARAMS)
-        r.close()
+        r = self._request('get', URL, params = PARAMS)
         headers = r.headers
 
         session_code = re.search('session_code=(.+?)&', r.text).group(1)
@@ -73,31 +860,27 @@ class HubSpace:
             "user-agent": "Mozilla/5.0 (Linux; Android 7.1.1; Android SDK built for x86_64 Build/NYC) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/69.0.3497.100 Safari/537.36",
         }
 
-        auth_data = {        
+        auth_data = {
             "username":     self._username,
             "password":     self._password,
-            "credentialId":"", 
+            "credentialId":"",
         }
 
         headers = {}
-        r = requests.post(auth_url, data=auth_data, headers=auth_header,cookies=r.cookies.get_dict(),allow_redirects = False)
-        r.close()
+        r = self._request('post', auth_url, data=auth_data, headers=auth_header,cookies=r.cookies.get_dict(),allow_redirects = False)
         #print("first headers")
         #print(r.headers)
         location= r.headers.get('location')
+        if location is None or '&code=' not in location:
+            if r.status_code >= 500:
+                r.raise_for_status()
+            # Keycloak shows the login form again instead of redirecting
+            raise AuthenticationError("Hubspace rejected the username or password")
 
         session_state = re.search('session_state=(.+?)&code', location).group(1)
         code = re.search('&code=(.+?)$', location).group(1)
 
-        auth_url = "https://accounts.hubspaceconnect.com/auth/realms/thd/protocol/openid-connect/token"
-        
-        auth_header = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host":"accounts.hubspaceconnect.com",
-        }
-
-        auth_data = {        
+        auth_data = {
             "grant_type":    "authorization_code",
             "code": code ,
             "redirect_uri" : "hubspace-app://loginredirect",
@@ -106,395 +889,534 @@ class HubSpace:
         }
 
         headers = {}
-        r = requests.post(auth_url, data=auth_data, headers=auth_header)
-        r.close()
+        r = self._request('post', TOKEN_URL, data=auth_data, headers=_token_header())
+        if 400 <= r.status_code < 500:
+            raise AuthenticationError(f"Hubspace rejected the login with status {r.status_code}")
+        r.raise_for_status()
         refresh_token = r.json().get('refresh_token')
         #print(refresh_token)
         return refresh_token
 
-
-    def getAuthTokenFromRefreshToken(self):
-        
-        utcTime = self.getUTCTime()
-        
-        if self._last_token is not None and ((utcTime - self._last_token_time ) < self._token_duration) :
-            #_LOGGER.debug("Resuse Token")
+    def _cachedToken(self, ahead=0):
+        # Returns the token while it has more than ahead seconds left
+        if self._last_token is not None and time.time() < self._token_expires - ahead:
             return self._last_token
-        
-        #_LOGGER.debug("Get New Token")
-        auth_url = "https://accounts.hubspaceconnect.com/auth/realms/thd/protocol/openid-connect/token"
-        
-        auth_header = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host":"accounts.hubspaceconnect.com",
-        }
-
-        auth_data = {        
-            "grant_type":    "refresh_token",
-            "refresh_token": self._refresh_token,
-            "scope": "openid email offline_access profile",
-            "client_id":     "hubspace_android",
-        }
+        return None
 
-        headers = {}
-        r = requests.post(auth_url, data=auth_data, headers=auth_header)
-        r.close()
-        token = r.json().get('id_token')
+    def _storeToken(self, data, now):
+        token = data.get('id_token')
+        expires = _token_expiry(token) or (now + float(data.get('expires_in') or self._token_duration))
         self._last_token = token
-        self._last_token_time = utcTime
-        
+        self._token_expires = expires
+        self.metrics.count('token_refreshes')
+        # Keycloak may rotate the refresh token with every use
+        if data.get('refresh_token') and data.get('refresh_token') != self._refresh_token:
+            self._refresh_token = data.get('refresh_token')
+            self._notifyRefreshToken()
         return token
 
-    def getAccountId(self):
+    def _notifyRefreshToken(self):
+        if self.onRefreshToken is not None:
+            self.onRefreshToken()
 
-        token = self.getAuthTokenFromRefreshToken()
-        auth_url = "https://api2.afero.net/v1/users/me"
+    def getCredentials(self):
+        """Return what a later start needs to skip the password login."""
+        return {"refresh_token": self._refresh_token, "accountId": self._accountId}
 
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "api2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-        }
+    def _fetchToken(self):
+        now = time.time()
+        r = self._request('post', TOKEN_URL, data=_refresh_data(self._refresh_token), headers=_token_header())
+        r.raise_for_status()
+        return self._storeToken(r.json(), now)
 
-        auth_data = {}
-        headers = {}
-        r = requests.get(auth_url, data=auth_data, headers=auth_header)
-        r.close()
+    def getAuthTokenFromRefreshToken(self):
+        """Return a valid token, refreshing it shortly before it expires.
+
+        Only one thread refreshes, the others wait for its token.
+        """
+        token = self._cachedToken(self._token_refresh_ahead)
+        if token is not None:
+            return token
+        start = time.monotonic()
+        with self._token_lock:
+            token = self._cachedToken(self._token_refresh_ahead)
+            if token is None:
+                token = self._fetchToken()
+        self._phase('auth', time.monotonic() - start)
+        return token
+
+    def _renewToken(self, rejected):
+        """Replace a token the API rejected, unless another thread already did."""
+        with self._token_lock:
+            if self._last_token == rejected:
+                self._fetchToken()
+            return self._last_token
+
+    def getAccountId(self):
+
+        auth_url = API_URL + "/users/me"
+
+        r = self._apiRequest('get', auth_url, host="api2.afero.net")
         accountId = r.json().get('accountAccess')[0].get('account').get('accountId')
         return accountId
 
-    def getMetadeviceInfo(self):
+    def streamMetadevices(self):
+        """Yield the account's Metadevices while the document is still downloading."""
+        auth_url = API_URL + "/accounts/" + self._accountId + "/metadevices?expansions=state"
+        with self._apiRequest('get', auth_url, stream=True) as r:
+            r.raise_for_status()
+            parser = MetadeviceParser()
+            for chunk in r.iter_content(METADEVICE_CHUNK):
+                yield from parser.feed(chunk)
+            yield from parser.close()
 
-        token = self.getAuthTokenFromRefreshToken()
-        
-        _LOGGER.debug("token " + token )
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "semantics2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-        }
+    def _storeSnapshot(self, metadevices):
+        start = time.monotonic()
+        previous = self._snapshot
+        self._snapshot = DeviceRegistry(metadevices)
+        self._snapshot_time = time.monotonic()
+        # Polls that were in flight while we wrote, or a push came in, must not revert it
+        pushes, self._pushes = self._pushes, {}
+        for child in set(self._writes) | set(pushes):
+            state = self._snapshot.states.get(child)
+            if state is not None:
+                values = _overlay(state.values, pushes.get(child, {}))
+                self._snapshot.states[child] = DeviceState(self._applyWrites(child, values))
+        # Unchanged devices keep their previous state object, so readers can
+        # tell what changed with an identity check
+        self._snapshot.changed = set()
+        for child, state in self._snapshot.states.items():
+            old = previous.states.get(child) if previous is not None else None
+            if old is not None and not state.changes(old):
+                self._snapshot.states[child] = old
+            else:
+                self._snapshot.changed.add(child)
+        self._phase('snapshot', time.monotonic() - start)
+        return self._snapshot
 
-        _LOGGER.debug("token " + self._accountId )
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId + "/metadevices?expansions=state"
+    def loadRegistry(self, metadevices):
+        """Use metadevices saved by an earlier run until the cloud is asked.
 
-        auth_data = {}
-        headers = {}
-        r = requests.get(auth_url, data=auth_data, headers=auth_header)
-        r.close()
+        The snapshot has no age, as it is unknown how old the saved copy is.
+        """
+        registry = self._storeSnapshot([Metadevice.fromDict(lis) for lis in metadevices])
+        self._snapshot_time = None
+        return registry
 
-        return r
+    def getRegistry(self):
+        """Fetch the metadevices and return their device registry.
 
-    def getChildrenFromRoom(self, roomName):
+        The old snapshot stays until the new one is stored, so it can be diffed against.
+        """
+        return self._storeSnapshot(list(self.streamMetadevices()))
 
-        response = self.getMetadeviceInfo()
+    def knownDevices(self):
+        """Ids of the devices in the latest snapshot, however old, without fetching it."""
+        return self._snapshot.states.keys() if self._snapshot is not None else ()
 
-        children = None
+    def _getStateValues(self,child):
+        r = self._apiRequest('get', _state_url(self._accountId, child))
+        return r.json().get('values')
 
-        for lis in response.json():
-            for key,val in lis.items():
-                if key == 'friendlyName' and val == roomName:
-                    if lis.get('typeId') == 'metadevice.room':
-                        children = lis.get('children')
-                        _LOGGER.debug('Room Children')
-                        _LOGGER.debug(children)
-                        return children
+    def _storeState(self, child, values):
+        # The snapshot is the only copy of a device's state, unchanged devices keep theirs
+        state = DeviceState(self._applyWrites(child, _state_values(values)))
+        old = self._snapshot.states.get(child) if self._snapshot is not None else None
+        if old is None:
+            return state
+        if not state.changes(old):
+            return old
+        self._snapshot.states[child] = state
+        return state
 
-        _LOGGER.debug("No children found ")
-        return children
+    def _applyWrites(self, child, values):
+        """Overlay our recent writes on state values read from the cloud.
 
-    def getChildInfoById(self, childId):
-
-        response = self.getMetadeviceInfo()
-
-        child = None
-        model = None
-        deviceId = None
-        deviceClass = None
-        friendlyName = None
-
-        for lis in response.json():
-            for key,val in lis.items():
-                if key == 'id' and val == childId and lis.get('typeId') == 'metadevice.device':
-                    #print(key, val)
-                    #_LOGGER.debug('getChildInfoById match')
-                    #_LOGGER.debug(lis)
-                    child = lis.get('id')
-                    deviceId = lis.get('deviceId')
-                    model = lis.get('description').get('device').get('model')
-                    deviceClass = lis.get('description').get('device').get('deviceClass')
-                    friendlyName = lis.get('friendlyName')
-                    if model is not None and deviceClass is not None:
-                        return child,model,deviceId,deviceClass,friendlyName
-
-        #_LOGGER.debug("No model found ")
-        return child,model,deviceId,deviceClass,friendlyName
-
-    def getChildId(self,deviceName):
-
-        response = self.getMetadeviceInfo()
-
-        child = None
-        model = None
-        deviceId = None
-        deviceClass = None
-
-        #_LOGGER.debug("############ Dumping all info 1 0f 2 #########")
-        #_LOGGER.debug(json.dumps(response.json(), indent=4, sort_keys=True))
-        #_LOGGER.debug("############ End Dump #########")
-
-        for lis in response.json():
-            for key,val in lis.items():
-                if key == 'friendlyName' and val == deviceName and lis.get('typeId') == 'metadevice.device':
-                    #print(key, val)
-                    #_LOGGER.debug('Printing Possible Error')
-                    #_LOGGER.debug(lis)
-                    child = lis.get('id')
-                    deviceId = lis.get('deviceId')
-                    model = lis.get('description').get('device').get('model')
-                    deviceClass = lis.get('description').get('device').get('deviceClass')
-                    if model is not None and deviceClass is not None:
-                        return child,model,deviceId, deviceClass
-        
-        #_LOGGER.debug("No model found ")
-        return child,model,deviceId,deviceClass
-
-    def discoverDeviceIds(self):
-        response = self.getMetadeviceInfo()
-                
-        for lis in response.json():
-            if lis.get('typeId') == 'metadevice.device':
-                child = lis.get('id')
-                deviceId = lis.get('deviceId')
-                model = lis.get('description', {}).get('device', {}).get('model')
-                deviceClass = lis.get('description', {}).get('device', {}).get('deviceClass')
-                friendlyName = lis.get('friendlyName')
-                functions = lis.get('description', {}).get('functions', [])
-                yield child, model, deviceId, deviceClass, friendlyName, functions
-
-    def getFunctions(self, id, functionClass = None):
-        response = self.getMetadeviceInfo()
-        
-        for lis in response.json():
-            if lis.get('id') == id:
-                functions = lis.get('description', {}).get('functions', [])
-                if functionClass is None:
-                    return functions
-                for function in functions:
-                    if function.get('functionClass') == functionClass:
-                        yield function
-
-    def getState(self,child,desiredStateName):
-
-        state = None
-        
-        token = self.getAuthTokenFromRefreshToken()
-        
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "semantics2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-        }
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId + "/metadevices/" + child + "/state"
-        auth_data = {}
-        headers = {}
+        A read value only replaces a written one once its lastUpdateTime is
+        newer than the write, so a poll that raced a command cannot undo it.
+        """
+        writes = self._writes.get(child)
+        if not writes:
+            return values
+        now = time.monotonic()
+        for key in [key for key, (expires, lis) in writes.items() if expires <= now]:
+            del writes[key]
+        if not writes:
+            del self._writes[child]
+            return values
 
-        r = requests.get(auth_url, data=auth_data, headers=auth_header)
-        r.close()
-        for lis in r.json().get('values'):
-            for key,val in lis.items():
-                if key == 'functionClass' and val == desiredStateName:
-                    state = lis.get('value')
+        return _overlay(values, {key: lis for key, (expires, lis) in writes.items()})
 
-        #print(desiredStateName + ": " + state)
-        return state
-    
-    def getStateInstance(self,child,desiredStateName,desiredFunctionInstance):
+    def applyPushedState(self, child, values):
+        """Merge state values pushed by the conclave stream into the cached state.
 
-        state = None
-        
-        token = self.getAuthTokenFromRefreshToken()
-        
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "semantics2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-        }
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId + "/metadevices/" + child + "/state"
-        auth_data = {}
-        headers = {}
+        Pushes usually carry only the functions that changed, and may arrive
+        out of order, so a value is only replaced by one with a newer lastUpdateTime.
+        They are also kept until the next snapshot is stored, which may come
+        from a poll that was sent before the push.
+        """
+        merged = {}
+        for lis in self._knownValues(child):
+            merged[lis.key] = lis
+        pushes = self._pushes.setdefault(child, {})
+        for lis in _state_values(values):
+            old = merged.get(lis.key)
+            if old is None or (lis.lastUpdateTime or 0) >= (old.lastUpdateTime or 0):
+                merged[lis.key] = lis
+                pushes[lis.key] = lis
+        return self._storeState(child, list(merged.values()))
 
-        r = requests.get(auth_url, data=auth_data, headers=auth_header)
-        r.close()
-        for lis in r.json().get('values'):
-            for key,val in lis.items():
-                if key == 'functionClass' and val == desiredStateName and lis.get('functionInstance') == desiredFunctionInstance :
-                    state = lis.get('value')
+    def _recordWrites(self, child, values):
+        """Remember values the cloud accepted and return the device state with them applied."""
+        expires = time.monotonic() + self._read_your_writes
+        writes = self._writes.setdefault(child, {})
+        for lis in _state_values(values):
+            writes[lis.key] = (expires, lis)
+        return self._storeState(child, self._knownValues(child))
 
-        #print(desiredStateName + ": " + state)
-        return state
-        
-    def getDebugInfo(self,child):
-
-        state = None
-        
-        r = self.getMetadeviceInfo()
-        
-        _LOGGER.debug("############ Dumping all info 1 0f 2 #########")
-        _LOGGER.debug(json.dumps(r.json(), indent=4, sort_keys=True))
-        _LOGGER.debug("############ End Dump #########")
-        
-        token = self.getAuthTokenFromRefreshToken()
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId + "/metadevices/" + child + "/state"
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "semantics2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-        }
-        
-        auth_data = {}
-
-        r = requests.get(auth_url, data=auth_data, headers=auth_header)
-        r.close()
-        _LOGGER.debug("############ Dumping all info 2 0f 2 #########")
-        _LOGGER.debug(json.dumps(r.json(), indent=4, sort_keys=True))
-        _LOGGER.debug("############ End Dump #########")
-        return r.json()
-        
-    def getPowerState(self,child):
-        return self.getState(child,"power")
+    def _knownValues(self, child):
+        # The latest state values we have for a device, however old
+        if self._snapshot is not None and child in self._snapshot.states:
+            return self._snapshot.states[child].values
+        return ()
 
-    def setState(self,child,desiredStateName,state,instanceField=None):
-   
-        token = self.getAuthTokenFromRefreshToken()
-                
-        auth_data = {}
-        headers = {}
-        
-        utc_time = self.getUTCTime()
-        payload = {
-            "metadeviceId": str(child),
-            "values": [
-                {
-                    "functionClass": desiredStateName,
-                    "lastUpdateTime": utc_time,
-                    "value": state
-                }
-            ]
-        }
-        
-        if instanceField is not None:
-            payload["values"][0]["functionInstance"] = instanceField
-            _LOGGER.debug("setting state with instance: " + instanceField )
-        
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "semantics2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-            "content-type": "application/json; charset=utf-8",
-        }
+    def getDeviceState(self, child):
+        """Fetch the indexed state of one device and fold it into the snapshot."""
+        return self._storeState(child, self._getStateValues(child))
+
+    def setStates(self,child,values):
+        """Write several functions of one device in a single PUT.
+
+        values is a list of (functionClass, functionInstance, value) tuples,
+        functionInstance may be None. Returns the device's state with the
+        accepted values applied.
+        """
 
 
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId + "/metadevices/" + child + "/state"
-        r = requests.put(auth_url, json=payload, headers=auth_header)
-        r.close()
-        for lis in r.json().get('values'):
-            for key,val in lis.items():
-                if key == 'functionClass' and val == desiredStateName:
-                    state = lis.get('value')
+        payload = _state_payload(child, values, self.getUTCTime())
+        _LOGGER.debug("setting states: " + str(payload["values"]))
+
+        r = self._apiRequest('put', _state_url(self._accountId, child), json=payload, json_body=True)
+        # The response echoes the accepted values, which are newer than anything cached
+        return self._recordWrites(child, r.json().get('values') or payload["values"])
+
+    def setState(self,child,desiredStateName,state,instanceField=None):
+
+        returned = self.setStates(child, [(desiredStateName, instanceField, state)]).get(desiredStateName, instanceField)
+        if returned is not None:
+            state = returned
 
         #print(desiredStateName + ": " + state)
         return state
-        
-    def setStateInstance(self,child,desiredStateName,desiredFunctionInstance,state):
 
-        
-        token = self.getAuthTokenFromRefreshToken()
-        
-        
-        auth_data = {}
-        headers = {}
-        
-        utc_time = self.getUTCTime()
-        payload = {
-            "metadeviceId": str(child),
-            "values": [
-                {
-                    "functionClass": desiredStateName,
-                    "functionInstance": desiredFunctionInstance,
-                    "lastUpdateTime": utc_time,
-                    "value": state
-                }
-            ]
-        }
-        
-        
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "semantics2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-            "content-type": "application/json; charset=utf-8",
-        }
 
+class AsyncHubSpace(HubSpace):
+    """HubSpace client with native asyncio methods for use on the event loop.
 
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId + "/metadevices/" + child + "/state"
-        r = requests.put(auth_url, json=payload, headers=auth_header)
-        r.close()
-        
-        
-    def setPowerState(self,child,state,powerFunctionInstance=None):
-        self.setState(child,"power",state,powerFunctionInstance)
-        
-     
-    async def getConclave(self):
+    Logging in is still blocking, so construct it in an executor job or pass
+    login=False and call start_login. The blocking camelCase methods remain
+    available and share the same token.
+    """
 
-        
-        token = self.getAuthTokenFromRefreshToken()
-        
-        
-        auth_data = {}
-        headers = {}
-        
-        
+    # Seconds before a login that failed, other than by being rejected, is
+    # tried again, doubled after every failure in a row
+    _login_retry_min = 5
+    _login_retry_max = 600
+
+    def __init__(self, username, password, websession, **kwargs):
+        super().__init__(username, password, **kwargs)
+        self._websession = websession
+        self._snapshot_task = None
+        self._state_tasks = {}
+        # child -> (values, future, timer) of writes waiting for their window to end
+        self._pending_writes = {}
+        # Flushes sending their PUT, kept so they are not garbage collected
+        self._flush_tasks = set()
+        self._token_task = None
+        self._login_task = None
+        self._login_delay = self._login_retry_min
+        self._login_retry_at = 0
+
+    def start_login(self, refresh_token=None, accountId=None):
+        """Log in on an executor thread, requests made meanwhile wait for it."""
+        self._login_task = asyncio.get_running_loop().run_in_executor(None, partial(self.login, refresh_token, accountId))
+        self._login_task.add_done_callback(self._login_done)
+        return self._login_task
+
+    def _login_done(self, task):
+        if task.cancelled():
+            return
+        ex = task.exception()
+        if ex is None:
+            self._login_delay = self._login_retry_min
+        elif isinstance(ex, AuthenticationError):
+            _LOGGER.error("%s, not logging in again until Home Assistant restarts", ex)
+        else:
+            self._login_retry_at = time.monotonic() + self._login_delay
+            _LOGGER.warning("Logging in to hubspace failed, trying again in %d seconds at the earliest: %s", self._login_delay, ex)
+            self._login_delay = min(self._login_delay * 2, self._login_retry_max)
+
+    async def _logged_in(self):
+        task = self._login_task
+        if task is None:
+            return
+        if task.done() and task.exception() is not None:
+            ex = task.exception()
+            if isinstance(ex, AuthenticationError):
+                # Sending a rejected password again and again could lock the account
+                raise AuthenticationError(str(ex)) from ex
+            if time.monotonic() < self._login_retry_at:
+                raise CircuitOpenError(f"Logging in to hubspace is paused after it failed: {ex}") from ex
+            # The last attempt failed a while ago, this request tries again
+            task = self.start_login(self._refresh_token, self._accountId)
+        await asyncio.shield(task)
+        if self._login_task is task:
+            self._login_task = None
+
+    async def wait_for_login(self):
+        """Wait for the login start_login began, raising what it failed with."""
+        await self._logged_in()
+
+    async def _account_id(self):
+        await self._logged_in()
+        return self._accountId
+
+    async def _async_request(self, method, url, parse=None, **kwargs):
+        """Send a request and return its JSON, or what awaiting parse(response) returns."""
+        host = urlparse(url).hostname
+        limiter = self._limiter(host)
+        breaker = self._breaker(host)
+        endpoint = _endpoint(method, url)
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=self._connect_timeout, sock_read=self._read_timeout))
+        for attempt in range(self._throttle_retries + 1):
+            await asyncio.sleep(limiter.reserve())
+            breaker.before()
+            ok = None
+            outcome = 'error'
+            start = time.monotonic()
+            received = None
+            try:
+                async with self._websession.request(method, url, **kwargs) as r:
+                    ok = r.status < 500
+                    if r.status != 429 or attempt == self._throttle_retries:
+                        r.raise_for_status()
+                        limiter.succeeded()
+                        if parse is not None:
+                            # parse times its own reading and parsing
+                            received = time.monotonic()
+                            data = await parse(r)
+                        else:
+                            data = await r.json(content_type=None)
+                        outcome = None
+                        return data
+                    retryAfter = _retry_after(r.headers.get('Retry-After'))
+            except asyncio.TimeoutError:
+                ok = False
+                outcome = 'timeout'
+                raise
+            except aiohttp.ClientConnectionError:
+                ok = False
+                raise
+            finally:
+                breaker.record(ok)
+                # Includes reading the body, which is where a slow cloud shows
+                self.metrics.observe(endpoint, time.monotonic() - start, outcome)
+                self._phase('network', (received or time.monotonic()) - start)
+            self.metrics.count('throttled')
+            limiter.tooManyRequests(retryAfter)
+
+    async def _async_api_request(self, method, url, host="semantics2.afero.net", json_body=False, **kwargs):
+        """Send an authorized request, renewing the token and replaying once if it is rejected."""
+        token = await self.get_auth_token()
+        try:
+            return await self._async_request(method, url, headers=_api_header(token, host, json_body), **kwargs)
+        except aiohttp.ClientResponseError as ex:
+            if ex.status != 401:
+                raise
+        token = await self._renew_token(token)
+        return await self._async_request(method, url, headers=_api_header(token, host, json_body), **kwargs)
+
+    async def get_auth_token(self):
+        """Return a valid token without waiting on a refresh while the current one still works.
+
+        Close to expiry the token is refreshed in the background, and every
+        caller that needs a new token awaits the same refresh.
+        """
+        start = time.monotonic()
+        await self._logged_in()
+        token = self._cachedToken(self._token_refresh_ahead)
+        if token is None:
+            refresh = self._refresh_token_task()
+            token = self._cachedToken()
+            if token is None:
+                token = await asyncio.shield(refresh)
+        self._phase('auth', time.monotonic() - start)
+        return token
+
+    async def _renew_token(self, rejected):
+        if self._last_token != rejected:
+            return self._last_token
+        return await asyncio.shield(self._refresh_token_task())
+
+    def _refresh_token_task(self):
+        if self._token_task is None:
+            self._token_task = asyncio.ensure_future(self._fetch_token())
+            self._token_task.add_done_callback(self._token_task_done)
+        return self._token_task
+
+    def _token_task_done(self, task):
+        if self._token_task is task:
+            self._token_task = None
+        if not task.cancelled() and task.exception() is not None:
+            _LOGGER.debug("Token refresh failed: %s", task.exception())
+
+    async def _fetch_token(self):
+        now = time.time()
+        data = await self._async_request('post', TOKEN_URL, data=_refresh_data(self._refresh_token), headers=_token_header())
+        return self._storeToken(data, now)
+
+    async def iter_metadevices(self):
+        """Yield the account's Metadevices while the document is still downloading."""
+        auth_url = API_URL + "/accounts/" + await self._account_id() + "/metadevices?expansions=state"
+        queue = asyncio.Queue()
+
+        async def parse(r):
+            parser = MetadeviceParser()
+            mark = time.monotonic()
+            async for chunk in r.content.iter_chunked(METADEVICE_CHUNK):
+                received = time.monotonic()
+                self._phase('network', received - mark)
+                for lis in parser.feed(chunk):
+                    queue.put_nowait(lis)
+                mark = time.monotonic()
+                self._phase('parse', mark - received)
+            for lis in parser.close():
+                queue.put_nowait(lis)
+            self._phase('parse', time.monotonic() - mark)
+
+        # The request runs as its own task so throttling, retries and the token replay still apply
+        task = asyncio.ensure_future(self._async_api_request('get', auth_url, parse=parse))
+        task.add_done_callback(lambda task: queue.put_nowait(None))
+        try:
+            while True:
+                lis = await queue.get()
+                if lis is None:
+                    break
+                yield lis
+            await task
+        finally:
+            task.cancel()
+
+    async def _fetch_registry(self):
+        return self._storeSnapshot([lis async for lis in self.iter_metadevices()])
+
+    async def get_registry(self):
+        """Fetch the metadevices and return their device registry.
+
+        Concurrent callers share one in-flight fetch.
+        """
+        if self._snapshot_task is None or self._snapshot_task.done():
+            self._snapshot_task = asyncio.ensure_future(self._fetch_registry())
+        # Shield the shared fetch so one cancelled caller does not cancel it for the others
+        return await asyncio.shield(self._snapshot_task)
+
+    async def refresh_registry(self, deadline=None):
+        """Fetch a new snapshot, e.g. once per poll of the whole account.
+
+        With a deadline in seconds the fetch is abandoned, not just no longer
+        waited for, once it runs out. The old snapshot stays in place until
+        then, so commands and pushes keep landing in it and the new one is
+        diffed against it.
+        """
+        try:
+            return await asyncio.wait_for(self.get_registry(), deadline)
+        except asyncio.TimeoutError:
+            if self._snapshot_task is not None:
+                self._snapshot_task.cancel()
+            raise
+
+    async def get_state_values(self, child):
+        data = await self._async_api_request('get', _state_url(await self._account_id(), child))
+        return data.get('values')
+
+    async def _fetch_device_state(self, child):
+        return self._storeState(child, await self.get_state_values(child))
+
+    async def get_device_state(self, child):
+        """Fetch the indexed state of one device, callers share a fetch that is in flight."""
+        task = self._state_tasks.get(child)
+        if task is None or task.done():
+            task = self._state_tasks[child] = asyncio.ensure_future(self._fetch_device_state(child))
+        return await asyncio.shield(task)
+
+    async def get_state(self, child, functionClass, functionInstance=None):
+        state = await self.get_device_state(child)
+        return state.get(functionClass, functionInstance)
+
+    async def set_states(self, child, values):
+        """Write several (functionClass, functionInstance, value) tuples in a single PUT.
+
+        Returns the device's state with the accepted values applied.
+        """
+        payload = _state_payload(child, values, self.getUTCTime())
+        data = await self._async_api_request('put', _state_url(await self._account_id(), child), json=payload, json_body=True)
+        return self._recordWrites(child, data.get('values') or payload["values"])
+
+    async def queue_states(self, child, values):
+        """Queue writes for one device and wait for the PUT that carries them.
+
+        The first queued write starts the write window, everything queued for
+        the device until it ends goes out in one PUT with only the latest value
+        per function. A dragged slider therefore costs at most one request per
+        window no matter how many values it produces.
+        """
+        pending = self._pending_writes.get(child)
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            pending = self._pending_writes[child] = ([], loop.create_future(), loop.call_later(self._write_window, self._start_flush, child))
+        pending[0].extend(values)
+        return await asyncio.shield(pending[1])
+
+    def _start_flush(self, child):
+        task = asyncio.ensure_future(self._flush_writes(child))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush_writes(self, child):
+        values, future, timer = self._pending_writes.pop(child)
+        try:
+            state = await self.set_states(child, values)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            # Raised in every caller that queued a value
+            future.set_exception(ex)
+        else:
+            future.set_result(state)
+
+    async def cancel_writes(self):
+        """Drop queued writes and stop those being sent, e.g. when Home Assistant stops.
+
+        Callers waiting for them get a CancelledError instead of waiting forever.
+        """
+        pending, self._pending_writes = self._pending_writes, {}
+        for values, future, timer in pending.values():
+            timer.cancel()
+            future.cancel()
+        tasks = list(self._flush_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def set_state(self, child, functionClass, value, functionInstance=None):
+        returned = (await self.set_states(child, [(functionClass, functionInstance, value)])).get(functionClass, functionInstance)
+        return value if returned is None else returned
+
+    async def get_conclave(self):
         payload = {
             "softHub": 'false',
             "user": 'true'
         }
-        
-        auth_header = {
-            "user-agent": "Dart/2.15 (dart:io)",
-            "host": "api2.afero.net",
-            "accept-encoding": "gzip",
-            "authorization": "Bearer " + token,
-            "content-type": "application/json; charset=utf-8",
-        }
-
-
-        auth_url = "https://api2.afero.net/v1/accounts/" + self._accountId    + "/conclaveAccess"
-        r = requests.post(auth_url, json=payload, headers=auth_header)
-        r.close()
-        #print(json.dumps(r.json(), indent=4, sort_keys=True))
-        host = r.json().get('conclave').get('host')
-        port = r.json().get('conclave').get('port')
-        token = r.json().get('tokens')[0].get('token')
-        expiresTimestamp = r.json().get('tokens')[0].get('expiresTimestamp')
-        
-    def setRGB(self,child,r,g,b):
-        # assume r,g,b 0-255
-        state = {'color-rgb': { 'r': r, 'b': b, 'g': g}}
-        self.setState(child,'color-rgb',state)
-        self.setState(child,'color-mode','color')
-        
-    def getRGB(self,child):
-        state = self.getState(child,'color-rgb')
-        r = int(state.get('color-rgb').get('r'))
-        g = int(state.get('color-rgb').get('g'))
-        b = int(state.get('color-rgb').get('b'))
-        return (r,g,b)
+        auth_url = API_URL + "/accounts/" + await self._account_id() + "/conclaveAccess"
+        return _conclave(await self._async_api_request('post', auth_url, json=payload, host="api2.afero.net", json_body=True))
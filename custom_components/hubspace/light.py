@@ -3,31 +3,24 @@ from __future__ import annotations
 
 import logging
 
-from .hubspace import HubSpace
-from .const import DOMAIN
-import voluptuous as vol
+from .hubspace import rgb_values
+from .capabilities import light_capabilities
+from .client import async_setup_hubspace_platform
+from .coordinator import HubspaceEntity
 
 # Import the device class from the component that you want to support
-from homeassistant.helpers import config_validation as cv, entity_platform, service
-from homeassistant.components.light import (ATTR_BRIGHTNESS, ATTR_RGB_COLOR, ATTR_WHITE, ATTR_COLOR_TEMP, PLATFORM_SCHEMA, ColorMode, COLOR_MODES_COLOR, LightEntity)
-from homeassistant.const import CONF_PASSWORD, CONF_USERNAME
-from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.components.light import (ATTR_BRIGHTNESS, ATTR_RGB_COLOR, ATTR_WHITE, ATTR_COLOR_TEMP, PLATFORM_SCHEMA, ColorMode, LightEntity)
+from homeassistant.const import Platform
+from homeassistant.core import HomeAssistant
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from datetime import timedelta
 
-# Import exceptions from the requests module
-import requests.exceptions
-
 SCAN_INTERVAL = timedelta(seconds=60)
 BASE_INTERVAL = timedelta(seconds=60)
 
 _LOGGER = logging.getLogger(__name__)
 
-CONF_FRIENDLYNAMES: Final = "friendlynames"
-CONF_ROOMNAMES: Final = "roomnames"
-CONF_DEBUG: Final = "debug"
-
     
 def _brightness_to_hass(value):
         if value is None:
@@ -45,262 +38,49 @@ def _convert_color_temp(value):
             value = 1
         return 1000000 // int(value)
 
-def _add_entity(entities, hs, model, deviceClass, friendlyName, debug):
-
-        if model == 'HPKA315CWB' or model == 'HPPA52CWBA023':
-            _LOGGER.debug("Creating Outlets" )
-            entities.append(HubspaceOutlet(hs, friendlyName,"1",debug))
-            entities.append(HubspaceOutlet(hs, friendlyName,"2",debug))
-        elif model == 'LTS-4G-W':
-            _LOGGER.debug("Creating Outlets" )
-            entities.append(HubspaceOutlet(hs, friendlyName,"1",debug))
-            entities.append(HubspaceOutlet(hs, friendlyName,"2",debug))
-            entities.append(HubspaceOutlet(hs, friendlyName,"3",debug))
-            entities.append(HubspaceOutlet(hs, friendlyName,"4",debug))
-        elif model == 'HB-200-1215WIFIB':
-            _LOGGER.debug("Creating Transformers" )
-            entities.append(HubspaceTransformer(hs, friendlyName,"1",debug))
-            entities.append(HubspaceTransformer(hs, friendlyName,"2",debug))
-            entities.append(HubspaceTransformer(hs, friendlyName,"3",debug))
-        elif model == '52133, 37833':
-            _LOGGER.debug("Creating Light" )
-            entities.append(HubspaceLight(hs, friendlyName,debug))
-        elif model == '76278, 37278':
-            _LOGGER.debug("Creating Light" )
-            entities.append(HubspaceLight(hs, friendlyName,debug))
-        elif deviceClass == 'door-lock' and model == 'TBD':
-            _LOGGER.debug("Creating Lock" )
-            entities.append(HubspaceLock(hs, friendlyName,debug))
-        else:
-            _LOGGER.debug("creating lights" )
-            entities.append(HubspaceLight(hs, friendlyName,debug))
-
-        return entities
-
-
-
-def setup_platform(
+async def async_setup_platform(
     hass: HomeAssistant,
     config: ConfigType,
-    add_entities: AddEntitiesCallback,
+    async_add_entities: AddEntitiesCallback,
     discovery_info: DiscoveryInfoType | None = None
 ) -> None:
     """Set up the Awesome Light platform."""
+    # The client, first poll and discovery are shared with the other platforms
+    await async_setup_hubspace_platform(hass, Platform.LIGHT, _ENTITY_TYPES, async_add_entities)
     
-    # Assign configuration variables.
-    # The configuration check takes care they are present.
         
-    username = hass.data[DOMAIN][CONF_USERNAME]
-    password = hass.data[DOMAIN][CONF_PASSWORD]
-    debug = hass.data[DOMAIN][CONF_DEBUG]
-    try:
-        hs = HubSpace(username,password)
-    except requests.exceptions.ReadTimeout as ex:
-        raise PlatformNotReady(f"Connection error while connecting to hubspace: {ex}") from ex
-    
-    entities = []
-    for friendlyName in hass.data[DOMAIN][CONF_FRIENDLYNAMES]:
-
-        _LOGGER.debug("friendlyName " + friendlyName )
-        [childId, model, deviceId, deviceClass] = hs.getChildId(friendlyName)
-
-        _LOGGER.debug("Switch on Model " + model )
-        _LOGGER.debug("childId: " + childId )
-        _LOGGER.debug("deviceId: " + deviceId )
-        _LOGGER.debug("deviceClass: " + deviceClass )
-        
-        entities = _add_entity(entities, hs, model, deviceClass, friendlyName, debug)
-
-    for roomName in hass.data[DOMAIN][CONF_ROOMNAMES]:
-
-        _LOGGER.debug("roomName " + roomName )
-        children = hs.getChildrenFromRoom(roomName)
-
-        for childId in children:
-
-            _LOGGER.debug("childId " + childId )
-            [childId, model, deviceId, deviceClass, friendlyName] = hs.getChildInfoById(childId)
-
-            _LOGGER.debug("Switch on Model " + model )
-            _LOGGER.debug("deviceId: " + deviceId )
-            _LOGGER.debug("deviceClass: " + deviceClass )
-            _LOGGER.debug("friendlyName: " + friendlyName )
-
-            entities = _add_entity(entities, hs, model, deviceClass, friendlyName, debug)
-    
-    if hass.data[DOMAIN][CONF_FRIENDLYNAMES] == [] and hass.data[DOMAIN][CONF_ROOMNAMES] == []:
-        _LOGGER.debug('Attempting automatic discovery')
-        for [childId, model, deviceId, deviceClass, friendlyName, functions] in hs.discoverDeviceIds():
-            _LOGGER.debug("childId " + childId )
-            _LOGGER.debug("Switch on Model " + model )
-            _LOGGER.debug("deviceId: " + deviceId )
-            _LOGGER.debug("deviceClass: " + deviceClass )
-            _LOGGER.debug("friendlyName: " + friendlyName )
-            _LOGGER.debug("functions: " + str(functions))
-            
-            if deviceClass == 'light' or deviceClass == 'switch':
-                entities.append(HubspaceLight(hs, friendlyName, debug, childId, model, deviceId, deviceClass, functions))
-            elif deviceClass == 'power-outlet':
-                for function in functions:
-                    if function.get('functionClass') == 'toggle':
-                        try:
-                            _LOGGER.debug(f"Found toggle with id {function.get('id')} and instance {function.get('functionInstance')}")
-                            outletIndex = function.get('functionInstance').split('-')[1]
-                            entities.append(HubspaceOutlet(hs, friendlyName, outletIndex, debug, childId, model, deviceId, deviceClass))
-                        except IndexError:
-                            _LOGGER.debug('Error extracting outlet index')
-            elif deviceClass == 'landscape-transformer':
-                for function in functions:
-                    if function.get('functionClass') == 'toggle':
-                        try:
-                            _LOGGER.debug(f"Found toggle with id {function.get('id')} and instance {function.get('functionInstance')}")
-                            outletIndex = function.get('functionInstance').split('-')[1]
-                            entities.append(HubspaceTransformer(hs, friendlyName, outletIndex, debug, childId, model, deviceId, deviceClass))
-                        except IndexError:
-                            _LOGGER.debug('Error extracting outlet index')
-    
-    if not entities:
-        return
-    add_entities(entities, True)
-    
-    
-    def my_service(call: ServiceCall) -> None:
-        """My first service."""
-        _LOGGER.info("Received data" +  str(call.data))
-        
-        entity_ids = call.data['entity_id']       
-        functionClass = call.data['functionClass']
-        value = call.data['value']
-        
-        if 'functionInstance' in call.data:
-            functionInstance = call.data['functionInstance']
-        else:
-            functionInstance = None
-        
-        for entity_id in entity_ids:
-            _LOGGER.info("entity_id: " + str(entity_id))
-            for i in entities:
-                if i.entity_id == entity_id:
-                    _LOGGER.info("Found Entity")
-                    i.send_command(functionClass,value,functionInstance)
-            
-
-    # Register our service with Home Assistant.
-    hass.services.register("hubspace", 'send_command', my_service)
-    
-        
-class HubspaceLight(LightEntity):
+class HubspaceLight(HubspaceEntity, LightEntity):
     """Representation of an Awesome Light."""
+
+    _state_keys = frozenset({('power', None), ('brightness', None), ('color-rgb', None), ('color-mode', None), ('color-temperature', None)})
     
-    def __init__(self, hs, friendlyname, debug, childId = None, model = None, deviceId = None, deviceClass = None, functions = None) -> None:
+    def __init__(self, coordinator, friendlyname, childId = None, model = None, deviceId = None, deviceClass = None, functions = None) -> None:
         """Initialize an AwesomeLight."""
+        super().__init__(coordinator)
         
         _LOGGER.debug("Light Name: " )
         _LOGGER.debug(friendlyname)
         self._name = friendlyname
 
         
-        self._debug = debug
         self._state = 'off'
         self._childId = childId
         self._model = model
         self._brightness = None
-        self._usePowerFunctionInstance = None
-        self._hs = hs
+        self._hs = coordinator.hs
         self._deviceId = deviceId
-        self._debugInfo = None
 
         # colorMode == 'color' || 'white' 
         self._colorMode = None
-        self._colorTemp = None
-        self._min_mireds = None
-        self._max_mireds = None
+        self._color_temp = None
         self._rgbColor = None
-        self._temperature_choices = None
-        self._temperature_suffix = None
         if None in (childId, model, deviceId, deviceClass):
-            [self._childId, self._model, self._deviceId, deviceClass] = self._hs.getChildId(self._name)
+            [self._childId, self._model, self._deviceId, deviceClass] = coordinator.data.childInfoByName(self._name)[:4]
         if functions is None:
-            functions = self._hs.getFunctions(self._childId)
-
-        self._supported_color_modes = []
-
-        # https://www.homedepot.com/p/Commercial-Electric-500-Watt-Single-Pole-Smart-Hubspace-Dimmer-with-Motion-Sensor-White-HPDA311CWB/317249353
-        if self._model == 'HPDA311CWB':
-            self._supported_color_modes.extend([ColorMode.BRIGHTNESS])
-
-        # https://www.homedepot.com/p/Defiant-15-Amp-120-Volt-Smart-Hubspace-Outdoor-Single-Outlet-Wi-Fi-Bluetooth-Plug-HPPA51CWB/316341409
-        # https://www.homedepot.com/p/Defiant-15-Amp-120-Volt-Smart-Hubspace-Wi-Fi-Bluetooth-Plug-with-1-Outlet-HPPA11AWB/315636834
-        if self._model == 'HPPA51CWB' or self._model == 'HPPA11AWBA023' or self._model == 'HPSA11CWB' or self._model == 'HPPA11CWB':
-            self._supported_color_modes.extend([ColorMode.ONOFF])
-        #https://www.homedepot.com/p/EcoSmart-16-ft-Smart-Hubspace-RGB-and-Tunable-White-Tape-Light-Works-with-Amazon-Alexa-and-Google-Assistant-AL-TP-RGBCW-60/314680856
-        if self._model == 'AL-TP-RGBCW-60-2116, AL-TP-RGBCW-60-2232' or self._model == 'HPKA315CWB' or self._model =='HPPA52CWBA023':
-            self._usePowerFunctionInstance = 'primary'
-            self._supported_color_modes.extend([ColorMode.RGB, ColorMode.WHITE])
-        
-        # https://www.homedepot.com/p/Commercial-Electric-4-in-Smart-Hubspace-Color-Selectable-CCT-Integrated-LED-Recessed-Light-Trim-Works-with-Amazon-Alexa-and-Google-538551010/314199717
-        # https://www.homedepot.com/p/Commercial-Electric-6-in-Smart-Hubspace-Ultra-Slim-New-Construction-and-Remodel-RGB-W-LED-Recessed-Kit-Works-with-Amazon-Alexa-and-Google-50292/313556988
-        #  https://www.homedepot.com/p/EcoSmart-120-Watt-Equivalent-Smart-Hubspace-PAR38-Color-Changing-CEC-LED-Light-Bulb-with-Voice-Control-1-Bulb-11PR38120RGBWH1/318411934
-        # https://www.homedepot.com/p/EcoSmart-60-Watt-Equivalent-Smart-Hubspace-A19-Color-Changing-CEC-LED-Light-Bulb-with-Voice-Control-1-Bulb-11A19060WRGBWH1/318411935
-        if self._model == '50291, 50292' or self._model == '11PR38120RGBWH1' or self._model == '11A21100WRGBWH1' or self._model == '11A19060WRGBWH1':
-            self._supported_color_modes.extend([ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE])
-            self._max_mireds = 454
-            self._min_mireds = 154
-            
-        #fan
-        if self._model == '52133, 37833' or self._model == '76278, 37278':
-            self._usePowerFunctionInstance = 'light-power'
-            self._supported_color_modes.extend([ColorMode.BRIGHTNESS])
-            self._temperature_suffix = 'K'
-            self._temperature_choices = []
-            for function in functions:
-                if function.get('functionClass') == 'color-temperature':
-                    for value in function.get('values'):
-                        temperatureName = value.get('name')
-                        if isinstance(temperatureName, str) and temperatureName.endswith(self._temperature_suffix):
-                            try:
-                                temperatureValue = int(temperatureName[:-len(self._temperature_suffix)])
-                            except ValueError:
-                                _LOGGER.debug(f"Can't convert temperatureName {temperatureName} to int")
-                                temperatureValue = None
-                            if temperatureValue is not None and temperatureValue not in self._temperature_choices:
-                                self._temperature_choices.append(temperatureValue)
-            if len(self._temperature_choices):
-                self._supported_color_modes.extend([ColorMode.COLOR_TEMP, ColorMode.WHITE])
-                self._max_mireds = 1000000//min(self._temperature_choices) + 1
-                self._min_mireds = 1000000//max(self._temperature_choices)
-            else:
-                self._temperature_choices = None
-
-        # https://www.homedepot.com/p/Commercial-Electric-5-in-6-in-Smart-Hubspace-Color-Selectable-CCT-Integrated-LED-Recessed-Light-Trim-Works-with-Amazon-Alexa-and-Google-538561010/314254248
-        if self._model == '538551010, 538561010, 538552010, 538562010':
-            self._supported_color_modes.extend([ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE])
-            self._max_mireds = 370
-            self._min_mireds = 154
-        # https://www.homedepot.com/p/Hampton-Bay-Lakeshore-13-in-Matte-Black-Smart-Hubspace-CCT-and-RGB-Selectable-LED-Flush-Mount-SMACADER-MAGB01/317216753
-        if self._model == 'SMACADER-MAGD01, SMACADER-MAGB01, SMACADER-MAGW01, CAD1aERMAGW26, CAD1aERMAGP26, CAD1aERMAGA26':
-            self._supported_color_modes.extend([ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE])
-            self._max_mireds = 370
-            self._min_mireds = 154
-        
-        # If model not found, use On/Off Only as a failsafe
-        if not self._supported_color_modes:
-            self._supported_color_modes.extend([ColorMode.ONOFF])
-    
-    async def async_setup_entry(hass, entry):
-        """Set up the media player platform for Sonos."""
-
-        platform = entity_platform.async_get_current_platform()
-
-        platform.async_register_entity_service(
-            "send_command",
-            {
-                vol.Required('functionClass'): cv.string,
-                vol.Required('value'): cv.string,
-                vol.Optional('functionInstance'): cv.string,
-            },
-            "send_command",
-        )
+            functions = coordinator.data.functions(self._childId)
+
+        # Color modes, mired range and power instance come from the device's functions
+        self._capabilities = light_capabilities(self._model, functions)
     
     @property
     def name(self) -> str:
@@ -321,7 +101,7 @@ class HubspaceLight(LightEntity):
     @property
     def supported_color_modes(self) -> set[ColorMode]:
         """Flag supported color modes."""
-        return {*self._supported_color_modes}
+        return set(self._capabilities.modes)
 
     @property
     def brightness(self) -> int or None:
@@ -336,50 +116,44 @@ class HubspaceLight(LightEntity):
     @property
     def min_mireds(self) -> int or None:
         """Return the coldest color_temp that this light supports."""
-        return self._min_mireds
+        return self._capabilities.min_mireds
         
     @property
     def max_mireds(self) -> int or None:
         """Return the warmest color_temp that this light supports."""
-        return self._max_mireds
+        return self._capabilities.max_mireds
     
     @property
     def is_on(self) -> bool | None:
         """Return true if light is on."""
         return self._state == 'on'
 
-    def send_command(self, field_name,field_state,functionInstance=None) -> None:
-        self._hs.setState(self._childId,field_name,field_state,functionInstance)
-        
-    def set_send_state(self, field_name,field_state) -> None:
-        self._hs.setState(self._childId,field_name,field_state)
+    async def async_set_send_state(self, field_name,field_state) -> None:
+        await self._async_write_states([(field_name, None, field_state)])
         
-    def turn_on(self, **kwargs: Any) -> None:
-        state = self._hs.setPowerState(self._childId,"on",self._usePowerFunctionInstance)
+    async def async_turn_on(self, **kwargs: Any) -> None:
+        # Everything is sent to the device in one PUT
+        capabilities = self._capabilities
+        values = [("power", capabilities.power, "on")]
 
-        if ATTR_BRIGHTNESS in kwargs and (ColorMode.ONOFF not in self._supported_color_modes):
+        if ATTR_BRIGHTNESS in kwargs and capabilities.brightness:
             brightness = kwargs.get(ATTR_BRIGHTNESS, self._brightness)
-            self._hs.setState(self._childId,"brightness",_brightness_to_hubspace(brightness))
+            values.append(("brightness", None, _brightness_to_hubspace(brightness)))
 
-        if ATTR_RGB_COLOR in kwargs and any(mode in COLOR_MODES_COLOR for mode in self._supported_color_modes):
-            self._hs.setRGB(self._childId,*kwargs[ATTR_RGB_COLOR])
+        if ATTR_RGB_COLOR in kwargs and capabilities.color:
+            values.extend(rgb_values(*kwargs[ATTR_RGB_COLOR]))
 
-        if ATTR_WHITE in kwargs and (any(mode in COLOR_MODES_COLOR for mode in self._supported_color_modes) or ColorMode.COLOR_TEMP in self._supported_color_modes):
+        if ATTR_WHITE in kwargs and capabilities.temperature:
             self._colorMode = ATTR_WHITE
-            self._hs.setState(self._childId,"color-mode",self._colorMode)
+            values.append(("color-mode", None, self._colorMode))
             brightness = kwargs.get(ATTR_WHITE, self._brightness)
-            self._hs.setState(self._childId,"brightness",_brightness_to_hubspace(brightness))
-
-        if ATTR_COLOR_TEMP in kwargs and (any(mode in COLOR_MODES_COLOR for mode in self._supported_color_modes) or ColorMode.COLOR_TEMP in self._supported_color_modes):
-            self._color_temp = _convert_color_temp(kwargs[ATTR_COLOR_TEMP])
-            if self._temperature_choices is not None:
-                self._color_temp = self._temperature_choices[min(range(len(self._temperature_choices)), key = lambda i: abs(self._temperature_choices[i]-self._color_temp))]
-            if self._temperature_suffix is not None:
-                self._hs.setState(self._childId, "color-temperature", str(self._color_temp) + self._temperature_suffix)
-            else:
-                self._hs.setState(self._childId,"color-temperature",self._color_temp)
-
-        self.update()
+            values.append(("brightness", None, _brightness_to_hubspace(brightness)))
+
+        if ATTR_COLOR_TEMP in kwargs and capabilities.temperature:
+            self._color_temp = capabilities.nearest_temperature(_convert_color_temp(kwargs[ATTR_COLOR_TEMP]))
+            values.append(("color-temperature", None, capabilities.temperature_value(self._color_temp)))
+
+        await self._async_write_states(values)
         
     @property
     def rgb_color(self):
@@ -394,67 +168,51 @@ class HubspaceLight(LightEntity):
         attr["deviceId"] = self._deviceId
         attr["devbranch"] = False
         
-        attr["debugInfo"] = self._debugInfo
-        
         return attr
         
-    def turn_off(self, **kwargs: Any) -> None:
+    async def async_turn_off(self, **kwargs: Any) -> None:
         """Instruct the light to turn off."""
-        state = self._hs.setPowerState(self._childId,"off",self._usePowerFunctionInstance)
-        self.update()
-        
-    @property
-    def should_poll(self):
-        """Turn on polling """
-        return True
+        await self._async_write_states([("power", self._capabilities.power, "off")])
     
         
-    def update(self) -> None:
-        """Fetch new state data for this light.
-
-        This is the only method that should fetch new data for Home Assistant.
-        """
-        self._state = self._hs.getPowerState(self._childId)
-        
-        if self._debug:
-            self._debugInfo = self._hs.getDebugInfo(self._childId)
+    def _update_from_registry(self, registry) -> None:
+        """Read this light's state from the coordinator's snapshot."""
+        self._state = registry.getPowerState(self._childId)
 
-        # ColorMode.ONOFF is the only color mode that doesn't support brightness
-        if ColorMode.ONOFF not in self._supported_color_modes:
-            self._brightness = _brightness_to_hass(self._hs.getState(self._childId,"brightness"))
+        capabilities = self._capabilities
+        if capabilities.brightness:
+            self._brightness = _brightness_to_hass(registry.getState(self._childId,"brightness"))
 
-        if any(mode in COLOR_MODES_COLOR for mode in self._supported_color_modes):
-            self._rgbColor = self._hs.getRGB(self._childId)
+        if capabilities.color:
+            self._rgbColor = registry.getRGB(self._childId)
 
-        if any(mode in COLOR_MODES_COLOR for mode in self._supported_color_modes) or ColorMode.COLOR_TEMP in self._supported_color_modes:
-            self._colorMode = self._hs.getState(self._childId,'color-mode')
-            self._color_temp = self._hs.getState(self._childId,'color-temperature')
-            if self._temperature_suffix is not None and isinstance(self._color_temp, str) and self._color_temp.endswith(self._temperature_suffix):
-                self._color_temp = self._color_temp[:-len(self._temperature_suffix)]
+        if capabilities.temperature:
+            self._colorMode = registry.getState(self._childId,'color-mode')
+            self._color_temp = capabilities.kelvin(registry.getState(self._childId,'color-temperature'))
 
-class HubspaceOutlet(LightEntity):
+class HubspaceOutlet(HubspaceEntity, LightEntity):
     """Representation of an Awesome Light."""
     
     
     
-    def __init__(self, hs, friendlyname, outletIndex, debug, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
+    def __init__(self, coordinator, friendlyname, outletIndex, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
         """Initialize an AwesomeLight."""
+        super().__init__(coordinator)
         
         self._name = friendlyname + "_outlet_" + outletIndex 
         
-        self._debug = debug
         self._state = 'off'
         self._childId = childId
         self._model = model
         self._brightness = None
         self._usePrimaryFunctionInstance = False
-        self._hs = hs
+        self._hs = coordinator.hs
         self._deviceId = deviceId
-        self._debugInfo = None
         self._outletIndex = outletIndex
+        self._state_keys = frozenset({('toggle', "outlet-" + outletIndex)})
 
         if None in (childId, model, deviceId, deviceClass):
-            [self._childId, self._model, self._deviceId, deviceClass] = self._hs.getChildId(friendlyname)
+            [self._childId, self._model, self._deviceId, deviceClass] = coordinator.data.childInfoByName(friendlyname)[:4]
     
     @property
     def name(self) -> str:
@@ -481,9 +239,8 @@ class HubspaceOutlet(LightEntity):
         """Return true if light is on."""
         return self._state == 'on'
 
-    def turn_on(self, **kwargs: Any) -> None:
-        self._hs.setStateInstance(self._childId,'toggle',"outlet-" + self._outletIndex ,'on')
-        self.update()
+    async def async_turn_on(self, **kwargs: Any) -> None:
+        await self._async_write_states([('toggle', "outlet-" + self._outletIndex, 'on')])
     
     @property
     def extra_state_attributes(self):
@@ -493,54 +250,43 @@ class HubspaceOutlet(LightEntity):
         attr["deviceId"] = self._deviceId + "_" + self._outletIndex
         attr["devbranch"] = False
         
-        attr["debugInfo"] = self._debugInfo
-        
         return attr
         
-    def turn_off(self, **kwargs: Any) -> None:
+    async def async_turn_off(self, **kwargs: Any) -> None:
         """Instruct the light to turn off."""
-        self._hs.setStateInstance(self._childId,'toggle',"outlet-" + self._outletIndex ,'off')
-        self.update()
-        
-    @property
-    def should_poll(self):
-        """Turn on polling """
-        return True
+        await self._async_write_states([('toggle', "outlet-" + self._outletIndex, 'off')])
         
-    def update(self) -> None:
-        """Fetch new state data for this light.
-
-        This is the only method that should fetch new data for Home Assistant.
-        """
-        self._state = self._hs.getStateInstance(self._childId,'toggle',"outlet-" + self._outletIndex)
-        if self._debug:
-            self._debugInfo = self._hs.getDebugInfo(self._childId)
+    def _update_from_registry(self, registry) -> None:
+        """Read this light's state from the coordinator's snapshot."""
+        self._state = registry.getState(self._childId,'toggle',"outlet-" + self._outletIndex)
 
-class HubspaceTransformer(LightEntity):
+class HubspaceTransformer(HubspaceEntity, LightEntity):
     """Representation of an Awesome Light."""
     
     
     
-    def __init__(self, hs, friendlyname, outletIndex, debug, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
+    def __init__(self, coordinator, friendlyname, outletIndex, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
         """Initialize an AwesomeLight."""
+        super().__init__(coordinator)
         
         self._name = friendlyname + "_transformer_" + outletIndex 
         
-        self._debug = debug
         self._state = 'off'
         self._childId = childId
         self._model = model
         self._brightness = None
         self._usePrimaryFunctionInstance = False
-        self._hs = hs
+        self._hs = coordinator.hs
         self._deviceId = deviceId
-        self._debugInfo = None
         self._watts = None
         self._volts = None
         
         self._outletIndex = outletIndex
+        self._state_keys = frozenset({('toggle', "zone-" + outletIndex)})
+        if outletIndex == '1':
+            self._state_keys |= {('watts', None), ('output-voltage-switch', None)}
         if None in (childId, model, deviceId, deviceClass):
-            [self._childId, self._model, self._deviceId, deviceClass] = self._hs.getChildId(friendlyname)
+            [self._childId, self._model, self._deviceId, deviceClass] = coordinator.data.childInfoByName(friendlyname)[:4]
     
     @property
     def name(self) -> str:
@@ -567,9 +313,8 @@ class HubspaceTransformer(LightEntity):
         """Return true if light is on."""
         return self._state == 'on'
 
-    def turn_on(self, **kwargs: Any) -> None:
-        self._hs.setStateInstance(self._childId,'toggle',"zone-" + self._outletIndex ,'on')
-        self.update()
+    async def async_turn_on(self, **kwargs: Any) -> None:
+        await self._async_write_states([('toggle', "zone-" + self._outletIndex, 'on')])
         
     @property
     def extra_state_attributes(self):
@@ -581,56 +326,44 @@ class HubspaceTransformer(LightEntity):
         attr["watts"] = self._watts
         attr["volts"] = self._volts
         
-        attr["debugInfo"] = self._debugInfo
-        
         return attr
         
-    def turn_off(self, **kwargs: Any) -> None:
+    async def async_turn_off(self, **kwargs: Any) -> None:
         """Instruct the light to turn off."""
-        self._hs.setStateInstance(self._childId,'toggle',"zone-" + self._outletIndex ,'off')
-        self.update()
+        await self._async_write_states([('toggle', "zone-" + self._outletIndex, 'off')])
         
-    @property
-    def should_poll(self):
-        """Turn on polling """
-        return True
-        
-    def update(self) -> None:
-        """Fetch new state data for this light.
-
-        This is the only method that should fetch new data for Home Assistant.
-        """
-        self._state = self._hs.getStateInstance(self._childId,'toggle',"zone-" + self._outletIndex)
+    def _update_from_registry(self, registry) -> None:
+        """Read this light's state from the coordinator's snapshot."""
+        self._state = registry.getState(self._childId,'toggle',"zone-" + self._outletIndex)
         
         if self._outletIndex == '1':
-            self._watts = self._hs.getState(self._childId,'watts')
-            self._volts = self._hs.getState(self._childId,'output-voltage-switch')
+            self._watts = registry.getState(self._childId,'watts')
+            self._volts = registry.getState(self._childId,'output-voltage-switch')
             
-        if self._debug:
-            self._debugInfo = self._hs.getDebugInfo(self._childId)
 
-class HubspaceLock(LightEntity):
+class HubspaceLock(HubspaceEntity, LightEntity):
     """Representation of an Awesome Light."""
+
+    _state_keys = frozenset({('lock-control', None), ('battery-level', None), ('last-event', None)})
     
-    def __init__(self, hs, friendlyname, debug, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
+    def __init__(self, coordinator, friendlyname, childId = None, model = None, deviceId = None, deviceClass = None) -> None:
         """Initialize an AwesomeLight."""
+        super().__init__(coordinator)
         
         self._name = friendlyname
         
-        self._debug = debug
         self._state = 'unlocked'
         self._childId = childId
         self._model = model
         self._brightness = None
         self._usePrimaryFunctionInstance = False
-        self._hs = hs
+        self._hs = coordinator.hs
         self._deviceId = deviceId
-        self._debugInfo = None
         self._batterylevel = None
         self._lastevent = None
          
         if None in (childId, model, deviceId, deviceClass):
-            [self._childId, self._model, self._deviceId, deviceClass] = self._hs.getChildId(friendlyname)
+            [self._childId, self._model, self._deviceId, deviceClass] = coordinator.data.childInfoByName(friendlyname)[:4]
     
     @property
     def name(self) -> str:
@@ -657,9 +390,8 @@ class HubspaceLock(LightEntity):
         """Return true if light is on."""
         return self._state == 'locked'
 
-    def turn_on(self, **kwargs: Any) -> None:
-        self._hs.setState(self._childId,'lock-control','locking')
-        self.update()
+    async def async_turn_on(self, **kwargs: Any) -> None:
+        await self._async_write_states([('lock-control', None, 'locking')])
         
     @property
     def extra_state_attributes(self):
@@ -671,31 +403,21 @@ class HubspaceLock(LightEntity):
         attr["battery-level"] = self._batterylevel 
         attr["last-event"] = self._lastevent
         
-        attr["debugInfo"] = self._debugInfo
-        
         return attr
         
-    def turn_off(self, **kwargs: Any) -> None:
+    async def async_turn_off(self, **kwargs: Any) -> None:
         """Instruct the light to turn off."""
-        self._hs.setState(self._childId,'lock-control','unlocking')
-        self.update()
-        
-    @property
-    def should_poll(self):
-        """Turn on polling """
-        return True
+        await self._async_write_states([('lock-control', None, 'unlocking')])
         
-    def update(self) -> None:
-        """Fetch new state data for this light.
-
-        This is the only method that should fetch new data for Home Assistant.
-        """
-        self._state = self._hs.getState(self._childId,'lock-control')
+    def _update_from_registry(self, registry) -> None:
+        """Read this light's state from the coordinator's snapshot."""
+        self._state = registry.getState(self._childId,'lock-control')
         
         
-        self._batterylevel = self._hs.getState(self._childId,'battery-level')
-        self._lastevent = self._hs.getState(self._childId,'last-event')
+        self._batterylevel = registry.getState(self._childId,'battery-level')
+        self._lastevent = registry.getState(self._childId,'last-event')
             
-        if self._debug:
-            self._debugInfo = self._hs.getDebugInfo(self._childId)
             
+
+
+_ENTITY_TYPES = {'light': HubspaceLight, 'outlet': HubspaceOutlet, 'transformer': HubspaceTransformer, 'lock': HubspaceLock}
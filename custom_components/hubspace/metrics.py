@@ -0,0 +1,72 @@
+"""The client's API metrics in the Prometheus text format."""
+from __future__ import annotations
+
+from aiohttp import web
+
+from homeassistant.components.http import HomeAssistantView
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN, DATA_CLIENT
+from .hubspace import LATENCY_BUCKETS, ApiMetrics
+
+METRICS_URL = "/api/hubspace/metrics"
+
+COUNTERS = {
+    'token_refreshes': "Tokens fetched from the auth server",
+    'throttled': "Responses asking to slow down (429)",
+}
+
+
+def render_prometheus(metrics: ApiMetrics) -> str:
+    lines = [
+        "# HELP hubspace_api_requests_total Requests sent to the Hubspace cloud",
+        "# TYPE hubspace_api_requests_total counter",
+    ]
+    for endpoint, endpoint_metrics in metrics.endpoints.items():
+        lines.append(f'hubspace_api_requests_total{{endpoint="{endpoint}"}} {endpoint_metrics.requests}')
+    lines += [
+        "# HELP hubspace_api_errors_total Requests that failed or got an error status",
+        "# TYPE hubspace_api_errors_total counter",
+    ]
+    for endpoint, endpoint_metrics in metrics.endpoints.items():
+        lines.append(f'hubspace_api_errors_total{{endpoint="{endpoint}"}} {endpoint_metrics.errors}')
+    lines += [
+        "# HELP hubspace_api_timeouts_total Requests that timed out",
+        "# TYPE hubspace_api_timeouts_total counter",
+    ]
+    for endpoint, endpoint_metrics in metrics.endpoints.items():
+        lines.append(f'hubspace_api_timeouts_total{{endpoint="{endpoint}"}} {endpoint_metrics.timeouts}')
+    lines += [
+        "# HELP hubspace_api_request_duration_seconds Time from sending a request to reading its response",
+        "# TYPE hubspace_api_request_duration_seconds histogram",
+    ]
+    for endpoint, endpoint_metrics in metrics.endpoints.items():
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), endpoint_metrics.buckets):
+            cumulative += count
+            lines.append(f'hubspace_api_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+        lines.append(f'hubspace_api_request_duration_seconds_sum{{endpoint="{endpoint}"}} {endpoint_metrics.seconds}')
+        lines.append(f'hubspace_api_request_duration_seconds_count{{endpoint="{endpoint}"}} {endpoint_metrics.requests}')
+    for counter, description in COUNTERS.items():
+        lines += [
+            f"# HELP hubspace_{counter}_total {description}",
+            f"# TYPE hubspace_{counter}_total counter",
+            f"hubspace_{counter}_total {metrics.counters[counter]}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+class HubspaceMetricsView(HomeAssistantView):
+    """Serve the metrics for Prometheus to scrape, with a long-lived access token."""
+
+    url = METRICS_URL
+    name = "api:hubspace:metrics"
+
+    def __init__(self, hass: HomeAssistant) -> None:
+        self.hass = hass
+
+    async def get(self, request: web.Request) -> web.Response:
+        hs = self.hass.data.get(DOMAIN, {}).get(DATA_CLIENT)
+        if hs is None:
+            return web.Response(status=503, text="hubspace is not set up yet\n")
+        return web.Response(text=render_prometheus(hs.metrics), content_type="text/plain", charset="utf-8")
@@ -0,0 +1,74 @@
+"""Profile the update and command paths on demand, without restarting Home Assistant."""
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import pstats
+import time
+
+from homeassistant.core import HomeAssistant
+from homeassistant.exceptions import HomeAssistantError
+
+from .coordinator import HubspaceCoordinator
+from .hubspace import PhaseTimings
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SECONDS = 60
+MAX_SECONDS = 600
+# Functions listed in the text report, by cumulative time
+REPORT_FUNCTIONS = 40
+
+
+def _write_report(profiler, stats_path, report_path, seconds, phases):
+    profiler.dump_stats(stats_path)
+    stream = io.StringIO()
+    stream.write(f"Hubspace profile over {seconds} seconds\n\n")
+    stream.write("Time per phase, network includes waiting on the cloud, command includes the write window:\n")
+    stream.write(json.dumps(phases, indent=2))
+    stream.write("\n\n")
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_FUNCTIONS)
+    with open(report_path, 'w') as file:
+        file.write(stream.getvalue())
+
+
+async def async_profile(hass: HomeAssistant, coordinator: HubspaceCoordinator, seconds: int = DEFAULT_SECONDS, refresh: bool = True) -> dict:
+    """Profile the event loop and time the client's phases for seconds.
+
+    Writes hubspace_profile_<time>.prof, for pstats or snakeviz, and a text
+    report next to it in the config directory. cProfile sees everything on
+    the event loop, so other integrations show up too.
+    """
+    hs = coordinator.hs
+    if hs.timings is not None:
+        raise HomeAssistantError("A hubspace profile is already running")
+    seconds = min(max(int(seconds), 1), MAX_SECONDS)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as ex:
+        # Another profiler, e.g. Home Assistant's own, is active
+        raise HomeAssistantError(f"Unable to start profiling: {ex}") from ex
+    hs.timings = PhaseTimings()
+    _LOGGER.info("Profiling hubspace for %d seconds", seconds)
+    try:
+        if refresh:
+            # Make sure at least one poll falls into the window
+            await coordinator.async_refresh()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        timings, hs.timings = hs.timings, None
+
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    stats_path = hass.config.path(f"hubspace_profile_{stamp}.prof")
+    report_path = hass.config.path(f"hubspace_profile_{stamp}.txt")
+    phases = timings.summary()
+    await hass.async_add_executor_job(_write_report, profiler, stats_path, report_path, seconds, phases)
+    _LOGGER.info("Hubspace profile written to %s and %s", stats_path, report_path)
+    return {"profile": stats_path, "report": report_path, "phases": phases}
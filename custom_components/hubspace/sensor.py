@@ -0,0 +1,87 @@
+"""Diagnostic sensors with the API metrics of the Hubspace client."""
+from __future__ import annotations
+
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.const import EntityCategory
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+
+from .client import async_get_coordinator
+from .coordinator import HubspaceCoordinator
+from .metrics import COUNTERS
+
+# The endpoints that get a sensor, the rest only show up in Prometheus
+SENSOR_ENDPOINTS = ('token', 'metadevices', 'state_get', 'state_put')
+
+
+async def async_setup_platform(
+    hass: HomeAssistant,
+    config: ConfigType,
+    async_add_entities: AddEntitiesCallback,
+    discovery_info: DiscoveryInfoType | None = None
+) -> None:
+    """Set up the metric sensors, loaded by the hubspace component itself."""
+    if discovery_info is None:
+        return
+    coordinator = await async_get_coordinator(hass)
+    entities = [HubspaceRequestSensor(coordinator, endpoint) for endpoint in SENSOR_ENDPOINTS]
+    entities += [HubspaceCounterSensor(coordinator, counter, description) for counter, description in COUNTERS.items()]
+    async_add_entities(entities)
+
+
+class HubspaceMetricSensor(CoordinatorEntity, SensorEntity):
+    """A metric of the client, refreshed whenever the coordinator has news."""
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+    _attr_state_class = SensorStateClass.TOTAL_INCREASING
+
+    def __init__(self, coordinator: HubspaceCoordinator, key: str, name: str) -> None:
+        super().__init__(coordinator)
+        self._attr_name = name
+        self._attr_unique_id = f"hubspace_metrics_{key}"
+
+    @property
+    def available(self) -> bool:
+        # Metrics are most useful exactly when polls fail
+        return True
+
+
+class HubspaceRequestSensor(HubspaceMetricSensor):
+    """Requests sent to one endpoint, with errors and latency as attributes."""
+
+    _attr_icon = "mdi:cloud-sync"
+
+    def __init__(self, coordinator: HubspaceCoordinator, endpoint: str) -> None:
+        super().__init__(coordinator, f"{endpoint}_requests", f"Hubspace {endpoint.replace('_', ' ')} requests")
+        self._endpoint = endpoint
+
+    @property
+    def native_value(self) -> int:
+        return self.coordinator.hs.metrics.endpoints[self._endpoint].requests
+
+    @property
+    def extra_state_attributes(self):
+        metrics = self.coordinator.hs.metrics.endpoints[self._endpoint]
+        attr = {}
+        attr["errors"] = metrics.errors
+        attr["timeouts"] = metrics.timeouts
+        attr["average_seconds"] = round(metrics.seconds / metrics.requests, 3) if metrics.requests else None
+        attr["p95_seconds_at_most"] = metrics.quantile(0.95)
+        return attr
+
+
+class HubspaceCounterSensor(HubspaceMetricSensor):
+    """One of the client's counters, e.g. token refreshes or throttled responses."""
+
+    _attr_icon = "mdi:counter"
+
+    def __init__(self, coordinator: HubspaceCoordinator, counter: str, description: str) -> None:
+        super().__init__(coordinator, counter, f"Hubspace {counter.replace('_', ' ')}")
+        self._counter = counter
+        self._attr_extra_state_attributes = {"description": description}
+
+    @property
+    def native_value(self) -> int:
+        return self.coordinator.hs.metrics.counters[self._counter]
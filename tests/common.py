@@ -0,0 +1,95 @@
+"""Helpers shared by the Hubspace tests."""
+from __future__ import annotations
+
+import asyncio
+import copy
+from unittest.mock import Mock
+
+from custom_components.hubspace.hubspace import AsyncHubSpace, Metadevice
+
+ACCOUNT_ID = "account-1"
+
+
+def value(functionClass, value, lastUpdateTime, functionInstance=None):
+    return {"functionClass": functionClass, "functionInstance": functionInstance, "value": value, "lastUpdateTime": lastUpdateTime}
+
+
+def device(child, values, model="HPKA315CWB", deviceClass="power-outlet", friendlyName=None, functions=()):
+    """A metadevices entry for one device, like the cloud sends with expansions=state."""
+    return {
+        "id": child,
+        "typeId": "metadevice.device",
+        "deviceId": "device-" + child,
+        "friendlyName": friendlyName or "Device " + child,
+        "children": [],
+        "description": {
+            "id": "description-" + model,
+            "version": 1,
+            "device": {"model": model, "deviceClass": deviceClass, "defaultName": model, "manufacturerName": "Test"},
+            "functions": list(functions),
+        },
+        "state": {"metadeviceId": child, "values": list(values)},
+    }
+
+
+def set_value(metadevices, child, functionClass, new, lastUpdateTime, functionInstance=None):
+    """Change one state value of a device in a metadevices document."""
+    for lis in metadevices:
+        if lis["id"] == child:
+            for entry in lis["state"]["values"]:
+                if entry["functionClass"] == functionClass and entry["functionInstance"] == functionInstance:
+                    entry["value"] = new
+                    entry["lastUpdateTime"] = lastUpdateTime
+                    return
+    raise KeyError((child, functionClass, functionInstance))
+
+
+class FakeCloud:
+    """Stands in for the Afero API: serves the metadevices document and device states, and echoes PUTs.
+
+    Set hold to an asyncio.Event to keep a poll in flight, with the document
+    as it was when the request went out, until the event is set.
+    """
+
+    def __init__(self, metadevices):
+        self.metadevices = metadevices
+        self.polls = 0
+        self.gets = 0
+        self.puts = []
+        self.hold = None
+        self.polling = asyncio.Event()
+
+    def client(self) -> AsyncHubSpace:
+        hs = AsyncHubSpace("user", "password", None, login=False, write_window=0)
+        hs._accountId = ACCOUNT_ID
+        hs.iter_metadevices = self.iter_metadevices
+        hs._async_api_request = self.api_request
+        return hs
+
+    async def iter_metadevices(self):
+        self.polls += 1
+        metadevices = [Metadevice.fromDict(lis) for lis in copy.deepcopy(self.metadevices)]
+        if self.hold is not None:
+            self.polling.set()
+            await self.hold.wait()
+        for lis in metadevices:
+            yield lis
+
+    async def api_request(self, method, url, json=None, **kwargs):
+        if method == "get":
+            self.gets += 1
+            child = url.split("/")[-2]
+            await asyncio.sleep(0)
+            return copy.deepcopy(next(lis["state"] for lis in self.metadevices if lis["id"] == child))
+        assert method == "put", url
+        self.puts.append(json)
+        return {"metadeviceId": json["metadeviceId"], "values": json["values"]}
+
+
+async def add_entity(hass, entity, entity_id):
+    """Add an entity to hass without a platform, with its state writes recorded."""
+    entity.hass = hass
+    entity.entity_id = entity_id
+    entity.async_write_ha_state = Mock()
+    await entity.async_added_to_hass()
+    return entity
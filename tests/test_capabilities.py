@@ -0,0 +1,127 @@
+"""Tests for the capabilities compiled from device descriptions."""
+from __future__ import annotations
+
+from unittest.mock import Mock
+
+import json
+from pathlib import Path
+
+import pytest
+
+from homeassistant.components.fan import FanEntityFeature
+from homeassistant.components.light import ColorMode
+from homeassistant.util.percentage import percentage_to_ordered_list_item
+
+from custom_components.hubspace.capabilities import fan_capabilities, light_capabilities
+from custom_components.hubspace.fan import HubspaceFan
+from custom_components.hubspace.hubspace import FunctionDescriptor, Metadevice
+
+SAMPLES = Path(__file__).parent.parent / "sample_data"
+
+
+def _sample(name, deviceClass):
+    for lis in json.loads((SAMPLES / name).read_text()):
+        metadevice = Metadevice.fromDict(lis)
+        if metadevice.deviceClass == deviceClass:
+            return metadevice
+    raise LookupError(deviceClass)
+
+
+def _fan_functions(*names):
+    return (FunctionDescriptor.fromDict({"functionClass": "fan-speed", "functionInstance": "fan-speed", "type": "category",
+                                         "values": [{"name": name} for name in names]}),
+            FunctionDescriptor.fromDict({"functionClass": "power", "functionInstance": "fan-power", "type": "category",
+                                         "values": [{"name": "on"}, {"name": "off"}]}))
+
+
+@pytest.mark.parametrize("names", [
+    ("fan-speed-3-100", "fan-speed-3-033", "fan-speed-3-000", "fan-speed-3-066"),
+    ("fan-speed-6-000", "fan-speed-6-016", "fan-speed-6-033", "fan-speed-6-050", "fan-speed-6-066", "fan-speed-6-083", "fan-speed-6-100"),
+])
+def test_fan_speed_tables_round_trip(names):
+    capabilities = fan_capabilities("fan-model", _fan_functions(*names))
+    speeds = tuple(sorted(name for name in names if not name.endswith("-000")))
+
+    assert capabilities.speeds == speeds
+    assert capabilities.speed_count == len(names) - 1
+    assert capabilities.off_speed == next(name for name in names if name.endswith("-000"))
+    assert capabilities.power == "fan-power"
+    assert capabilities.value(0) == capabilities.off_speed
+    assert capabilities.percentages[capabilities.off_speed] == 0
+    for percentage in range(1, 101):
+        assert capabilities.value(percentage) == percentage_to_ordered_list_item(speeds, percentage)
+    # Every speed comes back as itself
+    for speed in speeds:
+        assert capabilities.value(capabilities.percentages[speed]) == speed
+    assert capabilities.value(-5) == capabilities.value(0)
+    assert capabilities.value(150) == speeds[-1]
+
+
+def test_fan_without_a_description_gets_four_speeds():
+    capabilities = fan_capabilities("old-fan", ())
+    assert capabilities.speeds == ("fan-speed-025", "fan-speed-050", "fan-speed-075", "fan-speed-100")
+    assert capabilities.value(50) == "fan-speed-050"
+
+
+def test_fan_without_speed_values_cannot_set_a_speed():
+    capabilities = fan_capabilities("switch-fan", _fan_functions())
+    assert capabilities.speed_count == 0
+    assert capabilities.value(50) is None
+
+    coordinator = Mock()
+    coordinator.data.functions.return_value = _fan_functions()
+    fan = HubspaceFan(coordinator, "Fan", childId="fan", model="switch-fan", deviceId="device", deviceClass="fan")
+    assert not fan.supported_features & FanEntityFeature.SET_SPEED
+
+    coordinator.data.functions.return_value = _fan_functions("fan-speed-000", "fan-speed-050", "fan-speed-100")
+    fan = HubspaceFan(coordinator, "Fan", childId="fan", model="two-speed-fan", deviceId="device", deviceClass="fan")
+    assert fan.supported_features & FanEntityFeature.SET_SPEED
+    assert fan.speed_count == 2
+
+
+def test_fan_light_capabilities():
+    fan_light = _sample("fanelee.json", "light")
+    capabilities = light_capabilities(fan_light.model, fan_light.functions)
+
+    assert capabilities.modes == {ColorMode.BRIGHTNESS, ColorMode.COLOR_TEMP, ColorMode.WHITE}
+    assert capabilities.power == "light-power"
+    assert (capabilities.min_mireds, capabilities.max_mireds) == (153, 371)
+    assert capabilities.temperatures == (2700, 3000, 3500, 4000, 5000, 6500)
+    assert capabilities.temperature_range is None
+    assert capabilities.nearest_temperature(3200) == 3000
+    assert capabilities.temperature_value(3000) == "3000K"
+    assert capabilities.kelvin("3000K") == "3000"
+    # Compiled once and shared by every device with the same description
+    assert light_capabilities(fan_light.model, fan_light.functions) is capabilities
+
+
+def test_bulb_capabilities():
+    bulb = _sample("11A21100WRGBWH1.json", "light")
+    capabilities = light_capabilities(bulb.model, bulb.functions)
+
+    assert capabilities.modes == {ColorMode.RGB, ColorMode.COLOR_TEMP, ColorMode.WHITE}
+    assert (capabilities.min_mireds, capabilities.max_mireds) == (154, 454)
+    assert capabilities.temperatures is None
+    assert capabilities.temperature_range == (2200, 6500, 100)
+    assert capabilities.nearest_temperature(1000) == 2200
+    assert capabilities.nearest_temperature(9000) == 6500
+    assert capabilities.nearest_temperature(3333) == 3300
+    assert capabilities.temperature_value(3300) == 3300
+
+
+def test_outlet_override_capabilities():
+    outlet = _sample("outlets.json", "power-outlet")
+    capabilities = light_capabilities(outlet.model, outlet.functions)
+
+    assert capabilities.modes == {ColorMode.RGB, ColorMode.WHITE}
+    assert capabilities.power == "primary"
+    assert (capabilities.min_mireds, capabilities.max_mireds) == (None, None)
+
+
+def test_sample_fan_speeds():
+    fan = _sample("fanelee.json", "fan")
+    capabilities = fan_capabilities(fan.model, fan.functions)
+
+    assert capabilities.speeds == ("fan-speed-025", "fan-speed-050", "fan-speed-075", "fan-speed-100")
+    assert capabilities.off_speed == "fan-speed-000"
+    assert capabilities.power == "fan-power"
@@ -0,0 +1,61 @@
+"""Tests for the shared client setup."""
+from __future__ import annotations
+
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+
+from homeassistant.const import Platform
+from homeassistant.helpers.dispatcher import async_dispatcher_connect, async_dispatcher_send
+
+from custom_components.hubspace import HUBSPACE_SCHEMA
+from custom_components.hubspace.client import CATALOG_KEY, async_get_coordinator, async_setup_hubspace_platform
+from custom_components.hubspace.const import DATA_COORDINATOR, DATA_DISCOVERY, DOMAIN, SIGNAL_NEW_DEVICES
+
+from .common import FakeCloud, device, value
+
+OUTLET = {"id": "outlet-1", "functionClass": "toggle", "functionInstance": "outlet-1", "type": "category",
+          "values": [{"name": "on"}, {"name": "off"}]}
+
+
+@pytest.mark.parametrize("expected_lingering_timers", [True])
+async def test_devices_missing_from_the_catalog_get_entities(hass, hass_storage):
+    strip = device("strip", [value("toggle", "on", 1000, "outlet-1")], functions=[OUTLET])
+    lamp = device("lamp", [value("power", "on", 1000, "light-power")], model="lamp-model", deviceClass="light")
+    hass_storage[CATALOG_KEY] = {"version": 1, "minor_version": 1, "key": CATALOG_KEY,
+                                 "data": {"username": "user", "metadevices": [strip]}}
+    hass.data[DOMAIN] = HUBSPACE_SCHEMA({"username": "user", "password": "password", "push": False})
+    cloud = FakeCloud([strip, lamp])
+    sent = []
+    async_dispatcher_connect(hass, SIGNAL_NEW_DEVICES, sent.append)
+
+    with patch("custom_components.hubspace.client.async_create_client", AsyncMock(return_value=cloud.client())):
+        coordinator = await async_get_coordinator(hass)
+        # Built from the catalog before the cloud was asked
+        assert [kwargs["childId"] for kind, kwargs in hass.data[DOMAIN][DATA_DISCOVERY][Platform.LIGHT]] == ["strip"]
+        await hass.async_block_till_done()
+
+    assert cloud.polls == 1
+    assert [[kwargs["childId"] for kind, kwargs in discovery[Platform.LIGHT]] for discovery in sent] == [["lamp"]]
+    assert [kwargs["childId"] for kind, kwargs in hass.data[DOMAIN][DATA_DISCOVERY][Platform.LIGHT]] == ["strip", "lamp"]
+
+    # Only the first poll is looked at
+    await coordinator.async_refresh()
+    assert len(sent) == 1
+    await coordinator.async_shutdown()
+
+
+async def test_a_platform_set_up_again_adds_new_devices_once(hass):
+    hass.data[DOMAIN] = {DATA_COORDINATOR: Mock(), DATA_DISCOVERY: {Platform.LIGHT: [("light", {"childId": "lamp"})]}}
+    types = {"light": lambda coordinator, childId: childId}
+    first, second = Mock(), Mock()
+
+    await async_setup_hubspace_platform(hass, Platform.LIGHT, types, first)
+    await async_setup_hubspace_platform(hass, Platform.LIGHT, types, second)
+    first.assert_called_once_with(["lamp"])
+    second.assert_called_once_with(["lamp"])
+
+    async_dispatcher_send(hass, SIGNAL_NEW_DEVICES, {Platform.LIGHT: [("light", {"childId": "strip"})], Platform.FAN: []})
+    await hass.async_block_till_done()
+    assert first.call_count == 1
+    second.assert_called_with(["strip"])
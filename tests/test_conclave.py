@@ -0,0 +1,146 @@
+"""Tests for the conclave push stream."""
+from __future__ import annotations
+
+import asyncio
+import json
+
+from custom_components.hubspace import conclave
+from custom_components.hubspace.conclave import ConclaveDecoder, ConclaveStream, _state_updates
+from custom_components.hubspace.hubspace import AuthenticationError
+
+from .common import ACCOUNT_ID, FakeCloud, device, value
+
+
+def _line(message):
+    return (json.dumps(message, ensure_ascii=False) + "\n").encode()
+
+
+def _state(child, *values):
+    return {"event": "metadevice:state", "data": {"metadeviceId": child, "values": list(values)}}
+
+
+def test_decoder_joins_split_chunks():
+    decoder = ConclaveDecoder()
+    data = _line({"name": "café"}) + _line({"n": 2})
+    # Split inside the multi-byte character and inside the second message
+    cut = data.index("é".encode()) + 1
+    assert decoder.feed(data[:cut]) == []
+    assert decoder.feed(data[cut:-5]) == [{"name": "café"}]
+    assert decoder.feed(data[-5:]) == [{"n": 2}]
+
+
+def test_decoder_skips_junk_between_frames():
+    decoder = ConclaveDecoder()
+    data = b"\x16\x03\x01junk without a brace\n" + _line({"n": 1}) + b"\x00\x00" + _line({"n": 2})
+    data += b"{not json}\n" + b"\n" + _line([1, 2]) + _line({"n": 3})
+    assert decoder.feed(data) == [{"n": 1}, {"n": 2}, {"n": 3}]
+
+
+def test_state_updates_need_a_known_metadevice_state():
+    message = {
+        "data": [
+            {"metadeviceId": "strip", "values": [value("toggle", "on", 1, "outlet-1")]},
+            {"metadeviceId": "unknown", "values": [value("power", "on", 1)]},
+            # A function description, not state
+            {"id": "strip", "functionClass": "toggle", "values": [{"name": "on"}]},
+            {"id": "strip", "functionClass": "power", "value": "on"},
+        ]
+    }
+    assert list(_state_updates(message, {"strip"})) == [("strip", [value("toggle", "on", 1, "outlet-1")])]
+
+
+async def test_stream_reconnects_with_backoff(monkeypatch, socket_enabled):
+    monkeypatch.setattr(conclave, "RECONNECT_MIN", 0.01)
+    monkeypatch.setattr(conclave, "RECONNECT_MAX", 1)
+    cloud = FakeCloud([device("strip", [value("toggle", "off", 1000, "outlet-1")])])
+    hs = cloud.client()
+    hs.loadRegistry(cloud.metadevices)
+
+    drop_third = asyncio.Event()
+    handlers = []
+    logins = []
+    delays = []
+    updates = []
+    connections = []
+    changed = asyncio.Condition()
+
+    async def handle(reader, writer):
+        handlers.append(asyncio.current_task())
+        logins.append(json.loads(await reader.readline()))
+        delays.append(stream.reconnect_delay)
+        attempt = len(logins)
+        # The first two attempts are dropped before they log in
+        if attempt >= 3:
+            writer.write(b"\x16\x03junk\n" + _line({"event": "login", "ok": True}))
+            data = _line(_state("strip", value("toggle", "on", 2000, "outlet-1")))
+            writer.write(data[:10])
+            await writer.drain()
+            writer.write(data[10:] + _line(_state("unknown", value("power", "on", 2000))))
+            await writer.drain()
+            if attempt == 3:
+                await drop_third.wait()
+            else:
+                await reader.read()
+        writer.close()
+
+    async def notify(log, item):
+        log.append(item)
+        async with changed:
+            changed.notify_all()
+
+    async def wait_for(predicate):
+        async with changed:
+            await asyncio.wait_for(changed.wait_for(predicate), 5)
+
+    stream = ConclaveStream(hs, lambda children: asyncio.ensure_future(notify(updates, children)),
+                            lambda connected: asyncio.ensure_future(notify(connections, connected)), ssl=None)
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def get_conclave():
+        return "127.0.0.1", port, "conclave-token", 0
+
+    hs.get_conclave = get_conclave
+    stream.start()
+    try:
+        await wait_for(lambda: updates)
+        assert connections == [True]
+        assert hs._snapshot.getState("strip", "toggle", "outlet-1") == "on"
+        drop_third.set()
+        await wait_for(lambda: len(connections) == 3)
+    finally:
+        await stream.stop()
+        server.close()
+        await server.wait_closed()
+        await asyncio.wait_for(asyncio.gather(*handlers), 5)
+
+    assert [login["login"]["accessToken"] for login in logins] == ["conclave-token"] * 4
+    assert logins[0]["login"]["channelId"] == ACCOUNT_ID
+    # Doubled after every attempt that never logged in, reset once one did
+    assert delays == [0.01, 0.02, 0.04, 0.02]
+    assert connections == [True, False, True]
+    assert updates == [{"strip"}, {"strip"}]
+
+
+async def test_stream_survives_unexpected_errors(monkeypatch, caplog):
+    monkeypatch.setattr(conclave, "RECONNECT_MIN", 0.01)
+    hs = FakeCloud([]).client()
+    connections = []
+    stream = ConclaveStream(hs, lambda children: None, connections.append, ssl=None)
+    calls = []
+
+    async def get_conclave():
+        calls.append(stream.reconnect_delay)
+        if len(calls) == 1:
+            stream._set_connected(True)
+            raise TypeError("unexpected conclaveAccess response")
+        raise AuthenticationError("stop")
+
+    hs.get_conclave = get_conclave
+    stream.start()
+    await asyncio.wait_for(stream._task, 5)
+
+    assert calls == [0.01, 0.02]
+    # Polling goes back to its normal interval while push is down
+    assert connections == [True, False]
+    assert "Conclave stream failed unexpectedly" in caplog.text
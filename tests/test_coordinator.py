@@ -0,0 +1,171 @@
+"""Tests for the account-wide coordinator and its entities."""
+from __future__ import annotations
+
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+
+from homeassistant.helpers.update_coordinator import UpdateFailed
+
+from custom_components.hubspace import coordinator as coordinator_module
+from custom_components.hubspace.coordinator import ActivityScheduler, HubspaceCoordinator, HubspaceEntity
+from custom_components.hubspace.fan import HubspaceFan
+from custom_components.hubspace.hubspace import DeviceRegistry, Metadevice
+from custom_components.hubspace.light import HubspaceOutlet
+
+from .common import FakeCloud, add_entity, device, set_value, value
+
+
+def _strip():
+    return [device("strip", [
+        value("toggle", "on", 1000, "outlet-1"),
+        value("toggle", "off", 1000, "outlet-2"),
+        value("wifi-rssi", -50, 1000),
+    ])]
+
+
+async def _outlets(hass, coordinator):
+    return [
+        await add_entity(hass, HubspaceOutlet(coordinator, "Strip", index, childId="strip",
+                                              model="HPKA315CWB", deviceId="device-strip", deviceClass="power-outlet"),
+                         "light.strip_outlet_" + index)
+        for index in ("1", "2")
+    ]
+
+
+async def test_identical_polls_write_no_state(hass):
+    cloud = FakeCloud(_strip())
+    coordinator = HubspaceCoordinator(hass, cloud.client())
+    await coordinator.async_refresh()
+    outlets = await _outlets(hass, coordinator)
+
+    await coordinator.async_refresh()
+    await coordinator.async_refresh()
+
+    assert cloud.polls == 3
+    assert coordinator.data.changed == set()
+    for outlet in outlets:
+        outlet.async_write_ha_state.assert_not_called()
+    await coordinator.async_shutdown()
+
+
+async def test_only_entities_reading_a_changed_value_write_state(hass):
+    cloud = FakeCloud(_strip())
+    coordinator = HubspaceCoordinator(hass, cloud.client())
+    await coordinator.async_refresh()
+    outlet1, outlet2 = await _outlets(hass, coordinator)
+
+    # Telemetry no entity shows
+    set_value(cloud.metadevices, "strip", "wifi-rssi", -60, 2000)
+    await coordinator.async_refresh()
+    assert coordinator.data.changed == {"strip"}
+    outlet1.async_write_ha_state.assert_not_called()
+    outlet2.async_write_ha_state.assert_not_called()
+
+    set_value(cloud.metadevices, "strip", "toggle", "on", 3000, "outlet-2")
+    await coordinator.async_refresh()
+    outlet1.async_write_ha_state.assert_not_called()
+    outlet2.async_write_ha_state.assert_called_once()
+    assert outlet2.is_on
+    await coordinator.async_shutdown()
+
+
+async def test_entities_must_read_the_registry(hass):
+    coordinator = HubspaceCoordinator(hass, FakeCloud(_strip()).client())
+    with pytest.raises(TypeError):
+        type("Bare", (HubspaceEntity,), {})(coordinator)
+
+
+def _fan():
+    return [device("fan", [
+        value("power", "on", 1000, "fan-power"),
+        value("fan-speed", "fan-speed-025", 1000, "fan-speed"),
+    ], model="fan-model", deviceClass="fan")]
+
+
+async def test_command_during_a_poll_shows_at_once_and_survives_the_poll(hass):
+    cloud = FakeCloud(_fan())
+    coordinator = HubspaceCoordinator(hass, cloud.client())
+    await coordinator.async_refresh()
+    fan = await add_entity(hass, HubspaceFan(coordinator, "Fan", childId="fan", model="fan-model",
+                                             deviceId="device-fan", deviceClass="fan"), "fan.fan")
+    assert fan.percentage == 25
+
+    # The poll's response was made before the command reached the cloud
+    cloud.hold = asyncio.Event()
+    poll = hass.async_create_task(coordinator.async_refresh())
+    await cloud.polling.wait()
+    await fan.async_set_percentage(100)
+    assert fan.percentage == 100
+    assert coordinator.data.getState("fan", "fan-speed") == "fan-speed-100"
+
+    cloud.hold.set()
+    await poll
+    assert cloud.polls == 2
+    assert fan.percentage == 100
+    assert coordinator.data.getState("fan", "fan-speed") == "fan-speed-100"
+    await coordinator.async_shutdown()
+
+
+async def test_push_during_a_poll_survives_the_poll(hass):
+    cloud = FakeCloud(_fan())
+    hs = cloud.client()
+    coordinator = HubspaceCoordinator(hass, hs)
+    await coordinator.async_refresh()
+
+    cloud.hold = asyncio.Event()
+    poll = hass.async_create_task(coordinator.async_refresh())
+    await cloud.polling.wait()
+    hs.applyPushedState("fan", [value("fan-speed", "fan-speed-100", 2000, "fan-speed")])
+    coordinator._handle_push({"fan"})
+    assert coordinator.data.getState("fan", "fan-speed") == "fan-speed-100"
+
+    cloud.hold.set()
+    await poll
+    assert coordinator.data.getState("fan", "fan-speed") == "fan-speed-100"
+
+    # Once stored, a newer poll wins over the push again
+    cloud.hold = None
+    set_value(cloud.metadevices, "fan", "fan-speed", "fan-speed-050", 3000, "fan-speed")
+    await coordinator.async_refresh()
+    assert coordinator.data.getState("fan", "fan-speed") == "fan-speed-050"
+    await coordinator.async_shutdown()
+
+
+def test_telemetry_does_not_count_as_activity():
+    scheduler = ActivityScheduler(timedelta(seconds=15), timedelta(minutes=5))
+    now = time.time() * 1000
+    metadevices = [device("strip", [value("toggle", "on", now - 3600 * 1000, "outlet-1"), value("wifi-rssi", -50, now)])]
+    scheduler.observe(DeviceRegistry([Metadevice.fromDict(lis) for lis in metadevices]))
+    # Only the toggle counts, and it has been idle for an hour
+    assert scheduler.interval() == timedelta(minutes=5)
+
+    set_value(metadevices, "strip", "wifi-rssi", -60, now + 1000)
+    scheduler.observe(DeviceRegistry([Metadevice.fromDict(lis) for lis in metadevices]))
+    assert scheduler.interval() == timedelta(minutes=5)
+
+    set_value(metadevices, "strip", "toggle", "off", now + 2000, "outlet-1")
+    scheduler.observe(DeviceRegistry([Metadevice.fromDict(lis) for lis in metadevices]))
+    assert scheduler.interval() == timedelta(seconds=15)
+
+
+async def test_poll_past_the_deadline_fails_and_is_abandoned(hass, monkeypatch):
+    monkeypatch.setattr(coordinator_module, "UPDATE_DEADLINE", 0.01)
+    cloud = FakeCloud(_fan())
+    cloud.hold = asyncio.Event()
+    hs = cloud.client()
+    coordinator = HubspaceCoordinator(hass, hs)
+
+    await coordinator.async_refresh()
+    assert not coordinator.last_update_success
+    assert isinstance(coordinator.last_exception, UpdateFailed)
+    # Not left running in the background
+    await asyncio.sleep(0)
+    assert hs._snapshot_task.cancelled()
+
+    cloud.hold = None
+    await coordinator.async_refresh()
+    assert coordinator.last_update_success
+    await coordinator.async_shutdown()
@@ -0,0 +1,65 @@
+"""Tests for the anonymized diagnostics dump."""
+from __future__ import annotations
+
+import json
+
+from custom_components.hubspace import HUBSPACE_SCHEMA
+from custom_components.hubspace.coordinator import HubspaceCoordinator
+from custom_components.hubspace.dump import build_diagnostics
+from custom_components.hubspace.light import HubspaceOutlet
+
+from .common import FakeCloud, add_entity, device, value
+
+STRIP = "0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0"
+LAMP = "11111111-2222-3333-4444-555555555555"
+ROOM = "99999999-8888-7777-6666-555555555555"
+SECRETS = ("Boys Light", "boys_light", "Garage Lamp", "Kids Room", "a1b2c3d4e5f6", "HomeWifi", STRIP, LAMP, ROOM)
+
+
+def _account():
+    account = [
+        device(STRIP, [
+            value("toggle", "on", 1000, "outlet-1"),
+            value("wifi-ssid", "HomeWifi", 1000),
+            value("wifi-mac-address", "a1b2c3d4e5f6", 1000),
+        ], friendlyName="Boys Light"),
+        device(LAMP, [value("power", "on", 1000)], model="lamp-model", deviceClass="light", friendlyName="Garage Lamp"),
+        {"id": ROOM, "typeId": "metadevice.room", "friendlyName": "Kids Room", "children": [STRIP]},
+    ]
+    account[0]["deviceId"] = "d" * 16
+    account[1]["deviceId"] = "e" * 16
+    return account
+
+
+async def test_targeted_dump_leaves_no_names_macs_or_ssids(hass):
+    coordinator = HubspaceCoordinator(hass, FakeCloud(_account()).client())
+    await coordinator.async_refresh()
+    await add_entity(hass, HubspaceOutlet(coordinator, "Boys Light", "1", childId=STRIP, model="HPKA315CWB",
+                                          deviceId="d" * 16, deviceClass="power-outlet"),
+                     "light.boys_light_outlet_1")
+    conf = HUBSPACE_SCHEMA({"username": "user@example.com", "password": "secret",
+                            "friendlynames": ["Garage Lamp"], "roomnames": ["Kids Room"]})
+
+    diagnostics = build_diagnostics(coordinator, conf, {STRIP})
+
+    text = json.dumps(diagnostics)
+    for secret in SECRETS + ("user@example.com", "secret"):
+        assert secret not in text
+    assert len(diagnostics["metadevices"]) == 1
+    # The entity still points at the dumped device
+    (entity_id, child), = diagnostics["coordinator"]["entities"].items()
+    assert entity_id == "light.hubspace_0"
+    assert child == diagnostics["metadevices"][0]["id"]
+    assert diagnostics["config"]["roomnames"] != ["Kids Room"]
+    await coordinator.async_shutdown()
+
+
+async def test_plain_dump_keeps_names(hass):
+    coordinator = HubspaceCoordinator(hass, FakeCloud(_account()).client())
+    await coordinator.async_refresh()
+    conf = HUBSPACE_SCHEMA({"username": "user", "password": "secret"})
+
+    diagnostics = build_diagnostics(coordinator, conf, anonymized=False)
+
+    assert [lis["friendlyName"] for lis in diagnostics["metadevices"]] == ["Boys Light", "Garage Lamp", "Kids Room"]
+    await coordinator.async_shutdown()
@@ -0,0 +1,303 @@
+"""Tests for the Hubspace cloud client."""
+from __future__ import annotations
+
+import asyncio
+import time
+from unittest.mock import Mock
+
+import aiohttp
+import pytest
+import requests
+
+from custom_components.hubspace import hubspace
+from custom_components.hubspace.hubspace import API_URL, TOKEN_URL, AsyncHubSpace, AuthenticationError, CircuitBreaker, CircuitOpenError, HubSpace, RateLimiter
+
+from .common import ACCOUNT_ID, FakeCloud, device, set_value, value
+
+AUTH_URL = "https://accounts.hubspaceconnect.com/auth/realms/thd/protocol/openid-connect/auth"
+AUTHENTICATE_URL = "https://accounts.hubspaceconnect.com/auth/realms/thd/login-actions/authenticate"
+LOGIN_PAGE = '<form action="...?session_code=abc&execution=def&client_id=hubspace_android&tab_id=ghi&">'
+
+
+async def test_rejected_login_is_not_retried():
+    hs = AsyncHubSpace("user", "password", None, login=False)
+    hs.login = Mock(side_effect=AuthenticationError("Hubspace rejected the username or password"))
+    hs.start_login()
+    for attempt in range(3):
+        with pytest.raises(AuthenticationError):
+            await hs.wait_for_login()
+    assert hs.login.call_count == 1
+
+
+async def test_failed_login_backs_off():
+    hs = AsyncHubSpace("user", "password", None, login=False)
+    hs.login = Mock(side_effect=requests.exceptions.ConnectionError("down"))
+    hs.start_login()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        await hs.wait_for_login()
+    # Requests while the pause lasts fail without logging in
+    with pytest.raises(CircuitOpenError):
+        await hs.wait_for_login()
+    assert hs.login.call_count == 1
+
+    hs._login_retry_at = 0
+    with pytest.raises(requests.exceptions.ConnectionError):
+        await hs.wait_for_login()
+    assert hs.login.call_count == 2
+    assert hs._login_delay == 4 * AsyncHubSpace._login_retry_min
+
+    hs.login.side_effect = None
+    hs._login_retry_at = 0
+    await hs.wait_for_login()
+    assert hs.login.call_count == 3
+    assert hs._login_delay == AsyncHubSpace._login_retry_min
+
+
+def test_wrong_password_is_an_authentication_error(requests_mock):
+    requests_mock.get(AUTH_URL, text=LOGIN_PAGE)
+    # Keycloak answers a wrong password with the login form instead of a redirect
+    requests_mock.post(AUTHENTICATE_URL, text=LOGIN_PAGE)
+    hs = HubSpace("user", "wrong", login=False)
+    with pytest.raises(AuthenticationError):
+        hs.getRefreshCode()
+
+
+def test_server_errors_while_logging_in_are_not_authentication_errors(requests_mock):
+    requests_mock.get(AUTH_URL, text=LOGIN_PAGE)
+    requests_mock.post(AUTHENTICATE_URL, status_code=503)
+    hs = HubSpace("user", "password", login=False)
+    with pytest.raises(requests.exceptions.HTTPError):
+        hs.getRefreshCode()
+
+
+def _fan_light():
+    # A fan-light has one power function per part
+    return [device("fan", [
+        value("power", "on", 1000, "fan-power"),
+        value("power", "on", 1000, "light-power"),
+    ], model="fan-model", deviceClass="fan")]
+
+
+async def test_set_state_returns_the_written_instance():
+    cloud = FakeCloud(_fan_light())
+    hs = cloud.client()
+    await hs.refresh_registry()
+
+    assert await hs.set_state("fan", "power", "off", "fan-power") == "off"
+    assert [lis["functionInstance"] for lis in cloud.puts[0]["values"]] == ["fan-power"]
+    assert hs._snapshot.getState("fan", "power", "light-power") == "on"
+
+
+async def test_device_state_reads_share_a_fetch_in_flight():
+    cloud = FakeCloud(_fan_light())
+    hs = cloud.client()
+    await hs.refresh_registry()
+
+    assert await asyncio.gather(hs.get_state("fan", "power", "fan-power"),
+                                hs.get_state("fan", "power", "light-power")) == ["on", "on"]
+    assert cloud.gets == 1
+
+    # Nothing is cached once the fetch is done
+    set_value(cloud.metadevices, "fan", "power", "off", 2000, "light-power")
+    assert await hs.get_state("fan", "power", "light-power") == "off"
+    assert cloud.gets == 2
+    assert hs._snapshot.getState("fan", "power", "light-power") == "off"
+
+
+def test_sync_client_reads_and_writes(requests_mock):
+    metadevices = _fan_light()
+    state_url = API_URL + "/accounts/" + ACCOUNT_ID + "/metadevices/fan/state"
+    requests_mock.get(API_URL + "/accounts/" + ACCOUNT_ID + "/metadevices?expansions=state", json=metadevices)
+    requests_mock.get(state_url, json=metadevices[0]["state"])
+    requests_mock.put(state_url, json={"metadeviceId": "fan", "values": [value("power", "off", 2000, "fan-power")]})
+    hs = HubSpace("user", "password", login=False)
+    hs._accountId = ACCOUNT_ID
+    hs.getAuthTokenFromRefreshToken = lambda: "token"
+
+    assert hs.getRegistry().getState("fan", "power", "fan-power") == "on"
+    assert hs.getDeviceState("fan").get("power", "light-power") == "on"
+    assert hs.setState("fan", "power", "off", "fan-power") == "off"
+    assert requests_mock.last_request.json()["values"][0]["functionInstance"] == "fan-power"
+    assert hs._snapshot.getState("fan", "power", "light-power") == "on"
+
+
+async def test_quick_writes_share_one_put():
+    cloud = FakeCloud(_fan_light())
+    hs = cloud.client()
+    hs._write_window = 0.05
+    await hs.refresh_registry()
+
+    first, second = await asyncio.gather(
+        hs.queue_states("fan", [("power", "fan-power", "off")]),
+        hs.queue_states("fan", [("power", "light-power", "off"), ("power", "fan-power", "on")]),
+    )
+
+    assert len(cloud.puts) == 1
+    # Only the latest value per function is sent
+    assert {lis["functionInstance"]: lis["value"] for lis in cloud.puts[0]["values"]} == {"fan-power": "on", "light-power": "off"}
+    assert first is second
+    assert first.get("power", "light-power") == "off"
+
+
+async def test_failed_put_reaches_every_writer():
+    cloud = FakeCloud(_fan_light())
+    hs = cloud.client()
+    await hs.refresh_registry()
+
+    async def api_request(method, url, **kwargs):
+        raise requests.exceptions.ConnectionError("down")
+
+    hs._async_api_request = api_request
+    results = await asyncio.gather(hs.queue_states("fan", [("power", "fan-power", "off")]),
+                                   hs.queue_states("fan", [("power", "light-power", "off")]), return_exceptions=True)
+    assert [type(result) for result in results] == [requests.exceptions.ConnectionError] * 2
+    assert not hs._flush_tasks
+
+
+async def test_cancelled_writes_do_not_leave_writers_waiting():
+    cloud = FakeCloud(_fan_light())
+    hs = cloud.client()
+    await hs.refresh_registry()
+    sending = asyncio.Event()
+
+    async def api_request(method, url, **kwargs):
+        sending.set()
+        await asyncio.Event().wait()
+
+    # One write is being sent, the other still waits for its window
+    hs._async_api_request = api_request
+    sent = asyncio.ensure_future(hs.queue_states("fan", [("power", "fan-power", "off")]))
+    await sending.wait()
+    hs._write_window = 60
+    queued = asyncio.ensure_future(hs.queue_states("light", [("power", None, "off")]))
+    await asyncio.sleep(0)
+
+    await hs.cancel_writes()
+    for writer in (sent, queued):
+        with pytest.raises(asyncio.CancelledError):
+            await writer
+    assert not hs._flush_tasks
+    assert not hs._pending_writes
+
+
+class Clock:
+    """Stands in for time.monotonic, moved on by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_refills_and_queues_callers(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(hubspace.time, "monotonic", clock)
+    limiter = RateLimiter("host", 2, 3)
+
+    assert [limiter.reserve() for attempt in range(3)] == [0, 0, 0]
+    # Past the burst, later callers queue up behind earlier ones
+    assert limiter.reserve() == 0.5
+    assert limiter.reserve() == 1.0
+    clock.now += 1
+    assert limiter.reserve() == 0.5
+    # A long quiet spell refills no more than the burst
+    clock.now += 60
+    assert [limiter.reserve() for attempt in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_rate_limiter_obeys_retry_after(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(hubspace.time, "monotonic", clock)
+    limiter = RateLimiter("host", 0, 1)
+
+    assert limiter.tooManyRequests(7) == 7
+    assert limiter.reserve() == 7
+    clock.now += 5
+    assert limiter.reserve() == 2
+    clock.now += 2
+    assert limiter.reserve() == 0
+    # Without a Retry-After the pause doubles with every 429 in a row
+    assert limiter.tooManyRequests() == 2
+    assert limiter.tooManyRequests() == 4
+    limiter.succeeded()
+    assert limiter.tooManyRequests() == 1
+    assert limiter.throttled == 4
+
+
+def test_429_waits_for_retry_after_before_trying_again(requests_mock, monkeypatch):
+    url = API_URL + "/accounts/account-1/metadevices"
+    requests_mock.get(url, [{"status_code": 429, "headers": {"Retry-After": "7"}}, {"json": []}])
+    sleeps = []
+    monkeypatch.setattr(hubspace.time, "sleep", sleeps.append)
+    hs = HubSpace("user", "password", login=False)
+
+    assert hs._request("get", url).status_code == 200
+    assert requests_mock.call_count == 2
+    assert sleeps == [0, pytest.approx(7, abs=0.5)]
+
+
+def test_circuit_breaker_opens_after_failures_and_recovers_half_open(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(hubspace.time, "monotonic", clock)
+    breaker = CircuitBreaker("host")
+
+    for attempt in range(CircuitBreaker._failure_threshold - 1):
+        breaker.before()
+        breaker.record(False)
+    assert not breaker.open
+    breaker.before()
+    breaker.record(False)
+    assert breaker.open
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+    # Half open: a single probe goes out, and a failed one opens it for twice as long
+    clock.now += CircuitBreaker._reset_timeout
+    breaker.before()
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+    breaker.record(False)
+    clock.now += CircuitBreaker._reset_timeout
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+    # A probe that was cancelled lets the next request probe instead
+    clock.now += CircuitBreaker._reset_timeout
+    breaker.before()
+    breaker.record(None)
+    breaker.before()
+    breaker.record(True)
+    assert not breaker.open
+    assert breaker.failures == 0
+    breaker.before()
+
+
+async def test_concurrent_401s_refresh_the_token_once_and_replay():
+    hs = AsyncHubSpace("user", "password", None, login=False)
+    hs._last_token = "old"
+    hs._token_expires = time.time() + 3600
+    hs._refresh_token = "refresh"
+    sent = []
+
+    async def request(method, url, headers=None, **kwargs):
+        if url == TOKEN_URL:
+            sent.append("token")
+            await asyncio.sleep(0)
+            return {"id_token": "new", "expires_in": 120}
+        token = headers["authorization"]
+        sent.append((url, token))
+        await asyncio.sleep(0)
+        if token == "Bearer old":
+            raise aiohttp.ClientResponseError(Mock(), (), status=401)
+        return {"url": url}
+
+    hs._async_request = request
+    urls = [API_URL + "/accounts/account-1/metadevices/" + child + "/state" for child in ("a", "b", "c")]
+    results = await asyncio.gather(*(hs._async_api_request("get", url) for url in urls))
+
+    assert results == [{"url": url} for url in urls]
+    assert sent.count("token") == 1
+    for url in urls:
+        assert [entry[1] for entry in sent if entry[0] == url] == ["Bearer old", "Bearer new"]
+    assert hs.metrics.counters["token_refreshes"] == 1
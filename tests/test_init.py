@@ -0,0 +1,35 @@
+"""Tests for the integration's configuration and services."""
+from __future__ import annotations
+
+import pytest
+import voluptuous as vol
+
+from custom_components.hubspace import DUMP_DIAGNOSTICS_SCHEMA, HUBSPACE_SCHEMA, PROFILE_SCHEMA
+from custom_components.hubspace.dump import DEFAULT_MAX_SIZE
+from custom_components.hubspace.profiler import MAX_SECONDS
+
+
+@pytest.mark.parametrize(("option", "value"), [("debug", True), ("snapshot_ttl", 30)])
+def test_unused_options_are_deprecated(caplog, option, value):
+    conf = HUBSPACE_SCHEMA({"username": "user", "password": "password", option: value})
+    assert conf["username"] == "user"
+    assert f"'{option}' option is deprecated" in caplog.text
+
+
+def test_service_options_get_defaults():
+    assert DUMP_DIAGNOSTICS_SCHEMA({}) == {"anonymize": True, "max_size": DEFAULT_MAX_SIZE}
+    assert DUMP_DIAGNOSTICS_SCHEMA({"entity_id": "light.lamp"})["entity_id"] == ["light.lamp"]
+    # What the target selector sends for an area or device
+    assert DUMP_DIAGNOSTICS_SCHEMA({"area_id": "kitchen", "device_id": ["abc"]})["area_id"] == ["kitchen"]
+    assert PROFILE_SCHEMA({"seconds": "30"}) == {"seconds": 30, "refresh": True}
+
+
+@pytest.mark.parametrize(("schema", "data"), [
+    (DUMP_DIAGNOSTICS_SCHEMA, {"max_size": -1}),
+    (DUMP_DIAGNOSTICS_SCHEMA, {"anonymise": False}),
+    (PROFILE_SCHEMA, {"seconds": 0}),
+    (PROFILE_SCHEMA, {"seconds": MAX_SECONDS + 1}),
+])
+def test_bad_service_options_are_rejected(schema, data):
+    with pytest.raises(vol.Invalid):
+        schema(data)
@@ -0,0 +1,64 @@
+"""Tests for the API metrics, their sensors and the Prometheus view."""
+from __future__ import annotations
+
+from unittest.mock import Mock
+
+from custom_components.hubspace.const import DATA_CLIENT, DOMAIN
+from custom_components.hubspace.hubspace import API_URL, ApiMetrics, HubSpace
+from custom_components.hubspace.metrics import HubspaceMetricsView, render_prometheus
+from custom_components.hubspace.sensor import HubspaceCounterSensor, HubspaceRequestSensor
+
+from .common import ACCOUNT_ID
+
+
+def test_render_prometheus():
+    metrics = ApiMetrics()
+    metrics.observe('metadevices', 0.2)
+    metrics.observe('metadevices', 3, 'error')
+    metrics.observe('metadevices', 60, 'timeout')
+    metrics.count('token_refreshes')
+    lines = render_prometheus(metrics).splitlines()
+
+    assert 'hubspace_api_requests_total{endpoint="metadevices"} 3' in lines
+    assert 'hubspace_api_requests_total{endpoint="state_put"} 0' in lines
+    assert 'hubspace_api_errors_total{endpoint="metadevices"} 1' in lines
+    assert 'hubspace_api_timeouts_total{endpoint="metadevices"} 1' in lines
+    # Buckets are cumulative
+    assert 'hubspace_api_request_duration_seconds_bucket{endpoint="metadevices",le="0.1"} 0' in lines
+    assert 'hubspace_api_request_duration_seconds_bucket{endpoint="metadevices",le="0.25"} 1' in lines
+    assert 'hubspace_api_request_duration_seconds_bucket{endpoint="metadevices",le="5"} 2' in lines
+    assert 'hubspace_api_request_duration_seconds_bucket{endpoint="metadevices",le="30"} 2' in lines
+    assert 'hubspace_api_request_duration_seconds_bucket{endpoint="metadevices",le="+Inf"} 3' in lines
+    assert 'hubspace_api_request_duration_seconds_sum{endpoint="metadevices"} 63.2' in lines
+    assert 'hubspace_token_refreshes_total 1' in lines
+    assert 'hubspace_throttled_total 0' in lines
+
+
+def test_throttled_responses_are_counted(requests_mock):
+    url = API_URL + "/accounts/" + ACCOUNT_ID + "/metadevices"
+    requests_mock.get(url, [{"status_code": 429, "headers": {"Retry-After": "0"}}, {"json": []}])
+    hs = HubSpace("user", "password", login=False)
+    coordinator = Mock(hs=hs)
+    counter = HubspaceCounterSensor(coordinator, 'throttled', "Responses asking to slow down (429)")
+    requests = HubspaceRequestSensor(coordinator, 'metadevices')
+    assert counter.native_value == 0
+
+    assert hs._request('get', url).status_code == 200
+    assert counter.native_value == 1
+    assert requests.native_value == 2
+    assert requests.extra_state_attributes["errors"] == 1
+
+
+async def test_metrics_view(hass):
+    view = HubspaceMetricsView(hass)
+    hass.data[DOMAIN] = {}
+    response = await view.get(Mock())
+    assert response.status == 503
+
+    hs = HubSpace("user", "password", login=False)
+    hs.metrics.count('token_refreshes')
+    hass.data[DOMAIN][DATA_CLIENT] = hs
+    response = await view.get(Mock())
+    assert response.status == 200
+    assert response.content_type == "text/plain"
+    assert "hubspace_token_refreshes_total 1\n" in response.text
@@ -0,0 +1,63 @@
+"""Tests for the streaming parser of the metadevices document."""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from custom_components.hubspace.hubspace import Metadevice, MetadeviceParser
+
+SAMPLES = Path(__file__).parent.parent / "sample_data"
+
+
+def _parse(document: bytes, chunk: int):
+    parser = MetadeviceParser()
+    metadevices = []
+    for start in range(0, len(document), chunk):
+        metadevices.extend(parser.feed(document[start:start + chunk]))
+    metadevices.extend(parser.close())
+    return [metadevice.asDict() for metadevice in metadevices]
+
+
+def _expected(document: bytes):
+    return [Metadevice.fromDict(lis).asDict() for lis in json.loads(document)]
+
+
+@pytest.mark.parametrize("name", ["11A21100WRGBWH1.json", "fanelee.json", "outlets.json"])
+@pytest.mark.parametrize("chunk", [1, 7, 4096, 1 << 20])
+def test_samples_match_json_loads(name, chunk):
+    document = (SAMPLES / name).read_bytes()
+    assert _parse(document, chunk) == _expected(document)
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 5])
+def test_escaped_and_multibyte_strings_split_across_chunks(chunk):
+    document = json.dumps([
+        {"id": "a", "typeId": "metadevice.device", "friendlyName": 'Den "lamp" ]}, \\ [{'},
+        {"id": "b", "typeId": "metadevice.device", "friendlyName": "Küche ☕ \U0001f4a1"},
+    ], ensure_ascii=False).encode()
+    parsed = _parse(document, chunk)
+    assert parsed == _expected(document)
+    assert [lis["friendlyName"] for lis in parsed] == ['Den "lamp" ]}, \\ [{', "Küche ☕ \U0001f4a1"]
+
+
+def test_unknown_keys_are_skipped():
+    document = json.dumps([{
+        "id": "a", "typeId": "metadevice.device", "friendlyName": "Lamp",
+        "deviceValues": [{"key": "]}", "nested": {"deep": [1, 2, {"x": "}"}]}}],
+        "createdTimestampMs": 0,
+        "state": {"metadeviceId": "a", "values": [{"functionClass": "power", "value": "on", "lastUpdateTime": 1, "extra": True}]},
+    }]).encode()
+    parsed = _parse(document, 3)
+    assert parsed == _expected(document)
+    assert set(parsed[0]) == {"id", "typeId", "friendlyName", "state"}
+
+
+def test_truncated_document_is_an_error():
+    parser = MetadeviceParser()
+    parser.feed(b'[{"id": "a"}, {"id": "b", "friendly')
+    with pytest.raises(ValueError):
+        parser.close()
+    with pytest.raises(ValueError):
+        MetadeviceParser().feed(b'{"id": "a"}')